@@ -0,0 +1,159 @@
+"""
+Вспомогательный модуль для онлайн-рекомендаций по ALS-модели с дообучением вектора пользователя (fold-in).
+
+Из обученной модели implicit.als.AlternatingLeastSquares сохраняются только матрица факторов
+объектов Y (float32, n_items x factors) и параметры regularization и alpha (см. build_artifacts.py).
+По последним онлайн-событиям пользователя вектор x_u вычисляется так же, как на шаге ALS для
+пользователя с неизменными факторами объектов (веса всех событий равны 1, доверие c = alpha):
+
+    x_u = (Y^T Y + (c - 1) * Y_u^T Y_u + regularization * I)^(-1) * c * sum(Y_u),
+
+где Y_u - строки Y для объектов из событий. Матрица (Y^T Y + regularization * I)^(-1) вычисляется
+один раз при загрузке, поэтому при c = 1 fold-in - это сумма нескольких строк и одно умножение
+матрицы factors x factors на вектор. Оценки всего каталога - одно умножение Y x_u, а top-k
+выбирается через np.argpartition без полной сортировки; объекты из событий исключаются.
+
+Матрица факторов хранится в директории с .npy-файлами и отображается в память (np.memmap),
+поэтому несколько воркеров используют одну копию через кэш ОС.
+"""
+
+import logging
+import numpy as np
+from csr_index import save_arrays, load_arrays
+from hot_reload import artifacts_stamp, artifacts_version
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class ALSFoldIn:
+    """
+    Класс для получения рекомендаций по факторам объектов ALS-модели и онлайн-событиям пользователя
+    """
+
+    def __init__(self):
+
+        # Отсортированные item_id, матрица факторов (строки в порядке item_ids),
+        # обратная матрица (Y^T Y + regularization * I)^(-1) и параметры модели
+        self._model = None
+        # Путь к директории с факторами (для перезагрузки) и версия загруженных данных
+        self._source = None
+        self.version = None
+
+    @staticmethod
+    def save(directory, item_ids, factors, regularization, alpha=1.0):
+        """
+        Сохраняет факторы объектов ALS-модели в директорию для отображения в память
+        (строки упорядочиваются по item_id)
+        """
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        order = np.argsort(item_ids, kind="stable")
+        save_arrays(directory, {
+            "item_ids": item_ids[order],
+            "factors": np.asarray(factors, dtype=np.float32)[order],
+            "params": np.array([regularization, alpha], dtype=np.float64),
+        })
+
+    @staticmethod
+    def _read(directory, use_mmap=True):
+        """
+        Открывает сохраненные факторы и вычисляет обратную матрицу для fold-in
+        """
+        logger.info(f"Loading data, type: als, from {directory}")
+        arrays = load_arrays(directory, mmap_mode="r" if use_mmap else None)
+        factors = arrays["factors"]
+        regularization, alpha = arrays["params"].tolist()
+
+        # Y^T Y считаем в float64 по частям, чтобы не загружать всю матрицу в память сразу
+        gram = np.zeros((factors.shape[1], factors.shape[1]), dtype=np.float64)
+        for start in range(0, len(factors), 1_000_000):
+            chunk = np.asarray(factors[start:start + 1_000_000], dtype=np.float64)
+            gram += chunk.T @ chunk
+        gram_inv = np.linalg.inv(gram + regularization * np.eye(len(gram)))
+
+        return {
+            "item_ids": arrays["item_ids"],
+            "factors": factors,
+            "gram": gram,
+            "gram_inv": gram_inv.astype(np.float32),
+            "regularization": regularization,
+            "alpha": alpha,
+        }
+
+    def load(self, directory, use_mmap=True):
+        """
+        Загружает факторы объектов из директории
+        """
+        self._source = (directory, use_mmap)
+        self._model = self._read(directory, use_mmap)
+        self.version = artifacts_version(self.artifacts_stamp())
+        logger.info(f"Loaded")
+
+    def artifacts_stamp(self):
+        """
+        Возвращает отметку директории с факторами
+        """
+        return artifacts_stamp([self._source[0]])
+
+    def build_state(self):
+        """
+        Загружает новую версию факторов из той же директории (для перезагрузки)
+        """
+        stamp = self.artifacts_stamp()
+
+        return self._read(*self._source), artifacts_version(stamp)
+
+    def swap(self, state):
+        """
+        Атомарно заменяет текущую версию факторов на новую
+        """
+        self._model, self.version = state
+
+    def fold_in(self, rows, model=None):
+        """
+        Возвращает вектор пользователя по номерам строк факторов объектов из его событий
+        """
+        model = model or self._model
+        factors_u = np.asarray(model["factors"][rows], dtype=np.float32)
+        alpha = model["alpha"]
+        if alpha == 1.0:
+            return model["gram_inv"] @ factors_u.sum(axis=0)
+
+        a = model["gram"] + (alpha - 1) * (factors_u.T @ factors_u) + model["regularization"] * np.eye(len(model["gram"]))
+        return np.linalg.solve(a, alpha * factors_u.sum(axis=0, dtype=np.float64)).astype(np.float32)
+
+    def get(self, item_ids, k: int = 10, exclude_seen: bool = True):
+        """
+        Возвращает k объектов с наибольшими оценками для пользователя с событиями item_ids
+        (NumPy-массивы идентификаторов и оценок по убыванию оценки)
+        """
+        try:
+            model = self._model
+            all_item_ids, factors = model["item_ids"], model["factors"]
+
+            # Объекты, которых нет в модели, пропускаем
+            item_ids = np.asarray(item_ids, dtype=np.int64)
+            rows = np.minimum(np.searchsorted(all_item_ids, item_ids), len(all_item_ids) - 1)
+            rows = np.unique(rows[all_item_ids[rows] == item_ids])
+            if len(rows) == 0 or k <= 0:
+                return {"item_id": np.empty(0, dtype=np.int64), "score": np.empty(0, dtype=np.float32),
+                        "version": self.version}
+
+            # Оценки всего каталога одним умножением матрицы на вектор
+            scores = factors @ self.fold_in(rows, model)
+
+            # Берем с запасом на исключаемые объекты из событий и сортируем только их
+            n = min(k + (len(rows) if exclude_seen else 0), len(scores))
+            top = np.argpartition(scores, len(scores) - n)[len(scores) - n:]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            if exclude_seen:
+                top = top[~np.isin(top, rows)]
+            top = top[:k]
+
+            recs = {"item_id": all_item_ids[top], "score": scores[top], "version": self.version}
+        except Exception as e:
+            logger.error(f"{e}, no recommendations found")
+            recs = {"item_id": np.empty(0, dtype=np.int64), "score": np.empty(0, dtype=np.float32),
+                    "version": self.version}
+
+        return recs
@@ -0,0 +1,64 @@
+"""
+Вспомогательный модуль с построением, сохранением и открытием структур для быстрого поиска
+оффлайн-рекомендаций и похожих объектов.
+
+Модуль не зависит от FastAPI-приложений, поэтому его используют и сервисы при загрузке рекомендаций,
+и скрипт build_artifacts.py при конвертации parquet-файлов (без чтения config.ini и создания клиентов).
+
+Основные функции:
+- build_recommendations(), save_recommendations(), open_recommendations() - персональные рекомендации
+(индекс CSRIndex user_id -> item_id по возрастанию rank) и рекомендации по умолчанию (массив item_id);
+- build_similar_items() - индекс CSRIndex item_id_1 -> похожие объекты по убыванию score.
+"""
+
+import numpy as np
+from csr_index import CSRIndex, save_arrays, load_arrays
+
+
+def build_recommendations(type, recs):
+    """
+    Строит по датафрейму рекомендаций структуру для быстрого поиска
+    """
+    if type == "personal":
+        # Персональные рекомендации сортируем по (user_id, rank) и храним
+        # плоским массивом item_id со смещениями для каждого пользователя
+        return CSRIndex.from_frame(
+            recs, "user_id", ["item_id"], sort_by="rank", dtypes={"item_id": np.int32}
+        )
+    # Рекомендации по умолчанию - просто массив item_id в порядке файла
+    return recs["item_id"].to_numpy()
+
+
+def save_recommendations(type, recs, directory):
+    """
+    Сохраняет структуру, построенную через build_recommendations, в директорию для отображения в память
+    """
+    if type == "personal":
+        recs.save(directory)
+    else:
+        save_arrays(directory, {"item_id": recs})
+
+
+def open_recommendations(type, directory):
+    """
+    Открывает сохраненную через save_recommendations структуру, отображая ее в память только для чтения
+    """
+    if type == "personal":
+        return CSRIndex.open(directory)
+    return load_arrays(directory)["item_id"]
+
+
+def build_similar_items(similar_items):
+    """
+    Строит по датафрейму похожих объектов индекс item_id_1 -> похожие объекты
+    """
+    # Соседей каждого объекта упорядочиваем по убыванию score,
+    # чтобы top-k был просто префиксом среза
+    return CSRIndex.from_frame(
+        similar_items,
+        "item_id_1",
+        ["item_id_2", "score"],
+        sort_by="score",
+        ascending=False,
+        dtypes={"item_id_2": np.int32, "score": np.float32},
+    )
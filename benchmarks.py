@@ -0,0 +1,1031 @@
+"""
+Вспомогательный скрипт с микро-бенчмарками компонентов рекомендательного сервиса.
+
+Основные реализованные функции:
+- bench_recs_lookup() - сравнение времени поиска оффлайн-рекомендаций пользователя
+через DataFrame.query и через индекс CSRIndex на синтетической таблице;
+- bench_event_persistence() - время сохранения и восстановления хранилища онлайн-событий
+и накладные расходы журналирования на одно событие;
+- bench_stores() - накладные расходы http-клиента вспомогательных сервисов по сравнению со встроенным
+на один запрос (одинаковость ответов обоих клиентов проверяет test_store_clients.py);
+- bench_blend() - сравнение скорости векторизованного смешивания и прежнего цикла
+(совпадение результатов проверяет test_blending.py);
+- bench_evaluation() - совпадение метрик precision, recall и novelty, рассчитанных через Evaluator,
+с прежним расчетом через merge и groupby и время расчета обоими способами;
+- bench_event_store() - память на одного пользователя и скорость добавления событий
+в хранилище онлайн-событий по сравнению с прежней реализацией на списках;
+- bench_seen() - память на одного пользователя и задержка исключения прослушанных треков из рекомендаций
+по сравнению с множествами Python;
+- bench_reload() - задержки запросов к запущенному сервису во время перезагрузки рекомендаций;
+- bench_als() - задержка онлайн-рекомендаций по ALS-модели (fold-in + оценка всего каталога)
+в зависимости от размера каталога;
+- bench_serialization() - время кодирования и декодирования ответа с похожими объектами
+в JSON через FastAPI, в JSON напрямую и в двоичном формате;
+- bench_default() - пропускная способность /recommendations_default и /recommendations_offline для холодных
+пользователей с заранее закодированным ответом по сравнению с прежним маршрутом FastAPI (без сети, вызовом ASGI-приложения);
+- bench_metrics() - накладные расходы сбора метрик на один запрос;
+- bench_batch() - пропускная способность /recommendations_batch в пользователях в секунду;
+- bench_shards() - пропускная способность /put и /get шардированного хранилища онлайн-событий
+в зависимости от кол-ва шардов (шарды и клиенты запускаются отдельными процессами),
+проверка маршрутизации и доли пользователей, переходящих на новый шард;
+- bench_load() - нагрузочный тест запущенного сервиса: пропускная способность и задержки
+при разном количестве одновременных клиентов.
+
+Примеры запуска:
+python benchmarks.py --recs_lookup --n_users 1000000 --n_recs 100
+python benchmarks.py --blend --k 100
+python benchmarks.py --event_store --n_users 1000000 --n_puts 5000000
+python benchmarks.py --evaluation --n_users 1000000 --workers 4
+python benchmarks.py --event_persistence --n_users 10000000
+python benchmarks.py --seen --n_users 1000000 --n_events 50
+python benchmarks.py --stores --n_users 1000
+python benchmarks.py --reload --endpoint /recommendations_offline
+python benchmarks.py --als --n_items 1000000 --factors 50
+python benchmarks.py --serialization --k 100
+python benchmarks.py --default --k 10 100
+python benchmarks.py --metrics --n_calls 1000000
+python benchmarks.py --batch --n_users 1000000 --format ndjson
+python benchmarks.py --shards --n_shards 1 2 4 --n_clients 4 --duration 10
+python benchmarks.py --load --endpoint /recommendations_online --concurrency 1 4 16 64
+"""
+
+import sys
+import time
+import asyncio
+import tracemalloc
+import logging
+import argparse
+import configparser
+import httpx
+import numpy as np
+import pandas as pd
+
+from csr_index import CSRIndex
+
+
+# Создаем парсер конфигурационного файла
+config = configparser.ConfigParser()
+config.read("config.ini")
+
+# Основной сервис для получения оффлайн- и онлайн-рекомендаций
+recommendations_url = config["urls"]["recommendations_url"].strip('"') # "http://127.0.0.1:8000"
+# Вспомогательные сервисы хранилища похожих объектов и онлайн-событий
+features_store_url = config["urls"]["features_store_url"].strip('"') # "http://127.0.0.1:8010"
+events_store_url = config["urls"]["events_store_url"].strip('"') # "http://127.0.0.1:8020"
+
+
+# Настраиваем логирование
+logger = logging.getLogger('benchmarks_logs')
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(module)s, %(funcName)s, %(message)s')
+
+
+# Вспомогательные функции
+
+def make_recommendations(n_users: int, n_recs: int, n_items: int = 1_000_000, seed: int = 0):
+    """
+    Генерирует синтетическую таблицу в формате recommendations.parquet
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "user_id": np.repeat(np.arange(n_users, dtype=np.int32), n_recs),
+        "item_id": rng.integers(0, n_items, n_users * n_recs, dtype=np.int32),
+        "rank": np.tile(np.arange(1, n_recs + 1, dtype=np.int32), n_users),
+    })
+
+
+def timeit(func, args_list):
+    """
+    Вызывает func для каждого набора аргументов и возвращает задержки в микросекундах
+    """
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append((time.perf_counter() - start) * 1e6)
+
+    return np.array(latencies)
+
+
+def log_latencies(name, latencies):
+    logger.info(
+        f"{name:<20} mean={latencies.mean():.1f}us "
+        f"p50={np.percentile(latencies, 50):.1f}us p99={np.percentile(latencies, 99):.1f}us"
+    )
+
+
+# Поиск оффлайн-рекомендаций пользователя
+def bench_recs_lookup(n_users: int = 1_000_000, n_recs: int = 100, k: int = 100, n_queries: int = 100):
+    """
+    Сравнивает старый (DataFrame.query) и новый (CSRIndex) способы поиска рекомендаций
+    """
+    logger.info(f"Generating {n_users} users x {n_recs} recs")
+    recs = make_recommendations(n_users, n_recs)
+
+    start = time.perf_counter()
+    index = CSRIndex.from_frame(recs, "user_id", ["item_id"], sort_by="rank", dtypes={"item_id": np.int32})
+    logger.info(f"Index built in {time.perf_counter() - start:.2f}s")
+
+    rng = np.random.default_rng(1)
+    users = [(int(u),) for u in rng.integers(0, n_users, n_queries)]
+
+    def lookup_query(user_id):
+        return recs.query('user_id == @user_id')["item_id"].to_list()[:k]
+
+    def lookup_index(user_id):
+        return index.get(user_id, "item_id", k).tolist()
+
+    # Проверяем, что оба способа возвращают одно и то же
+    for (user_id,) in users[:10]:
+        assert lookup_query(user_id) == lookup_index(user_id)
+
+    log_latencies("DataFrame.query", timeit(lookup_query, users))
+    log_latencies("CSRIndex", timeit(lookup_index, users * 100))
+
+
+# Смешивание рекомендаций
+def legacy_blend(recs_offline, recs_online, k):
+    """
+    Прежняя реализация смешивания чередованием на списках (для сравнения)
+    """
+    recs_blended = []
+    min_length = min(len(recs_offline), len(recs_online))
+    offline_idx = online_idx = 0
+    for i in range(2 * min_length):
+        if i % 2 == 0:
+            recs_blended.append(recs_offline[offline_idx])
+            offline_idx += 1
+        else:
+            recs_blended.append(recs_online[online_idx])
+            online_idx += 1
+    if len(recs_offline) >= len(recs_online):
+        recs_blended.extend(recs_offline[offline_idx:])
+    else:
+        recs_blended.extend(recs_online[online_idx:])
+
+    seen = set()
+    recs_blended = [id for id in recs_blended if not (id in seen or seen.add(id))]
+
+    return recs_blended[:k]
+
+
+def bench_blend(k=100, n_lists=1000):
+    """
+    Сравнивает скорость прежнего цикла и blend() на списках длиной k
+    (совпадение результатов проверяет test_blending.py)
+    """
+    from blending import blend
+
+    rng = np.random.default_rng(0)
+    args = [(rng.integers(0, 10 * k, k).tolist(), rng.integers(0, 10 * k, k).tolist()) for _ in range(n_lists)]
+    log_latencies("legacy", timeit(lambda a, b: legacy_blend(a, b, k), args))
+    log_latencies("interleave", timeit(lambda a, b: blend([a, b], k=k).tolist(), args))
+    log_latencies("rrf", timeit(lambda a, b: blend([a, b], strategy="rrf", k=k).tolist(), args))
+
+
+# Метрики качества рекомендаций
+def legacy_binary_metrics(events_train, events_test, recs, top_k):
+    """
+    Прежний расчет precision@k и recall@k через merge и groupby (как в ноутбуке, для сравнения)
+    """
+    events_test = events_test.assign(gt=True)
+    common_users = set(events_test["user_id"]) & set(recs["user_id"])
+    events_for_common_users = events_test[events_test["user_id"].isin(common_users)]
+    recs_for_common_users = recs[recs["user_id"].isin(common_users)].sort_values(["user_id", "score"], ascending=[True, False])
+    events_for_common_users = events_for_common_users[events_for_common_users["item_id"].isin(events_train["item_id"].unique())]
+    recs_for_common_users = recs_for_common_users.groupby("user_id").head(top_k)
+
+    events_recs_common = events_for_common_users[["user_id", "item_id", "gt"]].merge(
+        recs_for_common_users[["user_id", "item_id", "score"]], on=["user_id", "item_id"], how="outer")
+    events_recs_common["gt"] = events_recs_common["gt"].fillna(False).astype(bool)
+    events_recs_common["pr"] = ~events_recs_common["score"].isnull()
+    events_recs_common["tp"] = events_recs_common["gt"] & events_recs_common["pr"]
+    events_recs_common["fp"] = ~events_recs_common["gt"] & events_recs_common["pr"]
+    events_recs_common["fn"] = events_recs_common["gt"] & ~events_recs_common["pr"]
+
+    groupper = events_recs_common.groupby("user_id")
+    precision = (groupper["tp"].sum() / (groupper["tp"].sum() + groupper["fp"].sum())).fillna(0).mean()
+    recall = (groupper["tp"].sum() / (groupper["tp"].sum() + groupper["fn"].sum())).fillna(0).mean()
+
+    return precision, recall
+
+
+def legacy_novelty(events_train, recs, top_k):
+    """
+    Прежний расчет novelty@k через merge и groupby (как в ноутбуке, для сравнения)
+    """
+    recs = recs.merge(events_train[["user_id", "item_id"]].assign(played=True), on=["user_id", "item_id"], how="left")
+    recs["played"] = recs["played"].fillna(False).astype("bool")
+    recs = recs.sort_values(by="score", ascending=False, kind="stable")
+    recs["rank"] = recs.groupby("user_id").cumcount() + 1
+
+    return (1 - recs.query("rank <= @top_k").groupby("user_id")["played"].mean()).mean()
+
+
+def bench_evaluation(n_users=200_000, n_items=100_000, n_events=20, n_recs=50, k=5, workers=1):
+    """
+    Сравнивает метрики и время их расчета через merge и groupby (как в ноутбуке) и через Evaluator
+    на синтетических событиях и рекомендациях (популярность объектов - по распределению Ципфа)
+    """
+    from evaluation import Evaluator
+
+    rng = np.random.default_rng(0)
+    n = n_users * n_events
+    events = pd.DataFrame({
+        "user_id": rng.integers(0, n_users, n, dtype=np.int32),
+        "item_id": ((rng.zipf(1.2, n) - 1) % n_items).astype(np.int32),
+        "is_train": rng.random(n) < 0.8,
+    })
+    events_train, events_test = events[events["is_train"]], events[~events["is_train"]]
+    recs = make_recommendations(n_users, n_recs, n_items)
+    recs["item_id"] = ((rng.zipf(1.2, len(recs)) - 1) % n_items).astype(np.int32)
+    recs["score"] = rng.random(len(recs))
+
+    start = time.perf_counter()
+    precision, recall = legacy_binary_metrics(events_train, events_test, recs, k)
+    novelty = legacy_novelty(events_train, recs, k)
+    logger.info(f"legacy    {time.perf_counter() - start:.2f}s precision={precision:.6f} recall={recall:.6f} novelty={novelty:.6f}")
+
+    start = time.perf_counter()
+    evaluator = Evaluator(events_train, events_test, np.arange(n_items))
+    logger.info(f"Evaluator built in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    metrics = evaluator.evaluate(recs, k, n_shards=max(workers, 1), workers=workers)
+    logger.info(f"Evaluator {time.perf_counter() - start:.2f}s " + " ".join(f"{name}={value:.6f}" for name, value in metrics.items()))
+
+    assert np.isclose(metrics["precision"], precision) and np.isclose(metrics["recall"], recall)
+    assert np.isclose(metrics["novelty"], novelty)
+
+
+# Хранилище онлайн-событий
+class ListEventStore:
+    """
+    Прежняя реализация хранилища событий на словаре списков (для сравнения)
+    """
+
+    def __init__(self, max_events_per_user=10):
+
+        self.events = {}
+        self.max_events_per_user = max_events_per_user
+
+    def put(self, user_id, item_id):
+        user_events = self.events.get(user_id, [])
+        self.events[user_id] = [item_id] + user_events[: self.max_events_per_user]
+
+
+def bench_event_store(n_users=1_000_000, n_puts=5_000_000, max_events_per_user=10):
+    """
+    Измеряет память на одного пользователя и кол-во добавляемых событий в секунду
+    """
+    from events_service import EventStore
+
+    rng = np.random.default_rng(0)
+    user_ids = rng.integers(0, n_users, n_puts).tolist()
+    item_ids = rng.integers(0, 1_000_000, n_puts).tolist()
+
+    for name, store_class in (("list", ListEventStore), ("ring buffer", EventStore)):
+        # Скорость добавления событий
+        store = store_class(max_events_per_user)
+        start = time.perf_counter()
+        for user_id, item_id in zip(user_ids, item_ids):
+            store.put(user_id, item_id)
+        elapsed = time.perf_counter() - start
+        del store
+
+        # Память: как и при разборе http-запроса, каждый item_id - новый объект int
+        tracemalloc.start()
+        store = store_class(max_events_per_user)
+        for user_id, item_id in zip(user_ids, item_ids):
+            store.put(user_id, item_id + 0)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        users = len(store.events) if name == "list" else len(store)
+        logger.info(
+            f"{name:<12} puts/sec={n_puts / elapsed:,.0f} "
+            f"memory per user={memory / users:.0f} bytes ({users} users)"
+        )
+        del store
+
+
+# Исключение прослушанных треков из рекомендаций
+def bench_seen(n_users=1_000_000, n_events=50, n_items=1_000_000, k=100, n_queries=10_000, n_puts=100_000):
+    """
+    Сравнивает память на одного пользователя и задержку фильтрации списка из 2 * k рекомендаций
+    для SeenItems и множеств Python (set item_id на пользователя)
+    """
+    from seen_items import SeenItems
+
+    # Кол-во событий пользователей распределено экспоненциально со средним n_events
+    rng = np.random.default_rng(0)
+    counts = rng.geometric(1 / n_events, n_users)
+    user_ids = np.repeat(np.arange(n_users), counts)
+    item_ids = rng.integers(0, n_items, len(user_ids))
+    logger.info(f"Generated {len(user_ids)} events of {n_users} users")
+
+    start = time.perf_counter()
+    seen = SeenItems()
+    seen._index = SeenItems.build(user_ids, item_ids)
+    logger.info(f"SeenItems built in {time.perf_counter() - start:.2f}s")
+
+    # Множества только для части пользователей, иначе не хватит памяти
+    n_set_users = min(n_users, 100_000)
+    bounds = np.searchsorted(user_ids, [0, n_set_users])
+    tracemalloc.start()
+    sets = {}
+    for user_id, item_id in zip(user_ids[bounds[0]:bounds[1]].tolist(), item_ids[bounds[0]:bounds[1]].tolist()):
+        sets.setdefault(user_id, set()).add(item_id)
+    set_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    logger.info(f"{'set':<12} memory per user={set_memory / n_set_users:.0f} bytes")
+    logger.info(f"{'SeenItems':<12} memory per user={seen.nbytes / n_users:.0f} bytes")
+
+    # Списки рекомендаций: половина - прослушанные треки пользователя, половина - случайные
+    users = rng.integers(0, n_set_users, n_queries)
+    queries = []
+    for user_id in users.tolist():
+        played = np.array(list(sets[user_id]))
+        recs = np.concatenate([rng.choice(played, k), rng.integers(0, n_items, k)])
+        queries.append((user_id, rng.permutation(recs)))
+
+    def filter_set(user_id, recs):
+        user_seen = sets.get(user_id, ())
+        return [item_id for item_id in recs.tolist() if item_id not in user_seen][:k]
+
+    def filter_seen(user_id, recs):
+        return seen.filter(user_id, recs)[:k].tolist()
+
+    # Проверяем, что оба способа возвращают одно и то же
+    for user_id, recs in queries[:1000]:
+        assert filter_set(user_id, recs) == filter_seen(user_id, recs)
+
+    log_latencies("set", timeit(filter_set, queries))
+    log_latencies("SeenItems", timeit(filter_seen, queries))
+
+    # Добавление онлайн-событий
+    puts = list(zip(rng.integers(0, n_users, n_puts).tolist(), rng.integers(0, n_items, n_puts).tolist()))
+    log_latencies("SeenItems.add", timeit(seen.add, puts))
+    log_latencies("SeenItems (+ online)", timeit(filter_seen, queries))
+
+
+# Сохранение хранилища онлайн-событий на диск
+async def run_event_persistence(n_users, n_log_events, directory):
+    """
+    Заполняет хранилище, сохраняет контрольную точку и дописывает журнал,
+    после чего измеряет время восстановления
+    """
+    import shutil
+    from events_service import EventStore
+    from events_persistence import EventStorePersistence
+
+    shutil.rmtree(directory, ignore_errors=True)
+    rng = np.random.default_rng(0)
+
+    store = EventStore(initial_capacity=n_users)
+    persistence = EventStorePersistence(store, directory)
+    persistence.restore()
+    for start in range(0, n_users, 1_000_000):
+        user_ids = np.arange(start, min(start + 1_000_000, n_users))
+        store.put_batch(np.repeat(user_ids, 3), rng.integers(0, 1_000_000, 3 * len(user_ids)))
+
+    started_at = time.perf_counter()
+    await persistence.checkpoint()
+    logger.info(f"Checkpoint of {len(store)} users saved in {time.perf_counter() - started_at:.2f}s")
+
+    # Накладные расходы на /put: добавление в хранилище с журналированием и без
+    user_ids = rng.integers(0, n_users, n_log_events).tolist()
+    item_ids = rng.integers(0, 1_000_000, n_log_events).tolist()
+    for name, record in (("put", False), ("put + log", True)):
+        started_at = time.perf_counter()
+        for user_id, item_id in zip(user_ids, item_ids):
+            store.put(user_id, item_id)
+            if record:
+                persistence.record(user_id, item_id)
+        logger.info(f"{name:<12} {(time.perf_counter() - started_at) / n_log_events * 1e9:.0f}ns per event")
+    await persistence.flush()
+    del store, persistence
+
+    started_at = time.perf_counter()
+    store = EventStore()
+    EventStorePersistence(store, directory).restore()
+    logger.info(f"Restored {len(store)} users in {time.perf_counter() - started_at:.2f}s")
+
+
+def bench_event_persistence(n_users=10_000_000, n_log_events=1_000_000, directory="bench_events_persistence"):
+    """
+    Измеряет время сохранения и восстановления хранилища онлайн-событий
+    """
+    asyncio.run(run_event_persistence(n_users, n_log_events, directory))
+
+
+# Сравнение встроенного и http-клиентов вспомогательных сервисов
+async def run_stores(n_users, n_items, k):
+    """
+    Наполняет оба хранилища событий одинаковыми событиями и сравнивает ответы
+    и задержки встроенного и http-клиентов (http-сервисы должны быть запущены)
+    """
+    from events_service import EventStore
+    from features_service import sim_items_store
+    from store_clients import HttpStoresClient, EmbeddedStoresClient
+    from sharding import parse_urls
+
+    embedded = EmbeddedStoresClient(EventStore(), sim_items_store, similar_items_path="similar.parquet")
+    http = HttpStoresClient(
+        events_store_url, features_store_url, timeout=10.0,
+        events_store_shards=parse_urls(config.get("urls", "events_store_shards", fallback="")),
+        virtual_nodes=config.getint("events", "virtual_nodes", fallback=100),
+    )
+    await embedded.start()
+    await http.start()
+
+    rng = np.random.default_rng(0)
+    user_ids = np.arange(n_users)
+    item_ids = rng.integers(0, n_items, (n_users, 3))
+    async with httpx.AsyncClient() as client:
+        for user_id, items in zip(user_ids, item_ids):
+            for item_id in items:
+                embedded.events_store.put(int(user_id), int(item_id))
+                # событие отправляется шарду пользователя, как в test_service.py
+                await client.post(http.events_ring.node(user_id) + "/put",
+                                  params={"user_id": int(user_id), "item_id": int(item_id)})
+
+    latencies = {}
+    for name, stores in (("embedded", embedded), ("http", http)):
+        latencies[name] = []
+        for user_id in user_ids:
+            start = time.perf_counter()
+            events, _ = await stores.get_events(int(user_id), 3)
+            i2i = await stores.get_similar_items(events, k)
+            latencies[name].append((time.perf_counter() - start) * 1e6)
+            if name == "http":
+                expected_events, _ = await embedded.get_events(int(user_id), 3)
+                expected = await embedded.get_similar_items(expected_events, k)
+                assert np.array_equal(i2i["item_id_2"], expected["item_id_2"]), f"Different results for user_id={user_id}"
+
+    await http.close()
+
+    return {name: np.array(values) for name, values in latencies.items()}
+
+
+def bench_stores(n_users=1000, n_items=1_000_000, k=100):
+    """
+    Измеряет накладные расходы http-клиента по сравнению со встроенным на один онлайн-запрос
+    """
+    latencies = asyncio.run(run_stores(n_users, n_items, k))
+    for name, values in latencies.items():
+        log_latencies(name, values)
+    overhead = np.median(latencies["http"]) - np.median(latencies["embedded"])
+    logger.info(f"http overhead per online request: {overhead:.1f}us")
+
+
+# Онлайн-рекомендации по ALS-модели
+def bench_als(n_items=1_000_000, factors=50, k=100, n_events=10, n_queries=100, directory="bench_als.idx"):
+    """
+    Измеряет задержку fold-in и оценки всего каталога для синтетической матрицы факторов,
+    сохраненной на диск и отображенной в память, и сравнивает выбор top-k через
+    np.argpartition с полной сортировкой оценок
+    """
+    import shutil
+    from als_foldin import ALSFoldIn
+
+    rng = np.random.default_rng(0)
+    item_ids = np.arange(n_items, dtype=np.int64)
+    ALSFoldIn.save(directory, item_ids, (rng.standard_normal((n_items, factors)) * 0.1).astype(np.float32), 0.05)
+    als_store = ALSFoldIn()
+    als_store.load(directory)
+
+    queries = [(rng.integers(0, n_items, n_events),) for _ in range(n_queries)]
+    log_latencies("fold-in + top-k", timeit(lambda events: als_store.get(events, k), queries))
+
+    def full_sort(events):
+        scores = als_store._model["factors"] @ als_store.fold_in(np.unique(events))
+        return np.argsort(-scores)[:k]
+
+    log_latencies("fold-in + argsort", timeit(full_sort, queries))
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+# Кодирование ответов сервисов
+def bench_serialization(k=100, n_calls=10_000):
+    """
+    Сравнивает время кодирования и декодирования ответа /similar_items_batch длиной k:
+    прежний путь FastAPI (jsonable_encoder + JSONResponse), прямой JSON и двоичный формат
+    """
+    import json
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    import encoding
+
+    rng = np.random.default_rng(0)
+    content = {
+        "item_id_2": rng.integers(0, 1_000_000, k).astype(np.int32),
+        "score": rng.random(k, dtype=np.float32),
+        "version": "20240803-194029",
+    }
+
+    def fastapi_json():
+        # прежний путь: массивы переводились в списки, ответ проходил через jsonable_encoder
+        as_lists = {"item_id_2": content["item_id_2"].tolist(), "score": content["score"].tolist(),
+                    "version": content["version"]}
+        return JSONResponse(jsonable_encoder(as_lists)).body
+
+    encoders = {
+        "fastapi_json": (fastapi_json, json.loads),
+        "fast_json": (lambda: encoding.dumps(content), json.loads),
+        "packed": (lambda: encoding.pack(content), encoding.unpack),
+    }
+    for name, (encode, decode) in encoders.items():
+        data = encode()
+        encode_us = timeit(lambda: [encode() for _ in range(n_calls)], [()])[0] / n_calls
+        decode_us = timeit(lambda: [decode(data) for _ in range(n_calls)], [()])[0] / n_calls
+        logger.info(f"{name:<14} encode={encode_us:.1f}us decode={decode_us:.1f}us size={len(data)}B")
+
+
+# Заранее закодированные ответы с рекомендациями по умолчанию
+async def asgi_post(app, path, query_string):
+    """
+    Вызывает ASGI-приложение с POST-запросом без http-сервера и возвращает статус и тело ответа
+    """
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query_string.encode(),
+        "headers": [(b"host", b"127.0.0.1")], "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 8000),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+
+    return messages[0]["status"], b"".join(message.get("body", b"") for message in messages[1:])
+
+
+async def run_default(ks, n_calls, n_default):
+    """
+    Сравнивает прежний маршрут FastAPI /recommendations_default (список + сериализация на каждый запрос)
+    с заранее закодированным ответом
+    """
+    from fastapi import Header
+    from metrics import stage, encoded_response
+    import recommendations_service as service
+
+    rec_store = service.rec_store
+    recs = {"personal": CSRIndex.from_frame(make_recommendations(1000, 10), "user_id", ["item_id"], sort_by="rank"),
+            "default": np.random.default_rng(0).permutation(1_000_000)[:n_default]}
+    rec_store.swap((recs, "20240803-194029", rec_store._build_response(recs, "20240803-194029")))
+
+    # прежняя реализация endpoint
+    async def legacy_recommendations_default(k: int = 100, accept: str | None = Header(None)):
+        with stage("recommendations", "index_lookup"):
+            recs = rec_store.get_default(k)
+        return encoded_response("recommendations", {"recs": recs, "version": rec_store.version}, accept)
+
+    service.app.add_api_route("/legacy_recommendations_default", legacy_recommendations_default, methods=["POST"])
+
+    # холодный пользователь - без персональных рекомендаций и прослушанных треков
+    cold_user_id = 10_000_000
+    for k in ks:
+        expected = await asgi_post(service.app, "/legacy_recommendations_default", f"k={k}")
+        for path in ("/legacy_recommendations_default", "/recommendations_default", "/recommendations_offline"):
+            query_string = f"k={k}&user_id={cold_user_id}"
+            assert await asgi_post(service.app, path, query_string) == expected, f"Different responses for {path}"
+            start = time.perf_counter()
+            for _ in range(n_calls):
+                await asgi_post(service.app, path, query_string)
+            logger.info(f"{path:<32} k={k:<4} rps={n_calls / (time.perf_counter() - start):,.0f}")
+
+
+def bench_default(ks=(10, 100), n_calls=10_000, n_default=1000):
+    """
+    Измеряет кол-во запросов в секунду, которое обрабатывает приложение основного сервиса
+    (без сети и http-клиента, т.е. верхняя граница пропускной способности одного воркера)
+    """
+    asyncio.run(run_default(ks, n_calls, n_default))
+
+
+# Накладные расходы сбора метрик
+def bench_metrics(n_calls=1_000_000):
+    """
+    Измеряет время замера одного этапа (stage), записи в гистограмму и формирования ответа /metrics
+    """
+    import metrics
+
+    histogram = metrics.Histogram("bench_duration_seconds", "", ("service", "endpoint"))
+    counter = metrics.Counter("bench_requests_total", "", ("service", "endpoint", "status"))
+
+    def empty_loop():
+        for _ in range(n_calls):
+            pass
+
+    def stage_loop():
+        for _ in range(n_calls):
+            with metrics.stage("bench", "stage"):
+                pass
+
+    def request_loop():
+        # то же, что MetricsMiddleware делает на каждый запрос
+        for _ in range(n_calls):
+            started_at = time.perf_counter()
+            histogram.observe(time.perf_counter() - started_at, "bench", "/endpoint")
+            counter.inc("bench", "/endpoint", "200")
+
+    baseline = timeit(empty_loop, [()])[0]
+    for name, func in (("stage", stage_loop), ("request", request_loop)):
+        elapsed = timeit(func, [()])[0] - baseline
+        logger.info(f"{name}: {elapsed / n_calls * 1e3:.0f}ns per call")
+
+    start = time.perf_counter()
+    text = metrics.REGISTRY.render()
+    logger.info(f"render: {(time.perf_counter() - start) * 1e3:.2f}ms, {len(text)} bytes")
+
+
+# Рекомендации для многих пользователей одним запросом
+def bench_batch(n_users=1_000_000, k=100, format="ndjson", url=None):
+    """
+    Запрашивает рекомендации для n_users случайных пользователей одним запросом
+    и измеряет пропускную способность в пользователях в секунду
+    """
+    url = url or recommendations_url
+    rng = np.random.default_rng(0)
+    body = "\n".join(map(str, rng.integers(0, n_users, n_users).tolist())).encode()
+
+    start = time.perf_counter()
+    first_chunk_at = None
+    n_bytes = 0
+    with httpx.Client(timeout=None) as client:
+        with client.stream("POST", url + "/recommendations_batch", params={"k": k, "format": format},
+                           content=body) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_bytes():
+                first_chunk_at = first_chunk_at or time.perf_counter()
+                n_bytes += len(chunk)
+    elapsed = time.perf_counter() - start
+
+    logger.info(
+        f"{format}: {n_users / elapsed:,.0f} users/sec, first chunk after {first_chunk_at - start:.2f}s, "
+        f"{n_bytes / 2**20:.1f}MB received in {elapsed:.2f}s"
+    )
+
+
+# Нагрузочный тест запущенного сервиса
+async def run_load(url, endpoint, concurrency, duration, n_users, k):
+    """
+    Отправляет запросы к endpoint из concurrency одновременных клиентов в течение duration секунд
+    и возвращает задержки успешных запросов в миллисекундах и количество ошибок
+    """
+    rng = np.random.default_rng(concurrency)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(client):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            params = {"user_id": int(rng.integers(0, n_users)), "k": k}
+            start = time.perf_counter()
+            try:
+                resp = await client.post(url + endpoint, params=params)
+                resp.raise_for_status()
+                latencies.append((time.perf_counter() - start) * 1e3)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+
+    return np.array(latencies), errors
+
+
+async def run_reload(url, endpoint, concurrency, duration, n_users, k):
+    """
+    Нагружает сервис и в середине нагрузки вызывает /admin/reload; возвращает задержки запросов,
+    выполненных во время перезагрузки и вне ее, а также кол-во ошибок
+    """
+    rng = np.random.default_rng(0)
+    during, outside = [], []
+    errors = 0
+    reload_window = [float("inf"), float("inf")]
+    deadline = time.perf_counter() + duration
+
+    async def worker(client):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            params = {"user_id": int(rng.integers(0, n_users)), "k": k}
+            start = time.perf_counter()
+            try:
+                resp = await client.post(url + endpoint, params=params)
+                resp.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            end = time.perf_counter()
+            overlaps = start <= reload_window[1] and end >= reload_window[0]
+            (during if overlaps else outside).append((end - start) * 1e3)
+
+    async def reloader(client):
+        await asyncio.sleep(duration / 3)
+        reload_window[0] = time.perf_counter()
+        resp = await client.post(url + "/admin/reload", timeout=600.0)
+        reload_window[1] = time.perf_counter()
+        logger.info(f"Reloaded to version {resp.json()['version']} in {reload_window[1] - reload_window[0]:.2f}s")
+
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+        await asyncio.gather(reloader(client), *[worker(client) for _ in range(concurrency)])
+
+    return np.array(during), np.array(outside), errors
+
+
+def bench_reload(endpoint="/recommendations_offline", concurrency=8, duration=30.0,
+                 n_users=1_000_000, k=100, url=None):
+    """
+    Сравнивает задержки запросов во время перезагрузки рекомендаций и вне ее
+    """
+    url = url or recommendations_url
+    during, outside, errors = asyncio.run(run_reload(url, endpoint, concurrency, duration, n_users, k))
+    for name, latencies in (("during reload", during), ("outside reload", outside)):
+        if len(latencies) > 0:
+            log_latencies(name, latencies * 1e3)
+    logger.info(f"errors={errors}")
+
+
+# Шардированное хранилище онлайн-событий
+async def run_shard_client(urls, virtual_nodes, concurrency, duration, n_users, put_share, seed):
+    """
+    Отправляет запросы /put (доля put_share) и /get шардам, которым принадлежат пользователи,
+    из concurrency одновременных клиентов и возвращает кол-во успешных запросов и ошибок
+    """
+    from sharding import HashRing
+
+    ring = HashRing(urls, virtual_nodes)
+    rng = np.random.default_rng(seed)
+    counts = {"put": 0, "get": 0, "errors": 0}
+    deadline = time.perf_counter() + duration
+
+    async def worker(client):
+        while time.perf_counter() < deadline:
+            user_id = int(rng.integers(0, n_users))
+            url = ring.node(user_id)
+            try:
+                if rng.random() < put_share:
+                    resp = await client.post(url + "/put", params={"user_id": user_id, "item_id": int(rng.integers(0, 1_000_000))})
+                    name = "put"
+                else:
+                    resp = await client.post(url + "/get", params={"user_id": user_id, "k": 10})
+                    name = "get"
+                resp.raise_for_status()
+                counts[name] += 1
+            except httpx.HTTPError:
+                counts["errors"] += 1
+
+    limits = httpx.Limits(max_connections=concurrency * len(urls))
+    async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+
+    return counts
+
+
+def shard_client(args):
+    return asyncio.run(run_shard_client(*args))
+
+
+def check_shard_routing(urls, virtual_nodes, n_checks=100):
+    """
+    Проверяет, что событие пользователя сохраняется только на его шарде и возвращается оттуда
+    """
+    from sharding import HashRing
+
+    ring = HashRing(urls, virtual_nodes)
+    user_ids = np.random.default_rng(1).integers(10_000_000, 20_000_000, n_checks).tolist()
+    with httpx.Client(timeout=10.0) as client:
+        for user_id in user_ids:
+            client.post(ring.node(user_id) + "/put", params={"user_id": user_id, "item_id": user_id % 1_000_000})
+        for user_id in user_ids:
+            for url in urls:
+                events = client.post(url + "/get", params={"user_id": user_id, "k": 1}).json()["events"]
+                expected = [user_id % 1_000_000] if url == ring.node(user_id) else []
+                assert events == expected, f"Wrong events of user_id={user_id} at {url}: {events}"
+
+
+def bench_shards(n_shards_list=(1, 2, 4), n_clients=4, concurrency=16, duration=10.0, n_users=1_000_000,
+                 put_share=0.5, virtual_nodes=100, base_port=8120, directory="bench_shards"):
+    """
+    Запускает n_shards экземпляров events_service и n_clients процессов-клиентов
+    и измеряет суммарное кол-во запросов /put и /get в секунду для каждого кол-ва шардов
+    """
+    import os
+    import shutil
+    import subprocess
+    from concurrent.futures import ProcessPoolExecutor
+    from load_test import wait_ready, stop_services
+    from sharding import HashRing
+
+    # httpx пишет в лог каждый запрос, что в нагрузочном тесте заметно снижает скорость клиентов
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # Доля пользователей на каждом шарде и доля перемещаемых при добавлении шарда
+    user_ids = np.arange(n_users)
+    for n_shards in n_shards_list:
+        urls = [f"http://127.0.0.1:{base_port + i}" for i in range(n_shards)]
+        owners = HashRing(urls, virtual_nodes).assign(user_ids)
+        moved = (HashRing(urls + [f"http://127.0.0.1:{base_port + n_shards}"], virtual_nodes).assign(user_ids) != owners).mean()
+        shares = np.bincount(owners, minlength=n_shards) / n_users
+        logger.info(f"shards={n_shards:<3} users per shard min={shares.min():.3f} max={shares.max():.3f}, "
+                    f"moved when adding a shard={moved:.3f} (ideal {1 / (n_shards + 1):.3f})")
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    for n_shards in n_shards_list:
+        urls = [f"http://127.0.0.1:{base_port + i}" for i in range(n_shards)]
+
+        # config.ini шардов: без заполнения из файла и без сохранения на диск
+        shard_config = configparser.ConfigParser()
+        shard_config.read_dict(config)
+        shard_config["urls"]["events_store_shards"] = ", ".join(urls)
+        shard_config["events"]["warmup_path"] = ""
+        shard_config["events"]["persistence_dir"] = ""
+        with open(os.path.join(directory, "config.ini"), "w") as f:
+            shard_config.write(f)
+
+        processes = [
+            subprocess.Popen([sys.executable, "-m", "uvicorn", "events_service:app", "--app-dir", repo_dir,
+                              "--port", url.rsplit(":", 1)[1], "--log-level", "warning"], cwd=directory)
+            for url in urls
+        ]
+        try:
+            for url, process in zip(urls, processes):
+                wait_ready(url, process)
+            check_shard_routing(urls, virtual_nodes)
+
+            args = [(urls, virtual_nodes, concurrency, duration, n_users, put_share, seed) for seed in range(n_clients)]
+            with ProcessPoolExecutor(n_clients) as executor:
+                results = list(executor.map(shard_client, args))
+        finally:
+            stop_services(processes)
+
+        puts, gets = sum(r["put"] for r in results), sum(r["get"] for r in results)
+        errors = sum(r["errors"] for r in results)
+        logger.info(f"shards={n_shards:<3} put rps={puts / duration:,.0f} get rps={gets / duration:,.0f} "
+                    f"total rps={(puts + gets) / duration:,.0f} errors={errors}")
+
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_load(endpoint="/recommendations_online", concurrency_levels=(1, 4, 16, 64),
+               duration=10.0, n_users=1_000_000, k=100, url=None):
+    """
+    Измеряет, как пропускная способность сервиса растет с количеством одновременных клиентов
+    """
+    url = url or recommendations_url
+    for concurrency in concurrency_levels:
+        latencies, errors = asyncio.run(run_load(url, endpoint, concurrency, duration, n_users, k))
+        if len(latencies) == 0:
+            logger.info(f"{endpoint} concurrency={concurrency:<4} no successful requests, errors={errors}")
+            continue
+        logger.info(
+            f"{endpoint} concurrency={concurrency:<4} rps={len(latencies) / duration:.1f} "
+            f"p50={np.percentile(latencies, 50):.1f}ms p99={np.percentile(latencies, 99):.1f}ms errors={errors}"
+        )
+
+
+if __name__ == "__main__":
+
+    # Создаем парсер для чтения аргументов, передаваемых из командной строки при запуске файла
+    parser = argparse.ArgumentParser()
+
+    if len(sys.argv) == 1:
+        logger.info(f"Error, wrong parameters")
+
+    elif sys.argv[1] == '--recs_lookup':
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--n_recs', type=int, default=100)
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--n_queries', type=int, default=100)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_recs_lookup(namespace.n_users, namespace.n_recs, namespace.k, namespace.n_queries)
+
+    elif sys.argv[1] == '--blend':
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--n_lists', type=int, default=1000)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_blend(namespace.k, namespace.n_lists)
+
+    elif sys.argv[1] == '--evaluation':
+        parser.add_argument('--n_users', type=int, default=200_000)
+        parser.add_argument('--n_items', type=int, default=100_000)
+        parser.add_argument('--n_events', type=int, default=20)
+        parser.add_argument('--n_recs', type=int, default=50)
+        parser.add_argument('--k', type=int, default=5)
+        parser.add_argument('--workers', type=int, default=1)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_evaluation(namespace.n_users, namespace.n_items, namespace.n_events, namespace.n_recs,
+                         namespace.k, namespace.workers)
+
+    elif sys.argv[1] == '--event_store':
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--n_puts', type=int, default=5_000_000)
+        parser.add_argument('--max_events_per_user', type=int, default=10)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_event_store(namespace.n_users, namespace.n_puts, namespace.max_events_per_user)
+
+    elif sys.argv[1] == '--seen':
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--n_events', type=int, default=50)
+        parser.add_argument('--n_items', type=int, default=1_000_000)
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--n_queries', type=int, default=10_000)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_seen(namespace.n_users, namespace.n_events, namespace.n_items, namespace.k, namespace.n_queries)
+
+    elif sys.argv[1] == '--event_persistence':
+        parser.add_argument('--n_users', type=int, default=10_000_000)
+        parser.add_argument('--n_log_events', type=int, default=1_000_000)
+        parser.add_argument('--directory', default="bench_events_persistence")
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_event_persistence(namespace.n_users, namespace.n_log_events, namespace.directory)
+
+    elif sys.argv[1] == '--stores':
+        parser.add_argument('--n_users', type=int, default=1000)
+        parser.add_argument('--n_items', type=int, default=1_000_000)
+        parser.add_argument('--k', type=int, default=100)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_stores(namespace.n_users, namespace.n_items, namespace.k)
+
+    elif sys.argv[1] == '--reload':
+        parser.add_argument('--endpoint', default="/recommendations_offline")
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=30.0)
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--url', default=None)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_reload(namespace.endpoint, namespace.concurrency, namespace.duration,
+                     namespace.n_users, namespace.k, namespace.url)
+
+    elif sys.argv[1] == '--als':
+        parser.add_argument('--n_items', type=int, default=1_000_000)
+        parser.add_argument('--factors', type=int, default=50)
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--n_events', type=int, default=10)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_als(namespace.n_items, namespace.factors, namespace.k, namespace.n_events)
+
+    elif sys.argv[1] == '--serialization':
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--n_calls', type=int, default=10_000)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_serialization(namespace.k, namespace.n_calls)
+
+    elif sys.argv[1] == '--default':
+        parser.add_argument('--k', type=int, nargs='+', default=[10, 100])
+        parser.add_argument('--n_calls', type=int, default=10_000)
+        parser.add_argument('--n_default', type=int, default=1000)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_default(namespace.k, namespace.n_calls, namespace.n_default)
+
+    elif sys.argv[1] == '--metrics':
+        parser.add_argument('--n_calls', type=int, default=1_000_000)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_metrics(namespace.n_calls)
+
+    elif sys.argv[1] == '--batch':
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--format', default="ndjson")
+        parser.add_argument('--url', default=None)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_batch(namespace.n_users, namespace.k, namespace.format, namespace.url)
+
+    elif sys.argv[1] == '--shards':
+        parser.add_argument('--n_shards', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--n_clients', type=int, default=4)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=10.0)
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--put_share', type=float, default=0.5)
+        parser.add_argument('--virtual_nodes', type=int, default=100)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_shards(namespace.n_shards, namespace.n_clients, namespace.concurrency, namespace.duration,
+                     namespace.n_users, namespace.put_share, namespace.virtual_nodes)
+
+    elif sys.argv[1] == '--load':
+        parser.add_argument('--endpoint', default="/recommendations_online")
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+        parser.add_argument('--duration', type=float, default=10.0)
+        parser.add_argument('--n_users', type=int, default=1_000_000)
+        parser.add_argument('--k', type=int, default=100)
+        parser.add_argument('--url', default=None)
+        namespace = parser.parse_args(sys.argv[2:])
+        bench_load(namespace.endpoint, namespace.concurrency, namespace.duration,
+                   namespace.n_users, namespace.k, namespace.url)
+
+    else:
+        logger.info(f"Error, wrong parameters")
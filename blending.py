@@ -0,0 +1,132 @@
+"""
+Вспомогательный модуль для смешивания и дедубликации списков рекомендаций на NumPy-массивах.
+
+Основные функции:
+- dedup() - удаление дубликатов с сохранением первого вхождения;
+- filter_seen() - исключение уже просмотренных объектов;
+- merge_by_score() - объединение кандидатов по убыванию score (используется для онлайн-рекомендаций);
+- interleave(), weighted_fusion(), rrf() - стратегии смешивания нескольких списков рекомендаций;
+- blend() - смешивание по стратегии с дедубликацией, фильтрацией и обрезкой до k.
+"""
+
+import numpy as np
+
+
+def as_ids(ids):
+    """
+    Приводит список идентификаторов к целочисленному массиву (в том числе пустой список)
+    """
+    ids = np.asarray(ids)
+
+    return ids if ids.dtype.kind in "iu" else ids.astype(np.int64)
+
+
+def dedup(ids):
+    """
+    Удаляет дубликаты, оставляя только первое вхождение каждого идентификатора
+    """
+    ids = as_ids(ids)
+    _, first = np.unique(ids, return_index=True)
+
+    return ids[np.sort(first)]
+
+
+def filter_seen(ids, seen):
+    """
+    Исключает из списка идентификаторы, которые есть в seen
+    """
+    ids = as_ids(ids)
+    if seen is None or len(seen) == 0:
+        return ids
+
+    return ids[~np.isin(ids, seen)]
+
+
+def merge_by_score(ids, scores):
+    """
+    Сортирует кандидатов по убыванию score (при равных score сохраняется исходный порядок)
+    и удаляет дубликаты, оставляя вхождение с максимальным score
+    """
+    ids, scores = np.asarray(ids), np.asarray(scores)
+    order = np.argsort(-scores, kind="stable")
+    ids, scores = ids[order], scores[order]
+    _, first = np.unique(ids, return_index=True)
+    first.sort()
+
+    return ids[first], scores[first]
+
+
+def interleave(lists):
+    """
+    Чередует элементы двух списков: первый - на четных позициях (начиная с нулевой),
+    второй - на нечетных, пока позволяет длина более короткого; остаток более длинного
+    списка добавляется в конец (при равной длине - остаток первого)
+    """
+    first, second = (as_ids(ids) for ids in lists)
+    n = min(len(first), len(second))
+
+    blended = np.empty(2 * n, dtype=np.result_type(first, second))
+    blended[0::2] = first[:n]
+    blended[1::2] = second[:n]
+    rest = first[n:] if len(first) >= len(second) else second[n:]
+
+    return np.concatenate([blended, rest])
+
+
+def _fuse(lists, list_scores, weights):
+    """
+    Суммирует взвешенные оценки объектов по всем спискам и сортирует объекты по убыванию суммы
+    (при равенстве - по первому появлению в конкатенации списков)
+    """
+    weights = np.ones(len(lists)) if weights is None else np.asarray(weights, dtype=np.float64)
+    ids = np.concatenate([as_ids(l) for l in lists])
+    scores = np.concatenate([w * np.asarray(s, dtype=np.float64) for w, s in zip(weights, list_scores)])
+    if len(ids) == 0:
+        return ids
+
+    unique_ids, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    totals = np.bincount(inverse, weights=scores)
+    order = np.lexsort((first, -totals))
+
+    return unique_ids[order]
+
+
+def weighted_fusion(lists, scores=None, weights=None):
+    """
+    Взвешенное слияние оценок: для каждого объекта суммируются оценки из всех списков,
+    умноженные на веса списков; если оценки не заданы, используется линейная оценка
+    по позиции 1 - rank / len(list)
+    """
+    if scores is None:
+        scores = [1 - np.arange(len(l)) / max(len(l), 1) for l in lists]
+
+    return _fuse(lists, scores, weights)
+
+
+def rrf(lists, weights=None, c=60):
+    """
+    Reciprocal rank fusion: оценка объекта - сумма weight / (c + rank) по всем спискам,
+    где rank - позиция объекта в списке, начиная с 1
+    """
+    scores = [1 / (c + np.arange(1, len(l) + 1)) for l in lists]
+
+    return _fuse(lists, scores, weights)
+
+
+# Доступные стратегии смешивания
+STRATEGIES = {
+    "interleave": lambda lists, **params: interleave(lists),
+    "weighted": weighted_fusion,
+    "rrf": rrf,
+}
+
+
+def blend(lists, strategy="interleave", seen=None, k=None, **params):
+    """
+    Смешивает списки рекомендаций по стратегии strategy, удаляет дубликаты и уже просмотренные
+    объекты и оставляет первые k
+    """
+    blended = STRATEGIES[strategy](lists, **params)
+    blended = filter_seen(dedup(blended), seen)
+
+    return blended if k is None else blended[:k]
@@ -0,0 +1,128 @@
+"""
+Вспомогательный скрипт для конвертации parquet-файлов с рекомендациями в индексированный
+двоичный формат, который сервисы отображают в память (np.memmap) вместо чтения parquet.
+
+Для каждого файла создается директория с тем же именем и расширением .idx
+(смещения + int32 идентификаторы + float32 оценки в виде .npy-файлов):
+- recommendations.parquet -> recommendations.idx - персональные рекомендации;
+- top_popular.parquet -> top_popular.idx - рекомендации по умолчанию;
+- similar.parquet -> similar.idx - похожие объекты;
+- models/als_model.pkl (+ items.parquet) -> als.idx - факторы объектов ALS-модели для онлайн-рекомендаций
+(см. als_foldin.py); строки факторов соответствуют item_id в порядке возрастания, как в LabelEncoder из ноутбука;
+- events.parquet -> seen.idx - прослушанные треки пользователей для исключения из рекомендаций
+(см. seen_items.py): для каждого пользователя - отсортированные уникальные item_id (int32).
+
+Сервисы используют директории .idx при use_mmap = true в секции [artifacts] файла config.ini,
+а при их отсутствии - parquet-файлы.
+
+Пример запуска (в папке с parquet-файлами):
+python build_artifacts.py
+"""
+
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+from csr_index import index_path
+from artifacts import build_recommendations as build_recs, save_recommendations, build_similar_items
+from als_foldin import ALSFoldIn
+from seen_items import SeenItems, unique_sorted
+from events_loader import iter_event_batches
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def build_recommendations(path, type):
+    """
+    Конвертирует файл с персональными рекомендациями или рекомендациями по умолчанию
+    """
+    columns = ["user_id", "item_id", "rank"] if type == "personal" else ["item_id", "rank"]
+    recs = build_recs(type, pd.read_parquet(path, columns=columns))
+    save_recommendations(type, recs, index_path(path))
+
+
+def build_similar(path):
+    """
+    Конвертирует файл с похожими объектами
+    """
+    similar_items = build_similar_items(pd.read_parquet(path, columns=["item_id_1", "item_id_2", "score"]))
+    similar_items.save(index_path(path))
+
+
+def build_als(model_path, items_path="items.parquet", directory="als.idx"):
+    """
+    Сохраняет факторы объектов ALS-модели implicit
+    """
+    import joblib
+
+    with open(model_path, "rb") as fd:
+        als_model = joblib.load(fd)
+    if hasattr(als_model, "to_cpu"):
+        als_model = als_model.to_cpu()
+    # item_encoder в ноутбуке - LabelEncoder по items["item_id"], т.е. отсортированные уникальные item_id
+    item_ids = np.unique(pd.read_parquet(items_path, columns=["item_id"])["item_id"].to_numpy())
+    # иначе item_id и строки факторов будут сопоставлены неверно (например, items.parquet другой версии)
+    if len(item_ids) != als_model.item_factors.shape[0]:
+        raise ValueError(
+            f"{items_path} has {len(item_ids)} unique item_id, "
+            f"but the ALS model has {als_model.item_factors.shape[0]} item factors"
+        )
+    ALSFoldIn.save(directory, item_ids, als_model.item_factors, als_model.regularization, als_model.alpha)
+
+
+def build_seen(events_path, directory="seen.idx"):
+    """
+    Сохраняет прослушанные пользователями треки; файл событий читается частями,
+    повторы пар (user_id, item_id) удаляются сначала в каждой части, затем во всех
+    """
+    keys = [unique_sorted(user_ids.astype(np.int64) << 32 | item_ids.astype(np.int64))
+            for user_ids, item_ids, _ in iter_event_batches(events_path)]
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    SeenItems.build(keys >> 32, keys & 0xFFFFFFFF).save(directory)
+
+
+def build_artifacts(recommendations_path="recommendations.parquet",
+                    top_popular_path="top_popular.parquet",
+                    similar_path="similar.parquet",
+                    als_model_path="models/als_model.pkl",
+                    items_path="items.parquet",
+                    events_path="events.parquet"):
+    """
+    Конвертирует все имеющиеся файлы с рекомендациями
+    """
+    builders = (
+        (recommendations_path, lambda path: build_recommendations(path, "personal")),
+        (top_popular_path, lambda path: build_recommendations(path, "default")),
+        (similar_path, build_similar),
+        (als_model_path, lambda path: build_als(path, items_path)),
+        (events_path, build_seen),
+    )
+    for path, build in builders:
+        if not os.path.exists(path):
+            logger.info(f"{path} not found, skipping")
+            continue
+        start = time.perf_counter()
+        build(path)
+        logger.info(f"Converted {path} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(module)s, %(funcName)s, %(message)s')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recommendations', default="recommendations.parquet")
+    parser.add_argument('--top_popular', default="top_popular.parquet")
+    parser.add_argument('--similar', default="similar.parquet")
+    parser.add_argument('--als_model', default="models/als_model.pkl")
+    parser.add_argument('--items', default="items.parquet")
+    parser.add_argument('--events', default="events.parquet")
+    namespace = parser.parse_args()
+
+    build_artifacts(namespace.recommendations, namespace.top_popular, namespace.similar,
+                    namespace.als_model, namespace.items, namespace.events)
@@ -0,0 +1,173 @@
+"""
+Вспомогательный модуль с компактным индексом для быстрого поиска рекомендаций по ключу.
+
+Таблица вида (key, value_1, value_2, ...) сортируется по ключу, значения хранятся
+в плоских NumPy-массивах, а для каждого уникального ключа запоминается смещение
+начала его строк (CSR-подобная раскладка). Поиск ключа выполняется через
+np.searchsorted за O(log n), а результат - это срез массивов без копирования.
+
+Индекс можно сохранить на диск в виде директории с .npy-файлами (CSRIndex.save)
+и открыть через отображение в память (CSRIndex.open): процессы-воркеры в этом случае
+не декодируют parquet при запуске и разделяют одни и те же страницы через кэш ОС.
+"""
+
+import os
+import shutil
+import numpy as np
+
+
+def index_path(path):
+    """
+    Возвращает путь к директории с индексом для parquet-файла (recommendations.parquet -> recommendations.idx)
+    """
+    return os.path.splitext(path)[0] + ".idx"
+
+
+def save_arrays(directory, arrays):
+    """
+    Сохраняет словарь массивов в директорию в виде .npy-файлов;
+    файлы сначала пишутся во временную директорию, затем прежняя директория переименовывается
+    в <directory>.old, а временная - на ее место, поэтому директория отсутствует только
+    между двумя переименованиями (в это время load_arrays читает <directory>.old)
+    """
+    directory = directory.rstrip("/")
+    tmp_directory = directory + ".tmp"
+    old_directory = directory + ".old"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+    if os.path.isdir(directory):
+        shutil.rmtree(old_directory, ignore_errors=True)
+        os.rename(directory, old_directory)
+    os.rename(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def load_arrays(directory, mmap_mode="r"):
+    """
+    Загружает словарь массивов из директории с .npy-файлами (по умолчанию - отображая их в память)
+    """
+    directory = directory.rstrip("/")
+    # Директория заменяется через save_arrays прямо сейчас (или замена была прервана)
+    if not os.path.isdir(directory) and os.path.isdir(directory + ".old"):
+        directory = directory + ".old"
+
+    arrays = {}
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith(".npy"):
+            arrays[file_name[:-4]] = np.load(os.path.join(directory, file_name), mmap_mode=mmap_mode)
+
+    return arrays
+
+
+class CSRIndex:
+    """
+    Индекс "ключ -> срез строк" поверх плоских NumPy-массивов
+    """
+
+    def __init__(self, keys, offsets, columns):
+
+        # Отсортированные уникальные ключи
+        self.keys = keys
+        # Смещения начала строк каждого ключа, длина len(keys) + 1
+        self.offsets = offsets
+        # Плоские массивы значений, упорядоченные по ключу
+        self.columns = columns
+
+    @classmethod
+    def from_frame(cls, df, key, columns, sort_by=None, ascending=True, dtypes=None):
+        """
+        Строит индекс по датафрейму: строки сортируются по ключу,
+        а внутри ключа - по колонке sort_by (если задана)
+        """
+        dtypes = dtypes or {}
+
+        keys = df[key].to_numpy()
+        if sort_by is None:
+            order = np.argsort(keys, kind="stable")
+        else:
+            secondary = df[sort_by].to_numpy()
+            if not ascending:
+                secondary = -secondary
+            # np.lexsort сортирует по последнему ключу в первую очередь
+            order = np.lexsort((secondary, keys))
+        keys = keys[order]
+
+        unique_keys, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+
+        data = {}
+        for col in columns:
+            values = df[col].to_numpy()[order]
+            data[col] = np.ascontiguousarray(values, dtype=dtypes.get(col, values.dtype))
+
+        return cls(unique_keys, offsets, data)
+
+    def save(self, directory):
+        """
+        Сохраняет индекс в директорию
+        """
+        arrays = {"keys": self.keys, "offsets": self.offsets}
+        arrays.update({f"column.{name}": values for name, values in self.columns.items()})
+        save_arrays(directory, arrays)
+
+    @classmethod
+    def open(cls, directory, mmap_mode="r"):
+        """
+        Открывает сохраненный индекс (по умолчанию - только для чтения через отображение в память)
+        """
+        arrays = load_arrays(directory, mmap_mode)
+        columns = {name[len("column."):]: values for name, values in arrays.items() if name.startswith("column.")}
+
+        return cls(arrays["keys"], arrays["offsets"], columns)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.locate(key) is not None
+
+    @property
+    def nrows(self):
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self):
+        """
+        Размер всех массивов индекса в байтах
+        """
+        return self.keys.nbytes + self.offsets.nbytes + sum(values.nbytes for values in self.columns.values())
+
+    def locate(self, key):
+        """
+        Возвращает границы (start, end) строк ключа или None, если ключа нет
+        """
+        pos = np.searchsorted(self.keys, key)
+        if pos >= len(self.keys) or self.keys[pos] != key:
+            return None
+
+        return int(self.offsets[pos]), int(self.offsets[pos + 1])
+
+    def slice(self, key, k=None):
+        """
+        Возвращает срез строк ключа key, обрезанный до k строк
+        (пустой срез, если ключа нет)
+        """
+        bounds = self.locate(key)
+        if bounds is None:
+            return slice(0, 0)
+
+        start, end = bounds
+        if k is not None:
+            end = min(end, start + max(k, 0))
+
+        return slice(start, end)
+
+    def get(self, key, column, k=None):
+        """
+        Возвращает срез колонки column для ключа key (не более k значений)
+        или пустой массив, если ключа нет
+        """
+        return self.columns[column][self.slice(key, k)]
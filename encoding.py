@@ -0,0 +1,208 @@
+"""
+Вспомогательный модуль для кодирования ответов сервисов в JSON или в компактный двоичный формат.
+
+Формат ответа выбирается по заголовку Accept запроса:
+- application/x-packed-arrays (BINARY_MEDIA_TYPE) - двоичный формат, в котором списки идентификаторов
+и оценок передаются упакованными массивами int32/int64/float32/float64 и декодируются через np.frombuffer
+без разбора каждого числа (используется при обращениях основного сервиса к вспомогательным);
+- в остальных случаях - JSON, который формируется сразу через json.dumps (без jsonable_encoder FastAPI),
+причем NumPy-массивы в ответе переводятся в списки.
+
+Двоичный формат (все числа - little-endian):
+- заголовок: b"PKA1", кол-во полей (uint16);
+- для каждого поля: длина имени (uint8), имя (utf-8), тип поля (1 байт),
+  кол-во элементов массива или длина JSON-значения в байтах (uint32), данные;
+- тип поля: b"a" - массив, за которым следует код типа NumPy из 2 символов (i4, i8, f4, f8),
+  b"j" - любое другое значение в JSON (строки, числа, None).
+
+Основные функции:
+- pack(), unpack() - кодирование и декодирование двоичного формата;
+- dumps() - кодирование в JSON;
+- encode_response() - выбор формата по заголовку Accept и формирование ответа;
+- PrecomputedResponse - заранее закодированный в оба формата ответ со списком, из которого
+ответ для любой длины списка k собирается срезом байтов без повторного кодирования.
+"""
+
+import json
+import struct
+from itertools import accumulate
+import numpy as np
+from fastapi.responses import Response
+
+
+BINARY_MEDIA_TYPE = "application/x-packed-arrays"
+JSON_MEDIA_TYPE = "application/json"
+
+MAGIC = b"PKA1"
+
+
+def _as_array(values):
+    """
+    Приводит список чисел к массиву поддерживаемого типа (целые - к int32, если помещаются)
+    """
+    if len(values) == 0:
+        return np.empty(0, dtype="<i4")
+    values = np.asarray(values)
+    if values.dtype.kind in "iu":
+        if values.dtype.itemsize > 4 and (values.min() < -2**31 or values.max() >= 2**31):
+            return values.astype("<i8", copy=False)
+        return values.astype("<i4", copy=False)
+    if values.dtype.kind == "f":
+        return values.astype("<f4" if values.dtype.itemsize <= 4 else "<f8", copy=False)
+
+    return None
+
+
+def pack(content):
+    """
+    Кодирует словарь в двоичный формат: списки и массивы чисел - упакованными массивами,
+    остальные значения - в JSON
+    """
+    parts = [MAGIC, struct.pack("<H", len(content))]
+    for name, value in content.items():
+        name = name.encode()
+        parts.append(struct.pack("<B", len(name)) + name)
+        array = _as_array(value) if isinstance(value, (list, np.ndarray)) else None
+        if array is not None and array.ndim == 1:
+            parts.append(b"a" + array.dtype.str[1:].encode() + struct.pack("<I", len(array)))
+            parts.append(array.tobytes())
+        else:
+            data = json.dumps(value, separators=(",", ":")).encode()
+            parts.append(b"j" + struct.pack("<I", len(data)))
+            parts.append(data)
+
+    return b"".join(parts)
+
+
+def unpack(data):
+    """
+    Декодирует двоичный формат в словарь; массивы возвращаются как NumPy-массивы
+    только для чтения поверх data (без копирования)
+    """
+    if data[:4] != MAGIC:
+        raise ValueError("Not a packed arrays message")
+    (n_fields,) = struct.unpack_from("<H", data, 4)
+    pos = 6
+    content = {}
+    for _ in range(n_fields):
+        name_len = data[pos]
+        name = bytes(data[pos + 1:pos + 1 + name_len]).decode()
+        pos += 1 + name_len
+        kind = data[pos:pos + 1]
+        if kind == b"a":
+            dtype = np.dtype("<" + bytes(data[pos + 1:pos + 3]).decode())
+            (n,) = struct.unpack_from("<I", data, pos + 3)
+            pos += 7
+            content[name] = np.frombuffer(data, dtype=dtype, count=n, offset=pos)
+            pos += n * dtype.itemsize
+        elif kind == b"j":
+            (n,) = struct.unpack_from("<I", data, pos + 1)
+            pos += 5
+            content[name] = json.loads(bytes(data[pos:pos + n]))
+            pos += n
+        else:
+            raise ValueError(f"Unknown field type {kind!r}")
+
+    return content
+
+
+def _default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    """
+    Кодирует ответ в JSON (как JSONResponse, но с поддержкой NumPy-массивов)
+    """
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode()
+
+
+def accepts_binary(accept):
+    """
+    Проверяет, запрошен ли двоичный формат в заголовке Accept
+    """
+    return accept is not None and BINARY_MEDIA_TYPE in accept
+
+
+def encode_response(content, accept=None):
+    """
+    Формирует ответ в формате, запрошенном в заголовке Accept
+    """
+    if accepts_binary(accept):
+        return Response(pack(content), media_type=BINARY_MEDIA_TYPE)
+
+    return Response(dumps(content), media_type=JSON_MEDIA_TYPE)
+
+
+def decode_response(resp):
+    """
+    Декодирует ответ httpx в зависимости от его Content-Type
+    """
+    if resp.headers.get("content-type", "").startswith(BINARY_MEDIA_TYPE):
+        return unpack(resp.content)
+
+    return resp.json()
+
+
+class PrecomputedResponse:
+    """
+    Заранее закодированные ответы вида {name: values[:k], **extra} в JSON и в двоичном формате.
+
+    Список кодируется один раз: в JSON - в строку "v1,v2,..." с позициями конца каждого элемента,
+    в двоичном формате - в массив, поэтому ответ для любого k - это заголовок, срез байтов списка
+    и окончание ответа. Ответы для часто запрашиваемых k (ks) хранятся целиком.
+    JSON совпадает с dumps() для того же содержимого, а двоичный ответ - с pack()
+    (кроме типа массива: он выбирается по всему списку, а не по срезу).
+    """
+
+    def __init__(self, values, name="recs", extra=None, ks=()):
+        extra = extra or {}
+        array = _as_array(values)
+        self.size = len(array)
+
+        # JSON: {"name":[ + первые k элементов + ],"key":value...}
+        items = [str(value).encode() for value in array.tolist()]
+        self._json_head = dumps({name: []})[:-2]
+        self._json_items = b",".join(items)
+        self._json_ends = [0] + [end - 1 for end in accumulate(len(item) + 1 for item in items)]
+        self._json_tail = b"]," + dumps(extra)[1:] if extra else b"]}"
+
+        # Двоичный формат: заголовок и поле name до кол-ва элементов, массив, остальные поля
+        name = name.encode()
+        self._itemsize = array.dtype.itemsize
+        self._binary_head = (MAGIC + struct.pack("<H", len(extra) + 1) + struct.pack("<B", len(name)) + name
+                             + b"a" + array.dtype.str[1:].encode())
+        self._binary_items = array.tobytes()
+        self._binary_tail = pack(extra)[6:]
+
+        self._cache = {(k, binary): self._build(k, binary) for k in ks for binary in (False, True)}
+
+    def _build(self, k, binary):
+        # Длина среза values[:k] (с той же обработкой отрицательных k, что и у списков)
+        n = len(range(self.size)[:k])
+        if binary:
+            return (self._binary_head + struct.pack("<I", n) + self._binary_items[:n * self._itemsize]
+                    + self._binary_tail)
+
+        return self._json_head + self._json_items[:self._json_ends[n]] + self._json_tail
+
+    def body(self, k, binary=False):
+        """
+        Возвращает закодированный ответ со списком длиной k
+        """
+        body = self._cache.get((k, binary))
+
+        return body if body is not None else self._build(k, binary)
+
+    def response(self, k, accept=None):
+        """
+        Формирует ответ со списком длиной k в формате, запрошенном в заголовке Accept
+        """
+        if accepts_binary(accept):
+            return Response(self.body(k, True), media_type=BINARY_MEDIA_TYPE)
+
+        return Response(self.body(k), media_type=JSON_MEDIA_TYPE)
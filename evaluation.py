@@ -0,0 +1,241 @@
+"""
+Вспомогательный модуль для расчета метрик качества рекомендаций на тестовой выборке.
+
+Метрики считаются так же, как в ноутбуке recommendations.ipynb (process_events_recs_for_binary_metrics,
+compute_cls_metrics и расчет coverage и novelty), но без merge и groupby таблиц pandas:
+события train и test переводятся в sparse-матрицы кол-ва событий "пользователь x объект" (CSR),
+рекомендации - в массивы номеров пользователей, объектов и рангов, значения матриц для них находятся
+через np.searchsorted, а метрики пользователей - это суммы через np.bincount.
+
+Правила расчета, как в ноутбуке:
+- precision@k и recall@k считаются по "общим" пользователям - тем, у кого есть и рекомендации,
+и события в test; из событий test учитываются только объекты, которые есть в train;
+- повторные события test с одним и тем же объектом учитываются столько раз, сколько они встречаются
+(как строки после merge), поэтому TP и FN - это суммы кол-ва таких событий;
+- пользователи без релевантных объектов получают recall = 0 (fillna(0) в ноутбуке);
+- novelty@k - доля непрослушанных в train объектов среди top-k рекомендаций, среднее по всем
+пользователям с рекомендациями; coverage - доля объектов каталога, попавших в рекомендации.
+NDCG@k (в ноутбуке не считался) - с бинарной релевантностью по тем же событиям test.
+
+Повторяющиеся строки рекомендаций (как в recommendations.parquet после merge кандидатов с событиями)
+учитываются каждая отдельно, как в ноутбуке. При равенстве score порядок рекомендаций пользователя
+сохраняется таким, как во входной таблице.
+
+Основные классы и функции:
+- Evaluator - кодирует события train и test один раз, после чего метод evaluate() считает
+метрики для любой таблицы рекомендаций (user_id, item_id, score);
+- при workers > 1 пользователи делятся на n_shards частей, которые обрабатываются в пуле процессов.
+
+Пример использования:
+evaluator = Evaluator(events_train, events_test, items["item_id"])
+evaluator.evaluate(pd.read_parquet("personal_als.parquet"), k=5)
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def encode(ids, index):
+    """
+    Возвращает номера ids в отсортированном массиве index и маску найденных
+    """
+    codes = np.minimum(np.searchsorted(index, ids), max(len(index) - 1, 0))
+    found = index[codes] == ids if len(index) else np.zeros(len(ids), dtype=bool)
+
+    return codes, found
+
+
+def extend_index(index, ids):
+    """
+    Возвращает номера ids в index, добавляя ненайденные значения в конец
+    (новые номера начинаются с len(index)), и кол-во добавленных значений
+    """
+    ids = np.asarray(ids)
+    codes, found = encode(ids, index)
+    new_ids, inverse = np.unique(ids[~found], return_inverse=True)
+    codes = codes.astype(np.int64)
+    codes[~found] = len(index) + inverse
+
+    return codes, len(new_ids)
+
+
+def resize(matrix, shape):
+    """
+    Возвращает CSR-матрицу с добавленными пустыми строками и столбцами (без копирования данных)
+    """
+    indptr = np.concatenate([matrix.indptr, np.full(shape[0] - matrix.shape[0], matrix.indptr[-1])])
+
+    return scipy.sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+def count_matrix(rows, cols, shape):
+    """
+    Возвращает CSR-матрицу кол-ва пар (rows, cols)
+    """
+    matrix = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=shape)
+    matrix.sum_duplicates()
+
+    return matrix
+
+
+def rank_rows(rows, cols, scores, k=None):
+    """
+    Упорядочивает строки рекомендаций по пользователю и убыванию score и возвращает
+    пользователей, объекты и ранги (1 - наибольший score) top-k строк каждого пользователя
+    """
+    # Две устойчивые сортировки вместо np.lexsort: по score, затем по пользователю
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    order = order[np.argsort(rows[order], kind="stable")]
+    rows, cols = rows[order], cols[order]
+    starts = np.flatnonzero(np.concatenate([[True], rows[1:] != rows[:-1]]))
+    ranks = np.arange(len(rows)) - np.repeat(starts, np.diff(np.append(starts, len(rows)))) + 1
+    if k is not None:
+        mask = ranks <= k
+        rows, cols, ranks = rows[mask], cols[mask], ranks[mask]
+
+    return rows, cols, ranks
+
+
+def lookup(matrix, rows, cols):
+    """
+    Возвращает значения CSR-матрицы (с отсортированными индексами) в ячейках (rows, cols), 0 - для пустых
+    """
+    keys = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr)) * matrix.shape[1]
+    keys += matrix.indices
+    query = rows.astype(np.int64) * matrix.shape[1] + cols
+    pos = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+    found = keys[pos] == query if len(keys) else np.zeros(len(query), dtype=bool)
+
+    return np.where(found, matrix.data[pos] if len(keys) else 0, 0)
+
+
+def user_metrics(rows, cols, ranks, relevant, train, k):
+    """
+    Возвращает покомпонентные метрики пользователей (строк матриц relevant и train) по top-k строкам
+    рекомендаций: TP, FP, FN, DCG, IDCG, кол-во прослушанных в train и всех учтенных рекомендаций
+    """
+    n_users = relevant.shape[0]
+    sums = lambda values: np.bincount(rows, weights=values, minlength=n_users)
+
+    # Как после outer merge: каждая строка рекомендаций совпадает со всеми событиями test
+    # с тем же объектом (TP), строки без таких событий - FP, события без рекомендаций - FN
+    gt = lookup(relevant, rows, cols).astype(np.float64)
+    tp = sums(gt)
+    fp = sums((gt == 0).astype(np.float64))
+    first = np.zeros(len(rows), dtype=bool)
+    first[np.unique(rows.astype(np.int64) * relevant.shape[1] + cols, return_index=True)[1]] = True
+    fn = np.asarray(relevant.sum(axis=1), dtype=np.float64).ravel() - sums(gt * first)
+
+    # DCG по рангам угаданных объектов, IDCG - по min(кол-во релевантных объектов, k)
+    dcg = sums(np.where(gt > 0, 1 / np.log2(ranks + 1), 0))
+    discounts = np.concatenate([[0], np.cumsum(1 / np.log2(np.arange(2, k + 2)))])
+    idcg = discounts[np.minimum(np.diff(relevant.indptr), k)]
+
+    # Как после merge с events_train: рекомендация, прослушанная в train n раз, повторяется n раз,
+    # и ранги проставляются уже по повторенным строкам, поэтому в top-k попадают не все повторы
+    played = lookup(train, rows, cols)
+    weights = np.maximum(played, 1)
+    cumulative = np.cumsum(weights)
+    offsets = cumulative - weights - (cumulative - weights)[np.searchsorted(rows, rows, side="left")]
+    kept = np.clip(k - offsets, 0, weights).astype(np.float64)
+
+    return np.vstack([tp, fp, fn, dcg, idcg, sums(np.where(played > 0, kept, 0)), sums(kept)])
+
+
+def _shard_metrics(args):
+    return user_metrics(*args)
+
+
+class Evaluator:
+    """
+    Класс для расчета метрик рекомендаций по событиям train и test
+    """
+
+    def __init__(self, events_train, events_test, item_ids=None):
+        """
+        events_train, events_test - таблицы с колонками user_id и item_id,
+        item_ids - идентификаторы всех объектов каталога (для coverage)
+        """
+        train_users = events_train["user_id"].to_numpy()
+        train_items = events_train["item_id"].to_numpy()
+        test_users = events_test["user_id"].to_numpy()
+        test_items = events_test["item_id"].to_numpy()
+
+        self.user_ids = np.unique(np.concatenate([train_users, test_users]))
+        if item_ids is None:
+            item_ids = np.concatenate([train_items, test_items])
+        self.item_ids = np.unique(np.asarray(item_ids))
+        self.n_catalog_items = len(self.item_ids)
+        self.item_ids = np.unique(np.concatenate([self.item_ids, train_items, test_items]))
+        shape = (len(self.user_ids), len(self.item_ids))
+
+        # Кол-во прослушиваний в train
+        self.train = count_matrix(encode(train_users, self.user_ids)[0], encode(train_items, self.item_ids)[0], shape)
+
+        # Пользователи с событиями в test и события test с объектами, которые есть в train
+        test_rows, test_cols = encode(test_users, self.user_ids)[0], encode(test_items, self.item_ids)[0]
+        self.has_test = np.zeros(shape[0], dtype=bool)
+        self.has_test[test_rows] = True
+        in_train = np.bincount(self.train.indices, minlength=shape[1])[test_cols] > 0
+        self.relevant = count_matrix(test_rows[in_train], test_cols[in_train], shape)
+
+        logger.info(f"Evaluator: {shape[0]} users, {shape[1]} items, {self.train.nnz} train pairs, "
+                    f"{self.relevant.nnz} relevant test pairs")
+
+    def evaluate(self, recs, k=5, n_shards=1, workers=1):
+        """
+        Возвращает precision@k, recall@k, NDCG@k, novelty@k и coverage для таблицы
+        рекомендаций recs (user_id, item_id, score)
+        """
+        # Сначала отбираем top-k строк каждого пользователя, затем кодируем только их
+        # (номера пользователей в отсортированном index сохраняют порядок user_id)
+        user_ids, item_ids, ranks = rank_rows(recs["user_id"].to_numpy(), recs["item_id"].to_numpy(),
+                                              recs["score"].to_numpy(), k)
+        rows, n_new_users = extend_index(self.user_ids, user_ids)
+        cols, n_new_items = extend_index(self.item_ids, item_ids)
+        if n_new_users:
+            # Новые пользователи получили номера в конце index, восстанавливаем порядок по номеру
+            order = np.argsort(rows, kind="stable")
+            rows, cols, ranks = rows[order], cols[order], ranks[order]
+        shape = (len(self.user_ids) + n_new_users, len(self.item_ids) + n_new_items)
+        train, relevant = resize(self.train, shape), resize(self.relevant, shape)
+
+        # Пользователи делятся на части по строкам матриц
+        bounds = np.linspace(0, shape[0], max(n_shards, 1) + 1).astype(np.int64)
+        positions = np.searchsorted(rows, bounds)
+        shards = [(rows[lo:hi] - start, cols[lo:hi], ranks[lo:hi], relevant[start:stop], train[start:stop], k)
+                  for start, stop, lo, hi in zip(bounds[:-1], bounds[1:], positions[:-1], positions[1:])]
+        if workers > 1 and len(shards) > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                parts = list(executor.map(_shard_metrics, shards))
+        else:
+            parts = [_shard_metrics(shard) for shard in shards]
+        tp, fp, fn, dcg, idcg, played_weight, total_weight = np.hstack(parts)
+
+        has_recs = np.bincount(rows, minlength=shape[0]) > 0
+        common = has_recs & np.concatenate([self.has_test, np.zeros(n_new_users, dtype=bool)])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            precision = np.nan_to_num(tp / (tp + fp))
+            recall = np.nan_to_num(tp / (tp + fn))
+            ndcg = np.nan_to_num(dcg / idcg)
+            novelty = 1 - played_weight / total_weight
+
+        return {
+            "users": int(common.sum()),
+            "precision": float(precision[common].mean()) if common.any() else 0.0,
+            "recall": float(recall[common].mean()) if common.any() else 0.0,
+            "ndcg": float(ndcg[common].mean()) if common.any() else 0.0,
+            "novelty": float(novelty[has_recs].mean()) if has_recs.any() else 0.0,
+            "coverage": self.coverage(recs),
+        }
+
+    def coverage(self, recs):
+        """
+        Возвращает долю объектов каталога, попавших в рекомендации (по всем рекомендациям)
+        """
+        return len(np.unique(recs["item_id"].to_numpy())) / self.n_catalog_items
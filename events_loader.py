@@ -0,0 +1,121 @@
+"""
+Вспомогательный скрипт для массовой загрузки истории событий в хранилище онлайн-событий.
+
+Parquet-файл в формате events.parquet (user_id, item_id, started_at) читается потоково
+по частям (row groups), поэтому вся таблица не загружается в память. Каждая часть
+сортируется по пользователю и времени, и в хранилище попадают только последние
+max_events_per_user событий каждого пользователя. Предполагается, что события одного
+пользователя в разных частях файла идут в хронологическом порядке (как в events.parquet).
+
+Основные реализованные функции:
+- iter_event_batches() - потоковое чтение событий из parquet-файла по частям;
+- load_events() - загрузка событий напрямую в объект EventStore (используется при запуске events_service);
+- post_events() - отправка событий в запущенный events_service через /put_batch.
+
+Если в config.ini задан список шардов events_store_shards, каждая часть событий делится между шардами
+по пользователям (см. sharding.py), и каждый шард получает только события своих пользователей.
+
+Примеры запуска:
+python events_loader.py --path events.parquet
+python events_loader.py --path events.parquet --batch_size 100000
+python events_loader.py --path events.parquet --shards "http://127.0.0.1:8020, http://127.0.0.1:8021"
+"""
+
+import time
+import logging
+import argparse
+import configparser
+import numpy as np
+import pyarrow.parquet as pq
+import requests
+from sharding import HashRing, parse_urls
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def iter_event_batches(path, batch_size=1_000_000):
+    """
+    Возвращает события из parquet-файла частями в виде кортежей NumPy-массивов
+    (user_ids, item_ids, timestamps)
+    """
+    parquet_file = pq.ParquetFile(path)
+    columns = [c for c in ("user_id", "item_id", "started_at") if c in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        user_ids = batch.column("user_id").to_numpy()
+        item_ids = batch.column("item_id").to_numpy()
+        timestamps = None
+        if "started_at" in columns:
+            # Время нужно только для упорядочивания событий, поэтому переводим его в число
+            timestamps = batch.column("started_at").cast("timestamp[s]").cast("int64").to_numpy()
+        yield user_ids, item_ids, timestamps
+
+
+def load_events(events_store, path, batch_size=1_000_000, ring=None, shard_url=None):
+    """
+    Загружает события из parquet-файла в хранилище events_store;
+    если заданы кольцо шардов ring и адрес шарда shard_url, загружаются только события его пользователей
+    """
+    logger.info(f"Loading events from {path}")
+    shard = ring.nodes.index(shard_url) if ring is not None else None
+    n_events = 0
+    start = time.perf_counter()
+    for user_ids, item_ids, timestamps in iter_event_batches(path, batch_size):
+        if shard is not None:
+            mask = ring.assign(user_ids) == shard
+            user_ids, item_ids = user_ids[mask], item_ids[mask]
+            timestamps = timestamps[mask] if timestamps is not None else None
+        n_events += events_store.put_batch(user_ids, item_ids, timestamps)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Loaded {n_events} events for {len(events_store)} users, {n_events / elapsed:,.0f} events/sec")
+
+    return n_events
+
+
+def post_events(events_store_url, path, batch_size=100_000, shards=None, virtual_nodes=100):
+    """
+    Отправляет события из parquet-файла в запущенный events_service
+    (или в шарды shards, каждому - события его пользователей)
+    """
+    ring = HashRing(shards or [events_store_url], virtual_nodes)
+    logger.info(f"Posting events from {path} to {', '.join(ring.nodes)}")
+    n_events = 0
+    start = time.perf_counter()
+    with requests.Session() as session:
+        for user_ids, item_ids, timestamps in iter_event_batches(path, batch_size):
+            owners = ring.assign(user_ids) if len(ring) > 1 else np.zeros(len(user_ids), dtype=np.int64)
+            for shard, url in enumerate(ring.nodes):
+                mask = owners == shard
+                if not mask.any():
+                    continue
+                batch = {"user_ids": user_ids[mask].tolist(), "item_ids": item_ids[mask].tolist()}
+                if timestamps is not None:
+                    batch["timestamps"] = timestamps[mask].astype(np.float64).tolist()
+                resp = session.post(url + "/put_batch", json=batch)
+                resp.raise_for_status()
+                n_events += resp.json()["count"]
+    elapsed = time.perf_counter() - start
+    logger.info(f"Posted {n_events} events, {n_events / elapsed:,.0f} events/sec")
+
+    return n_events
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(module)s, %(funcName)s, %(message)s')
+
+    # Создаем парсер конфигурационного файла
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default="events.parquet")
+    parser.add_argument('--url', default=config["urls"]["events_store_url"].strip('"'))
+    parser.add_argument('--batch_size', type=int, default=100_000)
+    parser.add_argument('--shards', default=config.get("urls", "events_store_shards", fallback=""))
+    parser.add_argument('--virtual_nodes', type=int, default=config.getint("events", "virtual_nodes", fallback=100))
+    namespace = parser.parse_args()
+
+    post_events(namespace.url, namespace.path, namespace.batch_size,
+                parse_urls(namespace.shards), namespace.virtual_nodes)
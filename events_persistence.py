@@ -0,0 +1,239 @@
+"""
+Модуль для сохранения хранилища онлайн-событий на диск и быстрого восстановления после перезапуска.
+
+Состояние хранится в директории persistence_dir в двух видах:
+- журнал событий events.<поколение>.log - двоичные записи (user_id int64, item_id int32),
+которые дописываются в конец файла пачками с fsync раз в fsync_interval секунд;
+- контрольная точка checkpoint.<поколение>/ - массивы EventStore в формате .npy,
+которые при запуске отображаются в память (np.load(mmap_mode="c")) без разбора содержимого.
+
+Файл CURRENT содержит имя последней полной контрольной точки. Контрольная точка поколения G
+содержит все события из журналов поколений меньше G, поэтому при восстановлении
+после нее проигрываются только журналы поколений G и выше.
+
+Состояние хранилища для контрольной точки копируется частями по snapshot_chunk_slots слотов
+между обработкой запросов (см. EventStore.start_snapshot), поэтому запись событий
+не останавливается на время копирования всего хранилища.
+"""
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import contextlib
+import numpy as np
+
+
+logger = logging.getLogger("uvicorn.error")
+
+# Формат одной записи журнала
+LOG_RECORD = np.dtype([("user_id", "<i8"), ("item_id", "<i4")])
+
+
+class EventStorePersistence:
+    """
+    Класс для журналирования событий и сохранения контрольных точек хранилища EventStore
+    """
+
+    def __init__(self, events_store, directory, fsync_interval=1.0, checkpoint_interval=600.0,
+                 snapshot_chunk_slots=4096):
+
+        self.events_store = events_store
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.snapshot_chunk_slots = snapshot_chunk_slots
+
+        # События, еще не записанные в журнал
+        self._buffer = []
+        self._generation = 0
+        self._log = None
+        # Фоновая задача run() и выполняемая в отдельном потоке запись на диск
+        self._task = None
+        self._pending = None
+
+    def _log_path(self, generation):
+        return os.path.join(self.directory, f"events.{generation:08d}.log")
+
+    def _checkpoint_path(self, generation):
+        return os.path.join(self.directory, f"checkpoint.{generation:08d}")
+
+    def _log_generations(self):
+        """
+        Возвращает отсортированный список поколений журналов в директории
+        """
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith("events.") and name.endswith(".log"):
+                generations.append(int(name.split(".")[1]))
+
+        return sorted(generations)
+
+    def restore(self):
+        """
+        Загружает последнюю контрольную точку, проигрывает журналы после нее
+        и открывает новый журнал для записи
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        start = time.perf_counter()
+
+        generation = 0
+        current_path = os.path.join(self.directory, "CURRENT")
+        if os.path.exists(current_path):
+            with open(current_path) as f:
+                checkpoint_path = os.path.join(self.directory, f.read().strip())
+            with open(os.path.join(checkpoint_path, "meta.json")) as f:
+                generation = json.load(f)["generation"]
+            arrays = {}
+            for name in ("events", "heads", "counts", "updated_at", "slot_users"):
+                arrays[name] = np.load(os.path.join(checkpoint_path, f"{name}.npy"), mmap_mode="c")
+            self.events_store.load_arrays(arrays)
+            logger.info(f"Loaded checkpoint {checkpoint_path} with {len(self.events_store)} users")
+
+        n_events = 0
+        for log_generation in self._log_generations():
+            if log_generation < generation:
+                continue
+            with open(self._log_path(log_generation), "rb") as f:
+                data = f.read()
+            # Последняя запись может быть записана не полностью, ее отбрасываем
+            records = np.frombuffer(data[:len(data) - len(data) % LOG_RECORD.itemsize], dtype=LOG_RECORD)
+            n_events += self.events_store.put_batch(records["user_id"], records["item_id"])
+            generation = max(generation, log_generation + 1)
+
+        self._generation = generation
+        self._log = open(self._log_path(generation), "ab")
+        logger.info(
+            f"Restored {len(self.events_store)} users, replayed {n_events} logged events "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+    def record(self, user_id, item_id):
+        """
+        Запоминает событие для записи в журнал (сама запись выполняется в фоне)
+        """
+        self._buffer.append((user_id, item_id))
+
+    def record_batch(self, user_ids, item_ids):
+        """
+        Запоминает пачку событий для записи в журнал
+        """
+        self._buffer.extend(zip(np.asarray(user_ids).tolist(), np.asarray(item_ids).tolist()))
+
+    async def _to_thread(self, func, *args):
+        """
+        Выполняет запись на диск в отдельном потоке; отмена фоновой задачи не прерывает
+        начатую запись (поток все равно доработает), поэтому close() дожидается ее завершения
+        """
+        self._pending = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        await asyncio.shield(self._pending)
+
+    def _write(self, log, buffer):
+        """
+        Дописывает события в журнал и сбрасывает его на диск
+        """
+        if buffer:
+            log.write(np.array(buffer, dtype=LOG_RECORD).tobytes())
+        log.flush()
+        os.fsync(log.fileno())
+
+    async def flush(self):
+        """
+        Записывает накопленные события в журнал в отдельном потоке
+        """
+        buffer, self._buffer = self._buffer, []
+        await self._to_thread(self._write, self._log, buffer)
+
+    def _save_checkpoint(self, arrays, generation):
+        """
+        Сохраняет массивы контрольной точки и делает ее текущей
+        """
+        checkpoint_path = self._checkpoint_path(generation)
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+        os.makedirs(checkpoint_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(checkpoint_path, f"{name}.npy"), array)
+        with open(os.path.join(checkpoint_path, "meta.json"), "w") as f:
+            json.dump({"generation": generation, "users": len(self.events_store)}, f)
+
+        # Переключаем CURRENT атомарно, затем удаляем устаревшие журналы и контрольные точки
+        tmp_path = os.path.join(self.directory, "CURRENT.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(os.path.basename(checkpoint_path))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, "CURRENT"))
+
+        for log_generation in self._log_generations():
+            if log_generation < generation:
+                os.remove(self._log_path(log_generation))
+        for name in os.listdir(self.directory):
+            if name.startswith("checkpoint.") and name != os.path.basename(checkpoint_path):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    async def checkpoint(self):
+        """
+        Сохраняет контрольную точку: начинает новый журнал, копирует состояние хранилища
+        частями и записывает его на диск в отдельном потоке
+        """
+        start = time.perf_counter()
+        await self.flush()
+
+        # Переключение журнала и начало снимка происходят без переключения на другие корутины,
+        # а снимок соответствует моменту своего начала, поэтому контрольная точка согласована
+        # с журналом, хотя события продолжают записываться во время копирования
+        old_log = self._log
+        self._generation += 1
+        self._log = open(self._log_path(self._generation), "ab")
+        buffer, self._buffer = self._buffer, []
+        self.events_store.start_snapshot()
+        try:
+            while not self.events_store.copy_snapshot_part(self.snapshot_chunk_slots):
+                await asyncio.sleep(0)
+        finally:
+            arrays = self.events_store.finish_snapshot()
+
+        await self._to_thread(self._write, old_log, buffer)
+        old_log.close()
+        await self._to_thread(self._save_checkpoint, arrays, self._generation)
+        logger.info(f"Saved checkpoint for {len(self.events_store)} users in {time.perf_counter() - start:.2f}s")
+
+    async def run(self):
+        """
+        Фоновая задача: периодически сбрасывает журнал на диск и сохраняет контрольные точки
+        """
+        checkpoint_at = time.monotonic() + self.checkpoint_interval
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                if self.checkpoint_interval > 0 and time.monotonic() >= checkpoint_at:
+                    await self.checkpoint()
+                    checkpoint_at = time.monotonic() + self.checkpoint_interval
+                else:
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"{e!r}, failed to persist events")
+
+    def start(self):
+        """
+        Запускает фоновую задачу run()
+        """
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """
+        Останавливает фоновую задачу, дожидается начатой ей записи на диск,
+        сохраняет итоговую контрольную точку и закрывает журнал
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        # итоговая контрольная точка не должна писаться одновременно с начатой в фоне
+        if self._pending is not None:
+            await asyncio.gather(self._pending, return_exceptions=True)
+        await self.checkpoint()
+        self._log.close()
@@ -4,14 +4,70 @@
 
 Основные обрабатываемые запросы:
 - /put - сохраняет пару значений user_id, item_id как событие, 
+- /put_batch - сохраняет пачку событий из массивов user_ids, item_ids и, возможно, timestamps,
 - /get - возвращает требуемое кол-во онлайн-событий для заданного пользователя,
-начиная с самых последних.
+начиная с самых последних, и версию его истории событий,
+- /metrics - метрики сервиса в формате Prometheus.
 
 Для запуска и тестирования см. инструкции в файле README.md
 """
 
-import pandas as pd
-from fastapi import FastAPI
+import time
+import logging
+import configparser
+from typing import Annotated
+from contextlib import asynccontextmanager
+import numpy as np
+from fastapi import FastAPI, Header, HTTPException, Query
+from pydantic import BaseModel, Field
+import metrics
+from metrics import stage, encoded_response
+from sharding import HashRing, parse_urls
+
+
+logger = logging.getLogger("uvicorn.error")
+
+# Создаем парсер конфигурационного файла
+config = configparser.ConfigParser()
+config.read("config.ini")
+
+# Максимальное кол-во хранимых событий на одного пользователя
+max_events_per_user = config.getint("events", "max_events_per_user", fallback=10)
+# Максимальное кол-во пользователей в хранилище (0 - без ограничений)
+max_users = config.getint("events", "max_users", fallback=0)
+# Время (в секундах) без новых событий, после которого пользователь удаляется из хранилища (0 - без ограничений)
+ttl = config.getfloat("events", "ttl", fallback=0)
+# Parquet-файл с историей событий для заполнения хранилища при запуске (пусто - не заполнять)
+warmup_path = config.get("events", "warmup_path", fallback="")
+# Директория для журнала событий и контрольных точек (пусто - хранилище не сохраняется на диск)
+persistence_dir = config.get("events", "persistence_dir", fallback="")
+# Интервал (в секундах) сброса журнала на диск и интервал сохранения контрольных точек
+fsync_interval = config.getfloat("events", "fsync_interval", fallback=1.0)
+checkpoint_interval = config.getfloat("events", "checkpoint_interval", fallback=600.0)
+# Шарды events_service, кол-во точек каждого шарда на кольце и адрес этого экземпляра (см. sharding.py):
+# при заполнении из warmup_path загружаются только события пользователей этого шарда
+events_store_shards = parse_urls(config.get("urls", "events_store_shards", fallback=""))
+virtual_nodes = config.getint("events", "virtual_nodes", fallback=100)
+shard_url = config.get("events", "shard_url", fallback="").strip('"')
+
+# Допустимые значения идентификаторов: события хранятся в int32-массиве, пользователи - в int64
+ITEM_ID_MIN, ITEM_ID_MAX = int(np.iinfo(np.int32).min), int(np.iinfo(np.int32).max)
+USER_ID_MIN, USER_ID_MAX = int(np.iinfo(np.int64).min), int(np.iinfo(np.int64).max)
+
+
+def sort_events(user_ids, item_ids, timestamps=None):
+    """
+    Сортирует события по пользователю, а внутри пользователя - по времени
+    (или по порядку следования, если timestamps не заданы)
+    """
+    user_ids = np.asarray(user_ids)
+    item_ids = np.asarray(item_ids, dtype=np.int32)
+    if timestamps is None:
+        order = np.argsort(user_ids, kind="stable")
+    else:
+        order = np.lexsort((np.asarray(timestamps), user_ids))
+
+    return user_ids[order], item_ids[order]
 
 
 # Класс-хранилище онлайн-событий 
@@ -19,34 +75,398 @@ class EventStore:
     """
     Класс для сохранения и получения последних онлайн-событий,
     необходимых для генерации персональных онлайн-рекомендаций.
+
+    События всех пользователей хранятся в одном заранее выделенном int32-массиве,
+    в котором каждому пользователю принадлежит слот с кольцевым буфером фиксированной емкости.
+    Каждое событие записывается дважды - в позиции head и head + емкость, поэтому последние
+    события пользователя (от новых к старым) всегда лежат непрерывно и возвращаются срезом
+    без копирования.
+
+    Пользователи без новых событий дольше ttl секунд, а также самые давние пользователи
+    сверх max_users вытесняются из хранилища при появлении новых пользователей,
+    а их слоты используются повторно.
+
+    Для каждого пользователя хранится версия истории событий - значение глобального счетчика
+    на момент последнего события; по ней основной сервис определяет, устарели ли
+    закэшированные для пользователя рекомендации. Счетчик начинается со времени запуска
+    в наносекундах, поэтому версии после перезапуска не совпадают с прежними.
+
+    Если задан seen_items (см. seen_items.py), каждое событие также добавляется в список
+    прослушанных пользователем треков, по которому из рекомендаций исключаются уже прослушанные.
+
+    Для сохранения на диск без остановки записи снимок состояния копируется частями между
+    обработкой запросов (start_snapshot, copy_snapshot_part, finish_snapshot): перед первым
+    изменением еще не скопированного слота его прежнее состояние сохраняется, поэтому снимок
+    соответствует моменту start_snapshot.
     """
 
-    def __init__(self, max_events_per_user=10):
+    def __init__(self, max_events_per_user=10, max_users=0, ttl=0, initial_capacity=1024):
 
-        self.events = {}
+        if max_events_per_user <= 0:
+            raise ValueError("max_events_per_user must be positive")
         self.max_events_per_user = max_events_per_user
+        self.max_users = max_users
+        self.ttl = ttl
+
+        # user_id -> номер слота
+        self._slots = {}
+        # Свободные слоты (вначале - все, далее - освободившиеся после вытеснения)
+        self._free_slots = list(range(initial_capacity - 1, -1, -1))
+        # Время последней проверки на устаревших пользователей
+        self._swept_at = time.monotonic()
+        # Глобальный счетчик версий истории событий
+        self._version = time.time_ns()
+        # Прослушанные пользователями треки (None - не отслеживаются)
+        self.seen_items = None
+        # Копируемый частями снимок состояния (None - снимок не копируется), кол-во уже скопированных
+        # слотов и прежнее состояние слотов, измененных до копирования
+        self._snapshot = None
+        self._snapshot_pos = 0
+        self._snapshot_saved = {}
+
+        self._allocate(initial_capacity)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _allocate(self, capacity, copy_from=0):
+        """
+        Выделяет массивы на capacity слотов, копируя в них первые copy_from слотов текущих массивов
+        """
+        width = 2 * self.max_events_per_user
+        arrays = {
+            "_events": np.zeros(capacity * width, dtype=np.int32),
+            "_heads": np.zeros(capacity, dtype=np.int32),
+            "_counts": np.zeros(capacity, dtype=np.int32),
+            "_updated_at": np.zeros(capacity, dtype=np.float64),
+            "_slot_users": np.zeros(capacity, dtype=np.int64),
+            "_versions": np.zeros(capacity, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            if copy_from:
+                old = getattr(self, name)
+                array[:len(old)] = old
+        self._set_arrays(arrays)
+
+    def _set_arrays(self, arrays):
+        """
+        Устанавливает массивы хранилища и создает для них memoryview
+        """
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        # Поэлементные чтение и запись через memoryview заметно быстрее,
+        # чем через индексацию NumPy-массивов
+        self._ev = memoryview(self._events)
+        self._hd = memoryview(self._heads)
+        self._ct = memoryview(self._counts)
+        self._ts = memoryview(self._updated_at)
+        self._us = memoryview(self._slot_users)
+        self._vs = memoryview(self._versions)
+
+    def _grow(self):
+        """
+        Увеличивает емкость массивов в 2 раза
+        """
+        capacity = len(self._heads)
+        self._allocate(2 * capacity, copy_from=capacity)
+        self._free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def _release(self, slots):
+        """
+        Удаляет пользователей из заданных слотов
+        """
+        for slot in slots.tolist():
+            if self._snapshot is not None:
+                self._save_slot(slot)
+            del self._slots[self._us[slot]]
+            self._ct[slot] = 0
+            self._free_slots.append(slot)
+
+    def _evict(self, now):
+        """
+        Вытесняет давно неактивных пользователей и самых давних пользователей сверх max_users
+        """
+        if self.ttl > 0 and now - self._swept_at > self.ttl:
+            self._swept_at = now
+            used = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+            self._release(used[now - self._updated_at[used] > self.ttl])
+
+        if self.max_users > 0 and len(self._slots) >= self.max_users:
+            # Вытесняем сразу 1% самых давних пользователей, чтобы не делать это на каждом добавлении
+            used = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+            n = min(len(used), max(len(used) - self.max_users + 1, self.max_users // 100))
+            oldest = np.argpartition(self._updated_at[used], n - 1)[:n]
+            self._release(used[oldest])
+
+    def _acquire_slot(self, user_id, now):
+        """
+        Выделяет слот для нового пользователя
+        """
+        self._evict(now)
+        if not self._free_slots:
+            self._grow()
+        slot = self._free_slots.pop()
+        if self._snapshot is not None:
+            self._save_slot(slot)
+        self._hd[slot] = 0
+        self._ct[slot] = 0
+        self._us[slot] = user_id
+        self._slots[user_id] = slot
+
+        return slot
+
+    def to_arrays(self):
+        """
+        Возвращает копию состояния хранилища в виде словаря NumPy-массивов для сохранения на диск
+        (время последнего события переводится из time.monotonic во время Unix)
+        """
+        return {
+            "events": self._events.copy(),
+            "heads": self._heads.copy(),
+            "counts": self._counts.copy(),
+            "updated_at": self._updated_at - time.monotonic() + time.time(),
+            "slot_users": self._slot_users.copy(),
+        }
+
+    def start_snapshot(self):
+        """
+        Начинает снимок состояния хранилища, который копируется частями через copy_snapshot_part
+        """
+        capacity = len(self._heads)
+        self._snapshot = {
+            "events": np.empty(capacity * 2 * self.max_events_per_user, dtype=np.int32),
+            "heads": np.empty(capacity, dtype=np.int32),
+            "counts": np.empty(capacity, dtype=np.int32),
+            "updated_at": np.empty(capacity, dtype=np.float64),
+            "slot_users": np.empty(capacity, dtype=np.int64),
+        }
+        self._snapshot_pos = 0
+        self._snapshot_saved = {}
+
+    def copy_snapshot_part(self, n_slots):
+        """
+        Копирует в снимок следующие n_slots слотов; возвращает True, если скопированы все слоты
+        """
+        snapshot, start = self._snapshot, self._snapshot_pos
+        capacity = len(snapshot["heads"])
+        end = min(start + n_slots, capacity)
+        width = 2 * self.max_events_per_user
+        snapshot["events"][start * width:end * width] = self._events[start * width:end * width]
+        for name in ("heads", "counts", "updated_at", "slot_users"):
+            snapshot[name][start:end] = getattr(self, f"_{name}")[start:end]
+        self._snapshot_pos = end
+
+        return end == capacity
+
+    def finish_snapshot(self):
+        """
+        Завершает снимок и возвращает его в том же виде, что и to_arrays
+        (при незавершенном копировании - просто прекращает отслеживание изменений)
+        """
+        snapshot, saved = self._snapshot, self._snapshot_saved
+        self._snapshot, self._snapshot_saved = None, {}
+        # Восстанавливаем прежнее состояние слотов, измененных до их копирования
+        width = 2 * self.max_events_per_user
+        for slot, (events, head, count, updated_at, user_id) in saved.items():
+            snapshot["events"][slot * width:(slot + 1) * width] = events
+            snapshot["heads"][slot] = head
+            snapshot["counts"][slot] = count
+            snapshot["updated_at"][slot] = updated_at
+            snapshot["slot_users"][slot] = user_id
+        snapshot["updated_at"] += time.time() - time.monotonic()
+
+        return snapshot
+
+    def _save_slot(self, slot):
+        """
+        Сохраняет прежнее состояние слота, который еще не скопирован в снимок
+        """
+        if self._snapshot_pos <= slot < len(self._snapshot["heads"]) and slot not in self._snapshot_saved:
+            width = 2 * self.max_events_per_user
+            self._snapshot_saved[slot] = (
+                self._events[slot * width:(slot + 1) * width].copy(),
+                self._hd[slot], self._ct[slot], self._ts[slot], self._us[slot],
+            )
+
+    def load_arrays(self, arrays):
+        """
+        Восстанавливает состояние хранилища из словаря массивов, полученного через to_arrays;
+        массивы не копируются, поэтому могут быть отображены в память (np.load(mmap_mode="c"))
+        """
+        capacity = len(arrays["heads"])
+        if len(arrays["events"]) != capacity * 2 * self.max_events_per_user:
+            raise ValueError("Snapshot was saved with a different max_events_per_user")
+
+        # Версии не сохраняются на диск: всем восстановленным пользователям назначаем новую версию
+        counts = arrays["counts"]
+        self._version += 1
+        self._set_arrays({
+            "_events": arrays["events"],
+            "_heads": arrays["heads"],
+            "_counts": counts,
+            "_updated_at": arrays["updated_at"] - time.time() + time.monotonic(),
+            "_slot_users": arrays["slot_users"],
+            "_versions": np.full(capacity, self._version, dtype=np.int64),
+        })
+
+        # Занятые слоты - те, в которых есть хотя бы одно событие
+        used = np.flatnonzero(counts > 0)
+        self._slots = dict(zip(self._slot_users[used].tolist(), used.tolist()))
+        self._free_slots = np.flatnonzero(counts == 0)[::-1].tolist()
 
     def put(self, user_id, item_id):
         """
         Сохраняет событие
         """
-        user_events = self.events.get(user_id, [])
-        self.events[user_id] = [item_id] + user_events[: self.max_events_per_user]
+        self._put(user_id, item_id)
+        if self.seen_items is not None:
+            self.seen_items.add(user_id, item_id)
+
+    def _put(self, user_id, item_id):
+        """
+        Сохраняет событие в хранилище (без добавления в прослушанные)
+        """
+        now = time.monotonic()
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._acquire_slot(user_id, now)
+        elif self._snapshot is not None:
+            self._save_slot(slot)
+
+        capacity = self.max_events_per_user
+        head = (self._hd[slot] - 1) % capacity
+        pos = 2 * capacity * slot + head
+        self._ev[pos] = item_id
+        self._ev[pos + capacity] = item_id
+        self._hd[slot] = head
+        if self._ct[slot] < capacity:
+            self._ct[slot] += 1
+        self._ts[slot] = now
+        self._version += 1
+        self._vs[slot] = self._version
+
+    def put_batch(self, user_ids, item_ids, timestamps=None, presorted=False):
+        """
+        Сохраняет пачку событий; события каждого пользователя добавляются в порядке timestamps
+        (или в порядке следования, если timestamps не заданы), причем добавляются только
+        последние max_events_per_user событий, остальные все равно были бы вытеснены;
+        presorted - события уже отсортированы через sort_events (повторно не сортируются)
+        """
+        if presorted:
+            user_ids, item_ids = np.asarray(user_ids), np.asarray(item_ids, dtype=np.int32)
+        else:
+            user_ids, item_ids = sort_events(user_ids, item_ids, timestamps)
+        if len(user_ids) == 0:
+            return 0
+
+        unique_users, starts, counts = np.unique(user_ids, return_index=True, return_counts=True)
+        ends = starts + counts
+        if self.seen_items is not None:
+            # В прослушанные добавляются все события, включая те, что не попадут в хранилище
+            for user_id, start, end in zip(unique_users.tolist(), starts.tolist(), ends.tolist()):
+                self.seen_items.add_many(user_id, item_ids[start:end])
+        starts = np.maximum(starts, ends - self.max_events_per_user)
+        for user_id, start, end in zip(unique_users.tolist(), starts.tolist(), ends.tolist()):
+            for item_id in item_ids[start:end].tolist():
+                self._put(user_id, item_id)
+
+        return len(user_ids)
 
     def get(self, user_id, k):
         """
-        Возвращает последние онлайн-события пользователя
+        Возвращает последние онлайн-события пользователя (от новых к старым)
+        в виде среза без копирования; срез меняется при следующих вызовах put,
+        поэтому для хранения его нужно скопировать
+        """
+        slot = self._slots.get(user_id)
+        if slot is None or (self.ttl > 0 and time.monotonic() - self._ts[slot] > self.ttl):
+            return self._events[:0]
+
+        start = 2 * self.max_events_per_user * slot + self._hd[slot]
+        return self._events[start:start + min(max(k, 0), self._ct[slot])]
+
+    def version(self, user_id):
+        """
+        Возвращает версию истории событий пользователя (0 - событий нет);
+        версия меняется при каждом новом событии пользователя
         """
-        user_events = self.events.get(user_id, [])[: min(k, self.max_events_per_user)]
+        slot = self._slots.get(user_id)
+        if slot is None or (self.ttl > 0 and time.monotonic() - self._ts[slot] > self.ttl):
+            return 0
 
-        return user_events
+        return self._vs[slot]
 
 
 # Создаем хранилище событий
-events_store = EventStore()
+events_store = EventStore(max_events_per_user, max_users, ttl)
+
+# Размер хранилища (вычисляется при запросе /metrics)
+metrics.gauge("events_store_users", "Number of users in the events store", lambda: len(events_store))
+metrics.gauge(
+    "events_store_bytes", "Size of the events store arrays",
+    lambda: sum(getattr(events_store, name).nbytes
+                for name in ("_events", "_heads", "_counts", "_updated_at", "_slot_users", "_versions")),
+)
+
+# Создаем объект для сохранения хранилища на диск, если он включен
+events_persistence = None
+if persistence_dir:
+    from events_persistence import EventStorePersistence
+    events_persistence = EventStorePersistence(
+        events_store, persistence_dir, fsync_interval, checkpoint_interval
+    )
+
+async def start_store():
+    """
+    Подготавливает хранилище к работе: восстанавливает его с диска и заполняет из файла
+    (вызывается при запуске events_service, а во встроенном режиме - при запуске основного сервиса,
+    т.к. lifespan приложения, подключенного через app.mount, не выполняется)
+    """
+    # восстанавливаем хранилище с диска (контрольная точка + журнал) и запускаем сохранение на диск
+    if events_persistence is not None:
+        events_persistence.restore()
+        events_persistence.start()
+
+    # заполняем пустое хранилище историей событий из файла
+    if warmup_path and len(events_store) == 0:
+        from events_loader import load_events
+        if events_store_shards and shard_url:
+            load_events(events_store, warmup_path, ring=HashRing(events_store_shards, virtual_nodes), shard_url=shard_url)
+        else:
+            load_events(events_store, warmup_path)
+
+
+async def stop_store():
+    """
+    Сохраняет хранилище на диск при остановке сервиса
+    """
+    if events_persistence is not None:
+        await events_persistence.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # код ниже (до yield) выполнится только один раз при запуске сервиса
+    await start_store()
+    logger.info("Ready!")
+    yield
+    # код ниже выполнится только один раз при остановке сервиса
+    await stop_store()
+
 
 # Создаём приложение FastAPI
-app = FastAPI(title="events")
+app = FastAPI(title="events", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware, service="events")
+
+
+class EventsBatch(BaseModel):
+    """
+    Пачка событий для /put_batch
+    """
+    user_ids: list[Annotated[int, Field(ge=USER_ID_MIN, le=USER_ID_MAX)]]
+    item_ids: list[Annotated[int, Field(ge=ITEM_ID_MIN, le=ITEM_ID_MAX)]]
+    timestamps: list[float] | None = None
 
 
 # Обращение к корневому url для проверки работоспособности сервиса
@@ -57,19 +477,54 @@ def read_root():
 
 # Сохранение одного события
 @app.post("/put")
-async def put(user_id: int, item_id: int):
+async def put(user_id: int = Query(ge=USER_ID_MIN, le=USER_ID_MAX),
+              item_id: int = Query(ge=ITEM_ID_MIN, le=ITEM_ID_MAX)):
     """
-    Сохраняет событие для user_id, item_id
+    Сохраняет событие для user_id, item_id (идентификаторы вне допустимого диапазона - ошибка 422)
     """
-    events_store.put(user_id, item_id)
+    with stage("events", "store_put"):
+        events_store.put(user_id, item_id)
+    if events_persistence is not None:
+        events_persistence.record(user_id, item_id)
     return {"result": "ok"}
 
 
+# Сохранение пачки событий
+@app.post("/put_batch")
+async def put_batch(batch: EventsBatch):
+    """
+    Сохраняет пачку событий для пар user_ids, item_ids
+    """
+    n = len(batch.user_ids)
+    if len(batch.item_ids) != n or (batch.timestamps is not None and len(batch.timestamps) != n):
+        raise HTTPException(status_code=400, detail="user_ids, item_ids and timestamps must have the same length")
+
+    with stage("events", "store_put"):
+        # сортируем один раз: в журнал события пишутся в том же порядке, в котором добавлены в хранилище
+        user_ids, item_ids = sort_events(batch.user_ids, batch.item_ids, batch.timestamps)
+        count = events_store.put_batch(user_ids, item_ids, presorted=True)
+    if events_persistence is not None:
+        events_persistence.record_batch(user_ids, item_ids)
+    return {"result": "ok", "count": count}
+
+
 # Получение онлайн-событий, начиная с самого последнего
 @app.post("/get")
-async def get(user_id: int, k: int = 10):
+async def get(user_id: int, k: int = 10, accept: str | None = Header(None)):
     """
     Возвращает список последних k событий для пользователя user_id
+    и версию его истории событий
+    """
+    with stage("events", "store_get"):
+        events = events_store.get(user_id, k).tolist()
+        version = events_store.version(user_id)
+    return encoded_response("events", {"events": events, "version": version}, accept)
+
+
+# Метрики сервиса
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Возвращает метрики сервиса в текстовом формате Prometheus
     """
-    events = events_store.get(user_id, k)
-    return {"events": events}
+    return metrics.render()
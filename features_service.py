@@ -2,19 +2,41 @@
 Вспомогательное FastAPI-приложение для получения онлайн-рекомендаций на основе треков с похожими жанрами.
 
 Основные обрабатываемые запросы:
-- /similar_items - получение требуемого кол-ва объектов, похожих на заданный.
+- /similar_items - получение требуемого кол-ва объектов, похожих на заданный,
+- /similar_items_batch - получение требуемого кол-ва объектов, похожих на любой из заданных,
+- /admin/reload - перезагрузка файла с похожими объектами без остановки сервиса,
+- /metrics - метрики сервиса в формате Prometheus.
 
 Для запуска и тестирования см. инструкции в файле README.md
 """
 
+import os
+import asyncio
 import logging
+import configparser
 from contextlib import asynccontextmanager
+import numpy as np
 import pandas as pd
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Query
+from csr_index import CSRIndex, index_path
+from artifacts import build_similar_items
+from blending import merge_by_score
+from hot_reload import ArtifactsReloader, artifacts_stamp, artifacts_version
+import metrics
+from metrics import stage, encoded_response
 
 
 logger = logging.getLogger("uvicorn.error")
 
+# Создаем парсер конфигурационного файла
+config = configparser.ConfigParser()
+config.read("config.ini")
+
+# Загружать ли похожие объекты из сконвертированных файлов через отображение в память
+use_mmap_artifacts = config.getboolean("artifacts", "use_mmap", fallback=True)
+# Интервал (в секундах) проверки файла с похожими объектами на изменения (0 - не проверять)
+watch_interval = config.getfloat("artifacts", "watch_interval", fallback=0)
+
 
 class SimilarItems:
     """
@@ -24,31 +46,113 @@ class SimilarItems:
     def __init__(self):
 
         self._similar_items = None
+        # Параметры загрузки (для перезагрузки) и версия загруженных данных
+        self._source = None
+        self.version = None
+
+    def _read(self, path, use_mmap=False, **kwargs):
+        """
+        Читает похожие объекты из сконвертированной директории или parquet-файла
+        """
+        mmap_path = index_path(path)
+        if use_mmap and os.path.isdir(mmap_path):
+            logger.info(f"Loading data, type: similar, from {mmap_path}")
+            return CSRIndex.open(mmap_path)
+
+        logger.info(f"Loading data, type: similar")
+        similar_items = pd.read_parquet(path, **kwargs)
+        return build_similar_items(similar_items)
 
-    def load(self, path, **kwargs):
+    def load(self, path, use_mmap=False, **kwargs):
         """
-        Загружаем данные из файла
+        Загружаем данные из файла и строим по ним индекс item_id_1 -> похожие объекты;
+        при use_mmap и наличии сконвертированной директории (см. build_artifacts.py)
+        индекс отображается в память вместо чтения parquet-файла
         """
-        logger.info(f"Loading data, type: {type}")
-        self._similar_items = pd.read_parquet(path, **kwargs) 
-        #self._similar_items = self._similar_items.set_index('item_id_1')
+        self._source = (path, use_mmap, kwargs)
+        self._similar_items = self._read(path, use_mmap, **kwargs)
+        self.version = artifacts_version(self.artifacts_stamp())
         logger.info(f"Loaded")
 
+    def artifacts_stamp(self):
+        """
+        Возвращает отметку файла, из которого загружены похожие объекты
+        """
+        path, use_mmap, _ = self._source
+        mmap_path = index_path(path)
+
+        return artifacts_stamp([mmap_path if use_mmap and os.path.isdir(mmap_path) else path])
+
+    def build_state(self):
+        """
+        Загружает новую версию похожих объектов из того же файла (для перезагрузки)
+        """
+        stamp = self.artifacts_stamp()
+        path, use_mmap, kwargs = self._source
+
+        return self._read(path, use_mmap, **kwargs), artifacts_version(stamp)
+
+    def swap(self, state):
+        """
+        Атомарно заменяет текущую версию похожих объектов на новую
+        """
+        self._similar_items, self.version = state
+
     def get(self, item_id: int, k: int = 10):
         """
-        Возвращает список похожих объектов
+        Возвращает k самых похожих объектов (NumPy-массивы идентификаторов и оценок,
+        в списки их переводит кодировщик ответа, см. encoding.py)
         """
         try:
-            i2i = self._similar_items.query('item_id_1 == @item_id') #.loc[item_id].head(k)
-            i2i = i2i[["item_id_2", "score"]].to_dict(orient="list")
-        except KeyError:
-            logger.error("No recommendations found")
-            i2i = {"item_id_2": [], "score": []}
+            index = self._similar_items
+            rows = index.slice(item_id, k)
+            i2i = {
+                "item_id_2": index.columns["item_id_2"][rows],
+                "score": index.columns["score"][rows],
+                "version": self.version,
+            }
+        except Exception as e:
+            logger.error(f"{e}, no recommendations found")
+            i2i = {"item_id_2": [], "score": [], "version": self.version}
+
+        return i2i
+
+    def get_batch(self, item_ids, k: int = 10, exclude_seed: bool = False):
+        """
+        Возвращает объединенный список из k объектов, похожих на любой из item_ids:
+        соседи всех объектов сортируются по убыванию score, дубликаты удаляются
+        (остается вхождение с максимальным score), при exclude_seed исключаются сами item_ids
+        """
+        try:
+            index = self._similar_items
+            rows = [index.slice(item_id, k) for item_id in item_ids]
+            rows = np.concatenate([np.arange(r.start, r.stop) for r in rows] + [np.arange(0)])
+            items = index.columns["item_id_2"][rows]
+            scores = index.columns["score"][rows]
+
+            # Сортируем по убыванию score и оставляем первое вхождение каждого объекта
+            items, scores = merge_by_score(items, scores)
+
+            if exclude_seed:
+                mask = ~np.isin(items, np.asarray(item_ids, dtype=items.dtype))
+                items, scores = items[mask], scores[mask]
+
+            i2i = {"item_id_2": items[:k], "score": scores[:k], "version": self.version}
+        except Exception as e:
+            logger.error(f"{e}, no recommendations found")
+            i2i = {"item_id_2": [], "score": [], "version": self.version}
 
         return i2i
 
 
 sim_items_store = SimilarItems()
+sim_items_reloader = ArtifactsReloader(sim_items_store, watch_interval)
+
+# Размер загруженного индекса похожих объектов (вычисляется при запросе /metrics)
+metrics.gauge(
+    "similar_items_artifacts_bytes", "Size of loaded similar items",
+    lambda: sim_items_store._similar_items.nbytes if sim_items_store._similar_items is not None else 0,
+)
 
 
 @asynccontextmanager
@@ -56,15 +160,23 @@ async def lifespan(app: FastAPI):
     # код ниже (до yield) выполнится только один раз при запуске сервиса
     sim_items_store.load(
         'similar.parquet', 
+        use_mmap=use_mmap_artifacts,
         columns=["item_id_1", "item_id_2", "score"],
     )
+    # Следим за изменениями файла с похожими объектами
+    watch_task = None
+    if watch_interval > 0:
+        watch_task = asyncio.create_task(sim_items_reloader.watch())
     logger.info("Ready!")
-    # код ниже выполнится только один раз при остановке сервиса
     yield
+    # код ниже выполнится только один раз при остановке сервиса
+    if watch_task is not None:
+        watch_task.cancel()
 
 
 # Создаём приложение FastAPI
 app = FastAPI(title="features", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware, service="features")
 
 
 # Обращение к корневому url для проверки работоспособности сервиса
@@ -74,9 +186,39 @@ def read_root():
 
 
 @app.post("/similar_items")
-async def recommendations(item_id: int, k: int = 10):
+async def recommendations(item_id: int, k: int = 10, accept: str | None = Header(None)):
     """
     Возвращает список похожих объектов длиной k для item_id
     """
-    i2i = sim_items_store.get(item_id, k)
-    return i2i
+    with stage("features", "index_lookup"):
+        i2i = sim_items_store.get(item_id, k)
+    return encoded_response("features", i2i, accept)
+
+
+@app.post("/similar_items_batch")
+async def recommendations_batch(item_ids: list[int] = Query([]), k: int = 10, exclude_seed: bool = False,
+                                accept: str | None = Header(None)):
+    """
+    Возвращает объединенный список длиной k объектов, похожих на item_ids,
+    отсортированный по убыванию score и без дубликатов
+    """
+    with stage("features", "index_lookup"):
+        i2i = sim_items_store.get_batch(item_ids, k, exclude_seed)
+    return encoded_response("features", i2i, accept)
+
+
+@app.post("/admin/reload")
+async def reload():
+    """
+    Загружает новую версию файла с похожими объектами и атомарно подменяет ей текущую
+    """
+    version = await sim_items_reloader.reload()
+    return {"result": "ok", "version": version}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Возвращает метрики сервиса в текстовом формате Prometheus
+    """
+    return metrics.render()
@@ -0,0 +1,137 @@
+"""
+Вспомогательный модуль для перезагрузки файлов с рекомендациями без остановки сервиса.
+
+Хранилище (Recommendations или SimilarItems) должно реализовывать методы:
+- artifacts_stamp() - отметка исходных файлов (см. artifacts_stamp), по изменению которой
+определяется, что файлы нужно перезагрузить;
+- build_state() - загрузка новой версии данных (выполняется в отдельном потоке);
+- swap(state) - атомарная замена текущей версии на новую (выполняется в цикле событий,
+поэтому запросы, которые уже начали работу со старой версией, завершаются на ней).
+
+После каждой замены (и по запросу, и при изменении файлов) вызывается on_swap, если он задан
+(например, для очистки кэша ответов, построенных по старой версии).
+
+После замены старая версия освобождается, как только на нее не остается ссылок.
+"""
+
+import gc
+import os
+import time
+import hashlib
+import asyncio
+import logging
+import resource
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Интервал (в секундах) замера памяти процесса во время перезагрузки
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def artifacts_stamp(paths):
+    """
+    Возвращает отметку файлов - время изменения в наносекундах, inode и размер каждого
+    существующего файла; отметка меняется и при замене файлов в пределах одной секунды
+    """
+    stamp = []
+    for path in paths:
+        if os.path.exists(path):
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_ino, st.st_size))
+
+    return tuple(stamp)
+
+
+def artifacts_version(stamp):
+    """
+    Возвращает строковую версию данных по отметке файлов: время последнего изменения
+    и хеш отметки, чтобы версии различались при изменении файлов в пределах одной секунды
+    """
+    mtime = max((mtime_ns for mtime_ns, _, _ in stamp), default=0) / 1e9
+    digest = hashlib.blake2b(repr(stamp).encode(), digest_size=4).hexdigest()
+
+    return time.strftime("%Y%m%d-%H%M%S", time.localtime(mtime)) + f"-{digest}"
+
+
+def rss_usage():
+    """
+    Возвращает текущий размер памяти процесса в мегабайтах
+    """
+    with open("/proc/self/statm") as f:
+        rss = int(f.read().split()[1]) * resource.getpagesize()
+
+    return rss / 2**20
+
+
+def memory_usage():
+    """
+    Возвращает текущий и пиковый (за все время работы процесса) размер памяти процесса в мегабайтах
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return rss_usage(), peak / 2**20
+
+
+class ArtifactsReloader:
+    """
+    Класс для перезагрузки данных хранилища по запросу и при изменении файлов
+    """
+
+    def __init__(self, store, watch_interval=0.0, on_swap=None):
+
+        self.store = store
+        self.watch_interval = watch_interval
+        self.on_swap = on_swap
+        self._lock = asyncio.Lock()
+
+    async def reload(self):
+        """
+        Загружает новую версию данных в фоне и атомарно подменяет ей текущую
+        """
+        async with self._lock:
+            start = time.perf_counter()
+            rss_before = rss_usage()
+            # ru_maxrss - пик за все время работы процесса, поэтому пик во время загрузки
+            # новой версии (когда в памяти обе версии) замеряем периодически
+            peak = rss_before
+            build = asyncio.ensure_future(asyncio.to_thread(self.store.build_state))
+            while not build.done():
+                await asyncio.wait([build], timeout=RSS_SAMPLE_INTERVAL)
+                peak = max(peak, rss_usage())
+            state = build.result()
+            self.store.swap(state)
+            del state
+            if self.on_swap is not None:
+                self.on_swap()
+            gc.collect()
+            rss_after = rss_usage()
+            logger.info(
+                f"Reloaded {type(self.store).__name__} to version {self.store.version} "
+                f"in {time.perf_counter() - start:.2f}s, rss {rss_before:.0f}MB -> {rss_after:.0f}MB "
+                f"({rss_after - rss_before:+.0f}MB), peak during reload {peak:.0f}MB"
+            )
+
+        return self.store.version
+
+    async def watch(self):
+        """
+        Фоновая задача: перезагружает данные, когда файлы изменились и не менялись
+        в течение еще одного интервала опроса (чтобы не читать недописанные файлы)
+        """
+        loaded_stamp = self.store.artifacts_stamp()
+        pending_stamp = None
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                stamp = self.store.artifacts_stamp()
+                if stamp == loaded_stamp:
+                    pending_stamp = None
+                elif stamp == pending_stamp:
+                    await self.reload()
+                    loaded_stamp, pending_stamp = stamp, None
+                else:
+                    pending_stamp = stamp
+            except Exception as e:
+                logger.error(f"{e!r}, failed to reload {type(self.store).__name__}")
@@ -0,0 +1,379 @@
+"""
+Вспомогательный скрипт для воспроизводимого нагрузочного тестирования рекомендательного сервиса.
+
+Скрипт выполняет три шага:
+- генерирует синтетические файлы recommendations.parquet, similar.parquet и top_popular.parquet
+заданного размера в директории data_dir (и, при use_mmap, сконвертированные директории *.idx);
+- запускает три сервиса локально на отдельных портах (или только основной сервис во встроенном режиме),
+используя config.ini репозитория с подставленными адресами сервисов;
+- подает смешанную нагрузку из concurrency одновременных клиентов: добавление событий (/put)
+вперемешку с запросами оффлайн-, онлайн- и смешанных рекомендаций (и, если задано в --mix,
+рекомендаций по умолчанию - default); пользователи и объекты
+выбираются по распределению Ципфа (небольшая часть пользователей дает большую часть запросов).
+
+Результат - пропускная способность (RPS) и задержки p50/p95/p99 по каждому типу запросов -
+выводится в лог и сохраняется в JSON-файл, чтобы результаты разных запусков можно было сравнивать.
+
+Основные реализованные функции:
+- generate_artifacts() - генерация синтетических файлов с рекомендациями;
+- write_config() - config.ini с адресами запускаемых сервисов;
+- start_services() - запуск сервисов и ожидание их готовности;
+- run_workload() - подача смешанной нагрузки;
+- summarize() - расчет RPS и перцентилей задержек.
+
+Примеры запуска:
+python load_test.py --n_users 100000 --n_items 100000 --concurrency 32 --duration 30
+python load_test.py --mix put=0.1,offline=0.4,online=0.1,blended=0.4 --zipf 1.2 --output results.json
+python load_test.py --no_start --duration 60 (нагрузка на уже запущенные сервисы из config.ini)
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import subprocess
+import configparser
+import httpx
+import numpy as np
+import pandas as pd
+from sharding import HashRing, parse_urls
+
+
+logger = logging.getLogger("load_test_logs")
+
+# Директория репозитория (модули сервисов и config.ini)
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Типы запросов нагрузки: сервис, endpoint и параметры запроса
+WORKLOAD = {
+    "put": ("events", "/put"),
+    "offline": ("recommendations", "/recommendations_offline"),
+    "default": ("recommendations", "/recommendations_default"),
+    "online": ("recommendations", "/recommendations_online"),
+    "blended": ("recommendations", "/recommendations"),
+}
+
+
+def generate_artifacts(data_dir, n_users=100_000, n_items=100_000, n_recs=100, n_similar=10,
+                       n_top=1000, seed=0):
+    """
+    Генерирует синтетические файлы с рекомендациями в форматах, которые читают сервисы
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    recommendations = pd.DataFrame({
+        "user_id": np.repeat(np.arange(n_users, dtype=np.int64), n_recs),
+        "item_id": rng.integers(0, n_items, n_users * n_recs, dtype=np.int64),
+        "score": rng.random(n_users * n_recs, dtype=np.float32),
+        "rank": np.tile(np.arange(1, n_recs + 1, dtype=np.int32), n_users),
+    })
+    recommendations.to_parquet(os.path.join(data_dir, "recommendations.parquet"))
+
+    similar = pd.DataFrame({
+        "item_id_1": np.repeat(np.arange(n_items, dtype=np.int64), n_similar),
+        "item_id_2": rng.integers(0, n_items, n_items * n_similar, dtype=np.int64),
+        "score": rng.random(n_items * n_similar, dtype=np.float32),
+    })
+    similar.to_parquet(os.path.join(data_dir, "similar.parquet"))
+
+    top_popular = pd.DataFrame({
+        "item_id": rng.permutation(n_items)[:n_top].astype(np.int64),
+        "rank": np.arange(1, min(n_top, n_items) + 1, dtype=np.int32),
+    })
+    top_popular.to_parquet(os.path.join(data_dir, "top_popular.parquet"))
+
+    logger.info(f"Generated artifacts in {data_dir}: {n_users} users x {n_recs} recs, {n_items} items x {n_similar} similar")
+
+
+def write_config(data_dir, base_port, stores_mode="http"):
+    """
+    Копирует config.ini репозитория в data_dir, подставляя адреса сервисов на портах
+    base_port (основной), base_port + 10 (features) и base_port + 20 (events)
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO_DIR, "config.ini"))
+
+    recommendations_url = f"http://127.0.0.1:{base_port}"
+    config["urls"]["recommendations_url"] = recommendations_url
+    config["urls"]["features_store_url"] = f"http://127.0.0.1:{base_port + 10}"
+    if stores_mode == "embedded":
+        config["urls"]["events_store_url"] = f"{recommendations_url}/events"
+    else:
+        config["urls"]["events_store_url"] = f"http://127.0.0.1:{base_port + 20}"
+    # запускается один экземпляр events_service
+    config["urls"]["events_store_shards"] = ""
+    config["recommendations"]["stores_mode"] = stores_mode
+
+    with open(os.path.join(data_dir, "config.ini"), "w") as f:
+        config.write(f)
+
+    return {name: url.strip('"') for name, url in config["urls"].items()}
+
+
+def wait_ready(url, process, timeout=300.0):
+    """
+    Ждет, пока сервис начнет отвечать на запросы
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Service at {url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url + "/", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+
+    raise TimeoutError(f"Service at {url} is not ready after {timeout}s")
+
+
+def build_artifacts(data_dir):
+    """
+    Конвертирует файлы с рекомендациями в data_dir в директории *.idx (см. build_artifacts.py);
+    конвертация выполняется в отдельном процессе с текущей директорией data_dir,
+    т.к. build_artifacts.py по умолчанию ищет файлы в текущей директории
+    """
+    cmd = [sys.executable, os.path.join(REPO_DIR, "build_artifacts.py")]
+    subprocess.run(cmd, cwd=data_dir, check=True)
+
+
+def start_services(data_dir, urls, workers=1):
+    """
+    Запускает сервисы в data_dir (файлы с рекомендациями и config.ini, записанный write_config,
+    читаются оттуда) и возвращает их процессы; workers воркеров запускается только у сервисов
+    без общего состояния (основной сервис в режиме http и features_service): events_service
+    и основной сервис во встроенном режиме хранят события в памяти процесса, поэтому у каждого
+    воркера было бы свое хранилище
+    """
+    stores_mode = "embedded" if urls["events_store_url"].startswith(urls["recommendations_url"]) else "http"
+    if stores_mode == "embedded":
+        services = [("recommendations_service", urls["recommendations_url"], 1)]
+    else:
+        services = [
+            ("recommendations_service", urls["recommendations_url"], workers),
+            ("features_service", urls["features_store_url"], workers),
+            ("events_service", urls["events_store_url"], 1),
+        ]
+    if workers > 1 and stores_mode == "embedded":
+        logger.warning("Embedded mode keeps events in process memory, starting a single worker")
+
+    processes = []
+    for module, url, n_workers in services:
+        port = url.rsplit(":", 1)[1]
+        cmd = [sys.executable, "-m", "uvicorn", f"{module}:app", "--app-dir", REPO_DIR,
+               "--port", port, "--workers", str(n_workers), "--log-level", "warning"]
+        processes.append(subprocess.Popen(cmd, cwd=data_dir))
+    try:
+        for (module, url, _), process in zip(services, processes):
+            wait_ready(url, process)
+            logger.info(f"Started {module} at {url}")
+    except Exception:
+        stop_services(processes)
+        raise
+
+    return processes
+
+
+def stop_services(processes):
+    """
+    Останавливает запущенные сервисы
+    """
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def zipf_sampler(n, s, rng):
+    """
+    Возвращает функцию, выбирающую size идентификаторов из 0..n-1 по распределению Ципфа
+    с показателем s (идентификаторы перемешаны, чтобы популярные не шли подряд)
+    """
+    cdf = np.cumsum(1 / np.arange(1, n + 1) ** s)
+    cdf /= cdf[-1]
+    ids = rng.permutation(n)
+
+    return lambda size: ids[np.minimum(np.searchsorted(cdf, rng.random(size)), n - 1)]
+
+
+def request_url(urls, events_ring, name, user_id):
+    """
+    Возвращает адрес запроса типа name для пользователя user_id:
+    события отправляются на шард пользователя (как в основном сервисе, см. sharding.py)
+    """
+    service, endpoint = WORKLOAD[name]
+    if service == "events":
+        return events_ring.node(user_id) + endpoint
+
+    return urls["recommendations_url"] + endpoint
+
+
+async def run_workload(urls, mix, concurrency=32, duration=30.0, warmup=5.0, n_users=100_000,
+                       n_items=100_000, zipf=1.1, k=100, seed=0, virtual_nodes=100):
+    """
+    Подает смешанную нагрузку в течение warmup + duration секунд и возвращает задержки
+    (в миллисекундах) и кол-во ошибок по каждому типу запросов; запросы во время разогрева не учитываются
+    """
+    rng = np.random.default_rng(seed)
+    sample_users = zipf_sampler(n_users, zipf, rng)
+    sample_items = zipf_sampler(n_items, zipf, rng)
+    names = list(mix)
+    probs = np.array([mix[name] for name in names], dtype=np.float64)
+    probs /= probs.sum()
+
+    events_ring = HashRing(parse_urls(urls.get("events_store_shards", "")) or [urls["events_store_url"]], virtual_nodes)
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    started_at = time.perf_counter()
+    measure_from = started_at + warmup
+    deadline = measure_from + duration
+
+    async def worker(client):
+        # Запросы выбираются заранее пачками, чтобы не тратить время клиента на генерацию
+        while time.perf_counter() < deadline:
+            kinds = rng.choice(len(names), 256, p=probs)
+            users, items = sample_users(256).tolist(), sample_items(256).tolist()
+            for kind, user_id, item_id in zip(kinds.tolist(), users, items):
+                name = names[kind]
+                params = {"user_id": user_id, "item_id": item_id} if name == "put" else {"user_id": user_id, "k": k}
+                start = time.perf_counter()
+                try:
+                    resp = await client.post(request_url(urls, events_ring, name, user_id), params=params)
+                    resp.raise_for_status()
+                    failed = False
+                except httpx.HTTPError:
+                    failed = True
+                end = time.perf_counter()
+                if end > deadline:
+                    return
+                if start >= measure_from:
+                    if failed:
+                        errors[name] += 1
+                    else:
+                        latencies[name].append((end - start) * 1e3)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+
+    return latencies, errors
+
+
+def summarize(latencies, errors, duration):
+    """
+    Возвращает RPS и перцентили задержек (в миллисекундах) по каждому типу запросов и в целом
+    """
+    def stats(values, n_errors):
+        values = np.asarray(values)
+        result = {"requests": len(values), "errors": n_errors, "rps": round(len(values) / duration, 1)}
+        if len(values) > 0:
+            for q in (50, 95, 99):
+                result[f"p{q}_ms"] = round(float(np.percentile(values, q)), 3)
+            result["mean_ms"] = round(float(values.mean()), 3)
+        return result
+
+    summary = {name: stats(latencies[name], errors[name]) for name in latencies}
+    summary["total"] = stats(np.concatenate([np.asarray(v) for v in latencies.values()] + [np.empty(0)]),
+                             sum(errors.values()))
+
+    return summary
+
+
+def git_revision():
+    """
+    Возвращает текущий коммит репозитория (для сравнения результатов разных версий)
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def parse_mix(mix):
+    """
+    Разбирает строку вида put=0.2,offline=0.3 в словарь долей запросов
+    """
+    result = {}
+    for part in mix.split(","):
+        name, share = part.split("=")
+        if name not in WORKLOAD:
+            raise ValueError(f"Unknown request type {name}, expected one of {list(WORKLOAD)}")
+        result[name] = float(share)
+
+    return result
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(module)s, %(funcName)s, %(message)s')
+    # httpx логирует каждый запрос, что заметно замедляет клиента
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default="load_test_data")
+    parser.add_argument('--n_users', type=int, default=100_000)
+    parser.add_argument('--n_items', type=int, default=100_000)
+    parser.add_argument('--n_recs', type=int, default=100)
+    parser.add_argument('--n_similar', type=int, default=10)
+    parser.add_argument('--use_existing_data', action='store_true')
+    parser.add_argument('--no_start', action='store_true')
+    parser.add_argument('--stores_mode', default="http")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--base_port', type=int, default=18000)
+    parser.add_argument('--mix', default="put=0.2,offline=0.3,online=0.2,blended=0.3")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--warmup', type=float, default=5.0)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default="load_test_results.json")
+    namespace = parser.parse_args()
+
+    mix = parse_mix(namespace.mix)
+    processes = []
+    config = configparser.ConfigParser()
+    if namespace.no_start:
+        config.read("config.ini")
+        urls = {name: url.strip('"') for name, url in config["urls"].items()}
+    else:
+        if not namespace.use_existing_data:
+            generate_artifacts(namespace.data_dir, namespace.n_users, namespace.n_items,
+                               namespace.n_recs, namespace.n_similar, seed=namespace.seed)
+        urls = write_config(namespace.data_dir, namespace.base_port, namespace.stores_mode)
+        if not namespace.use_existing_data:
+            build_artifacts(namespace.data_dir)
+        processes = start_services(namespace.data_dir, urls, namespace.workers)
+        config.read(os.path.join(namespace.data_dir, "config.ini"))
+    virtual_nodes = config.getint("events", "virtual_nodes", fallback=100)
+
+    try:
+        latencies, errors = asyncio.run(run_workload(
+            urls, mix, namespace.concurrency, namespace.duration, namespace.warmup,
+            namespace.n_users, namespace.n_items, namespace.zipf, namespace.k, namespace.seed, virtual_nodes,
+        ))
+    finally:
+        stop_services(processes)
+
+    summary = summarize(latencies, errors, namespace.duration)
+    for name, stats in summary.items():
+        logger.info(f"{name:<10} " + " ".join(f"{key}={value}" for key, value in stats.items()))
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "params": vars(namespace),
+        "results": summary,
+    }
+    with open(namespace.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved results to {namespace.output}")
@@ -0,0 +1,265 @@
+"""
+Вспомогательный модуль для сбора метрик сервисов в текстовом формате Prometheus (запрос /metrics).
+
+Основные классы и функции:
+- Counter, Histogram - счетчики и гистограммы с метками (значения меток передаются позиционно);
+- CallbackMetric - метрика, значение которой вычисляется при каждом запросе /metrics
+(размеры загруженных данных, память процесса, счетчики из _stats);
+- MetricsMiddleware - ASGI-middleware, считающее запросы и их длительность по каждому endpoint;
+- stage() - замер длительности этапа обработки запроса (поиск по индексу, обращение к хранилищам,
+смешивание, сериализация), результат попадает в гистограмму stage_duration_seconds;
+- encoded_response() - сериализация ответа (JSON или двоичный формат, см. encoding.py) с замером длительности;
+- render() - формирование ответа /metrics.
+
+Все метрики регистрируются в общем реестре REGISTRY, поэтому во встроенном режиме
+(stores_mode = embedded) метрики всех трех сервисов отдаются одним запросом /metrics.
+Запись метрики - это несколько операций со словарем и списком без блокировок
+(сервисы однопоточные, запросы обрабатываются в одном цикле событий).
+"""
+
+import time
+from bisect import bisect_left
+from fastapi.responses import PlainTextResponse
+from hot_reload import memory_usage
+from encoding import encode_response
+
+
+# Границы корзин гистограмм (в секундах) для длительности запросов и этапов их обработки
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25)
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    """
+    Возвращает метки в формате {name="value",...}
+    """
+    labels = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Registry:
+    """
+    Реестр метрик
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Регистрирует метрику; если метрика с таким именем уже есть, возвращает ее
+        (сервисы, запущенные в одном процессе, используют общие метрики)
+        """
+        return self._metrics.setdefault(metric.name, metric)
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """
+        Возвращает все метрики в текстовом формате Prometheus
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """
+    Счетчик с метками
+    """
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+
+class Histogram:
+    """
+    Гистограмма с метками: кол-во наблюдений по корзинам, их сумма и общее кол-во
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # метки -> [кол-во по корзинам (последняя - +Inf), сумма]
+        self._values = {}
+
+    def observe(self, value, *labelvalues):
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def get(self, *labelvalues):
+        """
+        Возвращает кол-во и сумму наблюдений
+        """
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            return 0, 0.0
+
+        return sum(entry[0]), entry[1]
+
+    def samples(self):
+        for labelvalues, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric:
+    """
+    Метрика, значение которой вычисляет функция fn при каждом запросе /metrics;
+    fn возвращает число или словарь {кортеж значений меток: число}
+    """
+
+    def __init__(self, name, help, fn, labelnames=(), type="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.type = type
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelvalues, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+
+def memory_bytes():
+    """
+    Возвращает текущий и пиковый размер памяти процесса в байтах
+    """
+    rss, peak = memory_usage()
+
+    return {("rss",): int(rss * 2**20), ("peak",): int(peak * 2**20)}
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=REQUEST_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+def gauge(name, help, fn, labelnames=()):
+    return REGISTRY.register(CallbackMetric(name, help, fn, labelnames))
+
+
+# Общие метрики процесса, запросов и этапов их обработки
+process_memory = gauge("process_memory_bytes", "Process memory usage", memory_bytes, ("kind",))
+requests_total = counter(
+    "http_requests_total", "Total HTTP requests", ("service", "endpoint", "status")
+)
+request_duration = histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("service", "endpoint")
+)
+stage_duration = histogram(
+    "stage_duration_seconds", "Latency of request processing stages", ("service", "stage"), STAGE_BUCKETS
+)
+
+
+class stage:
+    """
+    Контекстный менеджер для замера длительности этапа обработки запроса:
+    with stage("recommendations", "index_lookup"): ...
+    """
+    __slots__ = ("labelvalues", "started_at")
+
+    def __init__(self, service, name):
+        self.labelvalues = (service, name)
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_duration.observe(time.perf_counter() - self.started_at, *self.labelvalues)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware, считающее запросы и их длительность по каждому endpoint сервиса service
+    (endpoint - шаблон пути маршрута, например /recommendations)
+    """
+
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        root_path = scope.get("root_path", "")
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Запросы к вспомогательным сервисам, подключенным через app.mount (встроенный режим),
+            # учитывает middleware вспомогательного сервиса, а не основного
+            if scope.get("root_path", "") == root_path:
+                route = scope.get("route")
+                endpoint = route.path if route is not None else "unmatched"
+                request_duration.observe(time.perf_counter() - started_at, self.service, endpoint)
+                requests_total.inc(self.service, endpoint, str(status))
+
+
+def encoded_response(service, content, accept=None):
+    """
+    Сериализует ответ в формате, запрошенном в заголовке Accept,
+    замеряя длительность сериализации как этап serialization
+    """
+    with stage(service, "serialization"):
+        return encode_response(content, accept)
+
+
+def render():
+    """
+    Возвращает ответ /metrics
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,508 @@
+"""
+Вспомогательный скрипт для расчета оффлайн-рекомендаций и связанных с ними файлов вместо шагов
+ноутбука recommendations.ipynb (начиная с готовых items.parquet и events.parquet).
+
+Результаты совпадают с ноутбуком:
+- top_popular.parquet - топ популярных треков (рекомендации по умолчанию);
+- genres.parquet и all_items_genres_csr.npz - жанры и sparse-матрица "трек -> доли жанров";
+- models/als_model.pkl - ALS-модель (обучается, если файла нет или задан --fit);
+- personal_als.parquet - top-50 треков ALS-модели для каждого пользователя;
+- similar.parquet - top-10 похожих треков по косинусной близости факторов ALS-модели;
+- candidates_for_train.parquet - кандидаты с признаками для ранжирующей модели;
+- models/cb_model.cbm - ранжирующая модель CatBoost (обучается, если файла нет или задан --fit);
+- recommendations.parquet - итоговые рекомендации для пользователей из тестовой выборки.
+
+В отличие от ноутбука, таблицы событий и рекомендаций не собираются целиком в pandas:
+- события читаются из parquet по частям, а в памяти остается только sparse-матрица
+"пользователь -> трек" (кол-во прослушиваний в train) в формате CSR;
+- матрицы жанров строятся векторно через pyarrow (list_flatten, dictionary_encode) вместо iterrows;
+- рекомендации ALS, признаки кандидатов и похожие треки считаются по частям из chunk_size
+пользователей (треков) в пуле процессов; факторы модели, матрица событий и признаки жанров
+сохраняются в work_dir в виде .npy-файлов и отображаются воркерами в память (одна копия на все процессы);
+- результаты записываются в parquet-файлы по мере расчета группами строк (row groups) через
+pq.ParquetWriter, поэтому пиковая память определяется размером части, а не всей таблицы.
+
+Для каждого этапа в лог и в JSON-отчет (report) записываются длительность, текущий и пиковый
+размер памяти основного процесса и пиковый размер памяти завершившихся воркеров.
+
+Пример запуска (в папке с items.parquet и events.parquet):
+python offline_pipeline.py --workers 8 --chunk_size 64
+python offline_pipeline.py --fit --report pipeline_report.json
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import resource
+import contextlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import scipy.sparse
+
+from csr_index import save_arrays, load_arrays
+from hot_reload import memory_usage
+
+
+logger = logging.getLogger("uvicorn.error")
+
+# Параметры из ноутбука
+SPLIT_DATE = "2022-12-16"
+ALS_PARAMS = dict(factors=50, iterations=50, regularization=0.05, random_state=0)
+CB_PARAMS = dict(iterations=500, learning_rate=0.1, depth=6, loss_function='Logloss', verbose=50, random_seed=0)
+GENRES_TOP_K = 10
+
+# Массивы из work_dir, отображенные в память воркера
+_arrays = {}
+
+
+@contextlib.contextmanager
+def run_stage(report, name):
+    """
+    Замеряет длительность этапа и размер памяти после него
+    """
+    logger.info(f"Stage {name} started")
+    start = time.perf_counter()
+    yield
+    rss, peak = memory_usage()
+    workers_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    report[name] = {
+        "seconds": round(time.perf_counter() - start, 3),
+        "rss_mb": round(rss, 1),
+        "peak_rss_mb": round(peak, 1),
+        "workers_peak_rss_mb": round(workers_peak, 1),
+    }
+    logger.info(f"Stage {name} finished: {report[name]}")
+
+
+class ParquetSink:
+    """
+    Запись таблицы в parquet-файл по частям: части копятся в буфере и записываются
+    отдельной группой строк, когда в буфере набирается row_group_size строк
+    (часть целиком попадает в одну группу строк)
+    """
+
+    def __init__(self, path, row_group_size=1_000_000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self._writer = None
+        self._buffer = []
+        self._buffered_rows = 0
+        self.rows = 0
+
+    def write(self, table):
+        if isinstance(table, (dict, pd.DataFrame)):
+            table = pa.table(table) if isinstance(table, dict) else pa.Table.from_pandas(table, preserve_index=False)
+        self._buffer.append(table)
+        self._buffered_rows += table.num_rows
+        if self._buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        table = pa.concat_tables(self._buffer)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table, row_group_size=table.num_rows)
+        self.rows += table.num_rows
+        self._buffer, self._buffered_rows = [], 0
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_chunks(n, chunk_size):
+    """
+    Возвращает границы частей [start, stop) диапазона 0..n
+    """
+    for start in range(0, n, chunk_size):
+        yield start, min(start + chunk_size, n)
+
+
+def _init_worker(work_dir):
+    """
+    Отображает в память массивы из work_dir и ограничивает BLAS одним потоком
+    (параллелизм обеспечивается кол-вом процессов)
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    for name in os.listdir(work_dir):
+        if os.path.isdir(os.path.join(work_dir, name)):
+            _arrays[name] = load_arrays(os.path.join(work_dir, name))
+
+
+def map_chunks(func, tasks, work_dir, workers):
+    """
+    Выполняет func для каждой части в пуле из workers процессов
+    и возвращает результаты в исходном порядке по мере готовности
+    """
+    if workers <= 1:
+        _init_worker(work_dir)
+        yield from map(func, tasks)
+        return
+    with multiprocessing.Pool(workers, _init_worker, (work_dir,)) as pool:
+        yield from pool.imap(func, tasks)
+
+
+def top_n(scores, n):
+    """
+    Возвращает номера n наибольших элементов каждой строки scores по убыванию
+    """
+    n = min(n, scores.shape[1])
+    top = np.empty((len(scores), n), dtype=np.int64)
+    for row, row_scores in enumerate(scores):
+        idx = np.argpartition(row_scores, len(row_scores) - n)[len(row_scores) - n:]
+        top[row] = idx[np.argsort(-row_scores[idx], kind="stable")]
+
+    return top
+
+
+def read_events(events_path, item_ids, split_date=SPLIT_DATE, batch_size=5_000_000):
+    """
+    Читает события по частям, делит их по дате на train и test и возвращает
+    отсортированные user_id (как LabelEncoder в ноутбуке), CSR-матрицу кол-ва прослушиваний
+    в train (пользователи x треки) и номера пользователей из test
+    """
+    split = pd.Timestamp(split_date).value // 1000
+    user_parts, train_user_parts, train_item_parts, test_user_parts = [], [], [], []
+    for batch in pq.ParquetFile(events_path).iter_batches(batch_size, columns=["user_id", "item_id", "started_at"]):
+        user_ids = batch.column("user_id").to_numpy()
+        started_at = batch.column("started_at").cast(pa.timestamp("us")).cast(pa.int64()).to_numpy()
+        is_train = started_at < split
+        user_parts.append(np.unique(user_ids))
+        train_user_parts.append(user_ids[is_train])
+        train_item_parts.append(batch.column("item_id").to_numpy()[is_train])
+        test_user_parts.append(np.unique(user_ids[~is_train]))
+
+    user_ids = np.unique(np.concatenate(user_parts))
+    rows = np.searchsorted(user_ids, np.concatenate(train_user_parts)).astype(np.int32)
+    del train_user_parts
+    cols = np.searchsorted(item_ids, np.concatenate(train_item_parts)).astype(np.int32)
+    del train_item_parts
+    user_items = scipy.sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(user_ids), len(item_ids)))
+    user_items.sum_duplicates()
+    test_users = np.searchsorted(user_ids, np.unique(np.concatenate(test_user_parts)))
+    logger.info(f"Events: {len(rows)} in train, {len(user_ids)} users, {len(test_users)} users in test")
+
+    return user_ids, user_items, test_users
+
+
+def build_top_popular(items_path, user_items, item_ids, n=100):
+    """
+    Возвращает n треков с наибольшим кол-вом прослушиваний в train
+    (при равенстве - с наибольшим кол-вом уникальных пользователей)
+    """
+    plays = np.bincount(user_items.indices, weights=user_items.data, minlength=len(item_ids)).astype(np.int64)
+    users = np.bincount(user_items.indices, minlength=len(item_ids))
+    played = np.flatnonzero(plays)
+    top = played[np.lexsort((-users[played], -plays[played]))][:n]
+
+    top_popular = pd.DataFrame({"item_id": item_ids[top], "plays": plays[top], "users": users[top]})
+    meta = pq.read_table(items_path, columns=["item_id", "name", "genres", "artists", "albums"],
+                         filters=[("item_id", "in", top_popular["item_id"].tolist())]).to_pandas()
+    top_popular = top_popular.merge(meta, how="inner", on="item_id")
+    top_popular = top_popular.reset_index().rename(columns={"index": "rank"})
+    top_popular["rank"] += 1
+
+    return top_popular
+
+
+def build_genres(items_path):
+    """
+    Возвращает отсортированные item_id, таблицу жанров (как get_genres в ноутбуке:
+    genre_id в порядке первого появления жанра, кол-во треков и доля) и CSR-матрицу
+    "трек -> доли жанров" (как get_item2genre_matrix: строки в порядке item_id, нормировка L1)
+    """
+    table = pq.read_table(items_path, columns=["item_id", "genres"])
+    item_ids = table.column("item_id").to_numpy()
+    order = np.argsort(item_ids, kind="stable")
+    genres_list = table.column("genres").combine_chunks()
+
+    flat = pc.list_flatten(genres_list).dictionary_encode()
+    genre_codes = flat.indices.to_numpy(zero_copy_only=False)
+    rows = np.empty(len(item_ids), dtype=np.int64)
+    rows[order] = np.arange(len(item_ids))
+    rows = rows[pc.list_parent_indices(genres_list).to_numpy(zero_copy_only=False)]
+
+    genres = pd.DataFrame({
+        "name": flat.dictionary.to_pandas(),
+        "items_count": np.bincount(genre_codes, minlength=len(flat.dictionary)),
+    })
+    genres.index.name = "genre_id"
+    genres["score"] = genres["items_count"] / genres["items_count"].sum()
+
+    genres_csr = scipy.sparse.csr_matrix(
+        (np.ones(len(genre_codes)), (rows, genre_codes)), shape=(len(item_ids), len(genres)))
+    genres_csr.sum_duplicates()
+    # Нормируем, чтобы сумма долей жанров трека была равна 1
+    row_sums = np.asarray(genres_csr.sum(axis=1)).ravel()
+    genres_csr.data /= np.repeat(np.where(row_sums == 0, 1, row_sums), np.diff(genres_csr.indptr))
+
+    return item_ids[order], genres, genres_csr
+
+
+def build_item_genres(genres, genres_csr, top_k=GENRES_TOP_K):
+    """
+    Возвращает доли топ-k жанров и всех остальных жанров для каждого трека и имена колонок
+    """
+    top_idx = genres.sort_values("items_count", ascending=False).head(top_k).index.to_numpy()
+    others_idx = np.setdiff1d(genres.index.to_numpy(), top_idx)
+    features = np.hstack([
+        genres_csr[:, top_idx].toarray(),
+        np.asarray(genres_csr[:, others_idx].sum(axis=1)),
+    ])
+
+    return features, [f"genre_{id}" for id in top_idx] + ["genre_others"]
+
+
+def fit_als(user_items, model_path, fit=False):
+    """
+    Загружает ALS-модель из файла или обучает ее на матрице событий train
+    """
+    import joblib
+
+    if os.path.exists(model_path) and not fit:
+        with open(model_path, "rb") as fd:
+            als_model = joblib.load(fd)
+    else:
+        from implicit.als import AlternatingLeastSquares
+
+        als_model = AlternatingLeastSquares(**ALS_PARAMS)
+        als_model.fit(user_items.astype(np.int8))
+        os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+        with open(model_path, "wb") as fd:
+            joblib.dump(als_model, fd)
+    if hasattr(als_model, "to_cpu"):
+        als_model = als_model.to_cpu()
+
+    return als_model
+
+
+def _candidates_chunk(task):
+    """
+    Возвращает top-n треков ALS-модели для пользователей [start, stop) и признаки этих кандидатов
+    """
+    start, stop, n = task
+    als, train, item_genres = _arrays["als"], _arrays["train"], _arrays["item_genres"]
+
+    scores = np.asarray(als["user_factors"][start:stop]) @ np.asarray(als["item_factors"]).T
+    top = top_n(scores, n)
+    users = np.repeat(np.arange(start, stop), top.shape[1])
+    items = top.ravel()
+    als_scores = np.take_along_axis(scores, top, axis=1).ravel().astype(np.float64)
+
+    # События пользователей части: кол-во прослушиваний каждого трека
+    indptr = np.asarray(train["indptr"][start:stop + 1])
+    user_items = scipy.sparse.csr_matrix(
+        (train["data"][indptr[0]:indptr[-1]], train["indices"][indptr[0]:indptr[-1]], indptr - indptr[0]),
+        shape=(stop - start, len(als["item_factors"])))
+
+    # target как в merge с events_train: 1, если трек прослушан (строка повторяется
+    # по кол-ву прослушиваний), иначе 0
+    counts = np.asarray(user_items[users - start, items]).ravel()
+    repeats = np.maximum(counts, 1)
+
+    # Признаки пользователя: кол-во прослушиваний и средние доли жанров прослушанных треков
+    # (NaN для пользователей без событий в train, как после merge с how="left")
+    played = np.asarray(user_items.sum(axis=1), dtype=np.float64).ravel()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        genres = (user_items @ np.asarray(item_genres["features"])) / played[:, None]
+    played[played == 0] = np.nan
+
+    personal = {"user": users, "item": items, "score": als_scores}
+    candidates = {
+        "user": np.repeat(users, repeats),
+        "item": np.repeat(items, repeats),
+        "als_score": np.repeat(als_scores, repeats),
+        "target": np.repeat((counts > 0).astype(np.int64), repeats),
+        "tracks_played_by_user": np.repeat(played[users - start], repeats),
+        "genres": np.repeat(genres[users - start], repeats, axis=0),
+    }
+
+    return personal, candidates
+
+
+def _similar_chunk(task):
+    """
+    Возвращает top-n похожих треков для треков из train с номерами [start, stop)
+    по косинусной близости факторов (как similar_items в implicit), без самого трека
+    """
+    start, stop, n = task
+    als, train = _arrays["als"], _arrays["train"]
+    items = np.asarray(train["items"][start:stop])
+    item_factors, item_norms = als["item_factors"], als["item_norms"]
+
+    scores = np.asarray(item_factors[items]) @ np.asarray(item_factors).T
+    scores /= item_norms[None, :]
+    scores /= item_norms[items][:, None]
+    top = top_n(scores, n + 1)
+    items_1 = np.repeat(items, top.shape[1])
+    items_2 = top.ravel()
+    sim_scores = np.take_along_axis(scores, top, axis=1).ravel().astype(np.float64)
+    mask = items_1 != items_2
+
+    return items_1[mask], items_2[mask], sim_scores[mask]
+
+
+def rank_candidates(candidates_path, recommendations_path, cb_model, features, test_user_ids,
+                    max_recommendations_per_user=50, row_group_size=1_000_000):
+    """
+    Ранжирует кандидатов пользователей из тестовой выборки по частям (группам строк файла,
+    каждая из которых содержит всех кандидатов своих пользователей) и записывает рекомендации
+    """
+    from catboost import Pool
+
+    parquet_file = pq.ParquetFile(candidates_path)
+    with ParquetSink(recommendations_path, row_group_size) as sink:
+        for i in range(parquet_file.num_row_groups):
+            candidates = parquet_file.read_row_group(i).to_pandas()
+            candidates = candidates[np.isin(candidates["user_id"].to_numpy(), test_user_ids)]
+            if candidates.empty:
+                continue
+            cb_score = cb_model.predict_proba(Pool(data=candidates[features]))[:, 1]
+
+            # Для каждого пользователя проставляем rank, начиная с 1 - это максимальный score
+            user_ids = candidates["user_id"].to_numpy()
+            order = np.lexsort((-cb_score, user_ids))
+            candidates = candidates.iloc[order].drop(columns="target")
+            candidates["score"] = cb_score[order]
+            _, starts, counts = np.unique(user_ids[order], return_index=True, return_counts=True)
+            candidates["rank"] = np.arange(len(candidates)) - np.repeat(starts, counts) + 1
+            sink.write(candidates[candidates["rank"] <= max_recommendations_per_user])
+
+    return sink.rows
+
+
+def run_pipeline(items_path="items.parquet", events_path="events.parquet", output_dir=".",
+                 work_dir="pipeline_work", models_dir="models", split_date=SPLIT_DATE,
+                 workers=1, chunk_size=64, row_group_size=1_000_000, n_recommendations=50,
+                 n_similar=10, n_top_popular=100, fit=False):
+    """
+    Выполняет все этапы расчета и возвращает отчет с длительностью и памятью каждого этапа
+    """
+    report = {}
+    output = lambda name: os.path.join(output_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(work_dir, exist_ok=True)
+
+    with run_stage(report, "genres"):
+        item_ids, genres, genres_csr = build_genres(items_path)
+        genres.to_parquet(output("genres.parquet"))
+        scipy.sparse.save_npz(output("all_items_genres_csr.npz"), genres_csr)
+        item_genres, genre_columns = build_item_genres(genres, genres_csr)
+        save_arrays(os.path.join(work_dir, "item_genres"), {"features": item_genres})
+        del genres, genres_csr, item_genres
+
+    with run_stage(report, "events"):
+        user_ids, user_items, test_users = read_events(events_path, item_ids, split_date)
+        train_items = np.flatnonzero(np.bincount(user_items.indices, minlength=len(item_ids)))
+        save_arrays(os.path.join(work_dir, "train"), {
+            "indptr": user_items.indptr, "indices": user_items.indices,
+            "data": user_items.data, "items": train_items,
+        })
+
+    with run_stage(report, "top_popular"):
+        build_top_popular(items_path, user_items, item_ids, n_top_popular).to_parquet(output("top_popular.parquet"))
+
+    with run_stage(report, "als_fit"):
+        als_model = fit_als(user_items, os.path.join(models_dir, "als_model.pkl"), fit)
+        item_norms = np.linalg.norm(als_model.item_factors, axis=-1)
+        item_norms[item_norms == 0] = 1e-10
+        save_arrays(os.path.join(work_dir, "als"), {
+            "user_factors": als_model.user_factors, "item_factors": als_model.item_factors,
+            "item_norms": item_norms,
+        })
+        del als_model, user_items, item_norms
+
+    with run_stage(report, "candidates"):
+        tasks = ((start, stop, n_recommendations) for start, stop in iter_chunks(len(user_ids), chunk_size))
+        with ParquetSink(output("personal_als.parquet"), row_group_size) as personal_sink, \
+                ParquetSink(output("candidates_for_train.parquet"), row_group_size) as candidates_sink:
+            for personal, candidates in map_chunks(_candidates_chunk, tasks, work_dir, workers):
+                personal_sink.write({
+                    "user_id": user_ids[personal["user"]],
+                    "item_id": item_ids[personal["item"]],
+                    "score": personal["score"],
+                })
+                columns = {
+                    "user_id": user_ids[candidates["user"]],
+                    "item_id": item_ids[candidates["item"]],
+                    "als_score": candidates["als_score"],
+                    "target": candidates["target"],
+                    "tracks_played_by_user": candidates["tracks_played_by_user"],
+                }
+                columns.update(zip(genre_columns, candidates["genres"].T))
+                candidates_sink.write(columns)
+
+    with run_stage(report, "similar"):
+        tasks = ((start, stop, n_similar) for start, stop in iter_chunks(len(train_items), chunk_size))
+        with ParquetSink(output("similar.parquet"), row_group_size) as sink:
+            for items_1, items_2, scores in map_chunks(_similar_chunk, tasks, work_dir, workers):
+                sink.write({"score": scores, "item_id_1": item_ids[items_1], "item_id_2": item_ids[items_2]})
+
+    with run_stage(report, "cb_fit"):
+        from catboost import CatBoostClassifier, Pool
+
+        cb_model_path = os.path.join(models_dir, "cb_model.cbm")
+        features = ["als_score", "tracks_played_by_user"] + genre_columns
+        cb_model = CatBoostClassifier()
+        if os.path.exists(cb_model_path) and not fit:
+            cb_model.load_model(cb_model_path)
+        else:
+            # Ранжирующая модель, как в ноутбуке, обучается на всех кандидатах сразу
+            candidates_for_train = pd.read_parquet(output("candidates_for_train.parquet"),
+                                                   columns=features + ["target"])
+            cb_model = CatBoostClassifier(**CB_PARAMS)
+            cb_model.fit(Pool(data=candidates_for_train[features], label=candidates_for_train["target"]))
+            cb_model.save_model(cb_model_path)
+            del candidates_for_train
+
+    with run_stage(report, "ranking"):
+        rank_candidates(output("candidates_for_train.parquet"), output("recommendations.parquet"),
+                        cb_model, features, user_ids[test_users], n_recommendations, row_group_size)
+
+    return report
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(module)s, %(funcName)s, %(message)s')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', default="items.parquet")
+    parser.add_argument('--events', default="events.parquet")
+    parser.add_argument('--output_dir', default=".")
+    parser.add_argument('--work_dir', default="pipeline_work")
+    parser.add_argument('--models_dir', default="models")
+    parser.add_argument('--split_date', default=SPLIT_DATE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--row_group_size', type=int, default=1_000_000)
+    parser.add_argument('--fit', action='store_true', help="обучить модели заново, даже если файлы моделей есть")
+    parser.add_argument('--report', default="pipeline_report.json")
+    namespace = parser.parse_args()
+
+    report = run_pipeline(namespace.items, namespace.events, namespace.output_dir, namespace.work_dir,
+                          namespace.models_dir, namespace.split_date, namespace.workers,
+                          namespace.chunk_size, namespace.row_group_size, fit=namespace.fit)
+    with open(namespace.report, "w") as f:
+        json.dump(report, f, indent=2)
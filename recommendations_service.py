@@ -5,17 +5,39 @@
 - /recommendations_default - получение рекомендаций по умолчанию из числа топ-треков,
 - /recommendations_offline - получение персональных рекомендаций только по оффлайн-истории пользователя,
 - /recommendations_online - получение персональных рекомендаций только по онлайн-истории пользователя,
-- /recommendations - получение смешанных рекомендаций по оффлайн- и онлайн-истории пользователя.
+- /recommendations - получение смешанных рекомендаций по оффлайн- и онлайн-истории пользователя,
+- /recommendations_batch - получение оффлайн-рекомендаций для многих пользователей одним запросом,
+- /admin/reload - перезагрузка файлов с рекомендациями без остановки сервиса,
+- /metrics - метрики сервиса в формате Prometheus.
 
 Для запуска и тестирования см. инструкции в файле README.md
 """
 
+import io
+import os
+import time
+import tempfile
+import asyncio
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
+import numpy as np
 import pandas as pd
-import requests
+import pyarrow as pa
 import configparser
+from csr_index import index_path
+from artifacts import build_recommendations, open_recommendations
+from store_clients import HttpStoresClient, EmbeddedStoresClient
+from hot_reload import ArtifactsReloader, artifacts_stamp, artifacts_version
+from blending import blend
+from response_cache import ResponseCache
+from als_foldin import ALSFoldIn
+from seen_items import SeenItems
+from sharding import parse_urls
+import metrics
+from metrics import stage, encoded_response
+from encoding import PrecomputedResponse
 
 
 # Создаем логгер
@@ -26,10 +48,86 @@ config = configparser.ConfigParser()
 config.read("config.ini")  
 
 # Читаем url-адреса двух вспомогательных сервисов из конфигурационного файла
+# (кавычки вокруг значений, если они есть в config.ini, отбрасываем)
 # Вспомогательный сервис для получения рекомендаций по умолчанию на основе топ-треков
-features_store_url = config["urls"]["features_store_url"] # "http://127.0.0.1:8010"
+features_store_url = config["urls"]["features_store_url"].strip('"') # "http://127.0.0.1:8010"
 # Вспомогательный сервис для хранения и получения последних онлайн-событий пользователя
-events_store_url = config["urls"]["events_store_url"] # "http://127.0.0.1:8020"
+events_store_url = config["urls"]["events_store_url"].strip('"') # "http://127.0.0.1:8020"
+# Шарды хранилища онлайн-событий (пусто - один сервис по адресу events_store_url)
+events_store_shards = parse_urls(config.get("urls", "events_store_shards", fallback=""))
+events_virtual_nodes = config.getint("events", "virtual_nodes", fallback=100)
+
+# Параметры http-клиента для обращения к вспомогательным сервисам
+http_timeout = config.getfloat("http", "timeout", fallback=1.0)
+http_max_connections = config.getint("http", "max_connections", fallback=100)
+http_max_concurrency = config.getint("http", "max_concurrency", fallback=100)
+
+# Загружать ли рекомендации из сконвертированных файлов через отображение в память
+use_mmap_artifacts = config.getboolean("artifacts", "use_mmap", fallback=True)
+# Интервал (в секундах) проверки файлов с рекомендациями на изменения (0 - не проверять)
+watch_interval = config.getfloat("artifacts", "watch_interval", fallback=0)
+
+# Режим работы с вспомогательными сервисами:
+# http - обращение к отдельно запущенным events_service и features_service,
+# embedded - хранилища событий и похожих объектов работают в процессе основного сервиса
+stores_mode = config.get("recommendations", "stores_mode", fallback="http")
+
+# Максимальное время (в секундах) на получение онлайн-рекомендаций в смешанной выдаче
+request_deadline = config.getfloat("recommendations", "request_deadline", fallback=0.3)
+
+# Стратегия смешивания оффлайн- и онлайн-рекомендаций: interleave, weighted или rrf (см. blending.py)
+blend_strategy = config.get("recommendations", "blend_strategy", fallback="interleave")
+
+# Источник онлайн-рекомендаций: i2i - объекты, похожие на 3 последних трека (features_service),
+# als - оценки всего каталога по вектору пользователя, дообученному на последних событиях (см. als_foldin.py)
+online_source = config.get("recommendations", "online_source", fallback="i2i")
+# Директория с факторами объектов ALS-модели (см. build_artifacts.py) и кол-во последних событий для fold-in
+als_path = config.get("als", "path", fallback="als.idx")
+als_foldin_events = config.getint("als", "foldin_events", fallback=10)
+
+# Исключать ли из рекомендаций уже прослушанные пользователем треки
+# и директория с прослушанными треками из истории событий (см. build_artifacts.py)
+seen_enabled = config.getboolean("seen", "enabled", fallback=True)
+seen_path = config.get("seen", "path", fallback="seen.idx")
+# Ограничения запаса кандидатов онлайн-рекомендаций на прослушанные треки: при тысячах прослушанных
+# запрашивать k + кол-во прослушанных кандидатов слишком дорого, поэтому рекомендаций может остаться меньше k
+seen_candidates_factor = config.getint("seen", "candidates_factor", fallback=4)
+seen_max_candidates = config.getint("seen", "max_candidates", fallback=1000)
+# Треки из онлайн-событий хранятся с теми же ограничениями, что и события в events_service:
+# не больше max_users пользователей и не дольше ttl секунд без новых событий (0 - без ограничений)
+seen_max_users = config.getint("events", "max_users", fallback=0)
+seen_ttl = config.getfloat("events", "ttl", fallback=0)
+# Максимальное кол-во хранимых событий на одного пользователя в events_service
+# (в режиме http в прослушанные добавляются все хранимые события пользователя)
+max_events_per_user = config.getint("events", "max_events_per_user", fallback=10)
+
+# Длины списка рекомендаций по умолчанию, ответы для которых кодируются целиком при загрузке
+# (для остальных k ответ собирается из заранее закодированного списка)
+default_response_k = [int(k) for k in config.get("recommendations", "default_response_k", fallback="10, 100").split(",")]
+
+# Максимальное кол-во записей в кэше онлайн- и смешанных рекомендаций (0 - не кэшировать)
+# и время жизни записи в секундах
+cache_maxsize = config.getint("cache", "maxsize", fallback=100_000)
+cache_ttl = config.getfloat("cache", "ttl", fallback=60.0)
+
+
+# Вспомогательная функция
+def gather_rows(starts, lengths):
+    """
+    Возвращает индексы строк starts[i], ..., starts[i] + lengths[i] - 1 для всех i подряд
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shifts = np.asarray(starts, dtype=np.int64) - (np.cumsum(lengths) - lengths)
+
+    return np.repeat(shifts, lengths) + np.arange(lengths.sum())
+
+
+def filter_seen_items(seen, user_id, recs, k):
+    """
+    Исключает из рекомендаций прослушанные пользователем треки и обрезает список до k
+    """
+    with stage("recommendations", "seen_filter"):
+        return seen.filter(user_id, recs)[:k]
 
 
 # Объявляем специальный класс для работы с оффлайн-рекомендациями
@@ -37,44 +135,157 @@ class Recommendations:
     """
     Класс для работы с оффлайн-рекомендациями
     """
-    def __init__(self):
+    def __init__(self, response_k=()):
         self._recs = {"personal": None, "default": None}
+        # Параметры загрузки каждого типа рекомендаций (для перезагрузки)
+        self._sources = {}
+        # Версия загруженных рекомендаций
+        self.version = None
+        # Закодированный ответ с рекомендациями по умолчанию и длины списка, для которых он хранится целиком
+        self._default_response = None
+        self.response_k = response_k
         self._stats = {
             "request_personal_count": 0,
             "request_default_count": 0,
+            "request_degraded_count": 0,
         }
 
-    def load(self, type, path, **kwargs):
+    def _read(self, type, path, use_mmap=False, **kwargs):
         """
-        Загружает рекомендации из файла
+        Читает рекомендации из сконвертированной директории или parquet-файла
         """
+        mmap_path = index_path(path)
+        if use_mmap and os.path.isdir(mmap_path):
+            logger.info(f"Loading recommendations, type: {type}, from {mmap_path}")
+            return open_recommendations(type, mmap_path)
+
         logger.info(f"Loading recommendations, type: {type}")
-        self._recs[type] = pd.read_parquet(path, **kwargs)
+        recs = pd.read_parquet(path, **kwargs)
+        return build_recommendations(type, recs)
+
+    def _build_response(self, recs, version):
+        """
+        Кодирует ответ с рекомендациями по умолчанию (см. encoding.PrecomputedResponse)
+        """
+        if recs.get("default") is None:
+            return None
+
+        return PrecomputedResponse(recs["default"], extra={"version": version}, ks=self.response_k)
+
+    def load(self, type, path, use_mmap=False, **kwargs):
+        """
+        Загружает рекомендации из файла и строит по ним индекс для быстрого поиска;
+        при use_mmap и наличии сконвертированной директории (см. build_artifacts.py)
+        индекс отображается в память вместо чтения parquet-файла
+        """
+        self._sources[type] = (path, use_mmap, kwargs)
+        self._recs[type] = self._read(type, path, use_mmap, **kwargs)
+        self.version = artifacts_version(self.artifacts_stamp())
+        self._default_response = self._build_response(self._recs, self.version)
         logger.info(f"Loaded")
 
-    def get(self, user_id: int, k: int=100):
+    def artifacts_stamp(self):
+        """
+        Возвращает отметку файлов, из которых загружены рекомендации
+        """
+        paths = []
+        for path, use_mmap, _ in self._sources.values():
+            mmap_path = index_path(path)
+            paths.append(mmap_path if use_mmap and os.path.isdir(mmap_path) else path)
+
+        return artifacts_stamp(paths)
+
+    def build_state(self):
         """
-        Возвращает список рекомендаций для пользователя
+        Загружает новую версию всех рекомендаций из тех же файлов (для перезагрузки)
+        """
+        stamp = self.artifacts_stamp()
+        recs = {type: self._read(type, path, use_mmap, **kwargs)
+                for type, (path, use_mmap, kwargs) in self._sources.items()}
+        version = artifacts_version(stamp)
+
+        return recs, version, self._build_response(recs, version)
+
+    def swap(self, state):
+        """
+        Атомарно заменяет текущую версию рекомендаций на новую
+        """
+        self._recs, self.version, self._default_response = state
+
+    def __contains__(self, user_id):
+        """
+        Проверяет, есть ли у пользователя персональные рекомендации
+        """
+        return user_id in self._recs["personal"]
+
+    def get(self, user_id: int, k: int=100, seen=None):
+        """
+        Возвращает список рекомендаций для пользователя;
+        если задан seen (SeenItems), прослушанные треки исключаются до обрезки списка до k
         """
         
         # Добавляем обработку исключений для общего случая
         # (у нас все рекомендации должны быть обязательно загружены, без них сервис не запустится,
         # поэтому KeyError можно не проверять)
         try: 
-            recs = self._recs["personal"].query('user_id == @user_id') 
-            if len(recs) > 0:
-                recs = recs["item_id"].to_list()[:k]
-                self._stats["request_personal_count"] += 1
-            else:
-                recs = self._recs["default"]
-                recs = recs["item_id"].to_list()[:k]
-                self._stats["request_default_count"] += 1
+            # Срез по индексу, обрезанный до k, без сканирования всей таблицы
+            # (при фильтрации прослушанных - срез целиком)
+            all_recs = self._recs
+            n = k if seen is None else None
+            with stage("recommendations", "index_lookup"):
+                recs = all_recs["personal"].get(user_id, "item_id", n)
+                if len(recs) > 0:
+                    self._stats["request_personal_count"] += 1
+                else:
+                    recs = all_recs["default"][:n]
+                    self._stats["request_default_count"] += 1
+            # фильтрация прослушанных замеряется отдельным этапом, не входящим в index_lookup
+            if seen is not None:
+                recs = filter_seen_items(seen, user_id, recs, k)
+            recs = recs.tolist()
         except Exception as e:
             logger.error(f"{e}, no recommendations found")
             recs = []
 
         return recs
 
+    def get_many(self, user_ids, k: int=100):
+        """
+        Возвращает рекомендации для массива пользователей одним векторизованным поиском
+        в виде CSR-пары (offsets, item_ids): рекомендации i-го пользователя -
+        item_ids[offsets[i]:offsets[i + 1]]; для пользователей без персональных
+        рекомендаций возвращаются рекомендации по умолчанию
+        """
+        all_recs = self._recs
+        personal, default = all_recs["personal"], all_recs["default"]
+        user_ids = np.asarray(user_ids)
+        k = max(k, 0)
+
+        # Ищем всех пользователей в индексе сразу (в пустом индексе не найден никто)
+        found = np.zeros(len(user_ids), dtype=bool)
+        starts = np.zeros(len(user_ids), dtype=np.int64)
+        ends = np.zeros(len(user_ids), dtype=np.int64)
+        if len(personal.keys) > 0:
+            pos = np.searchsorted(personal.keys, user_ids)
+            pos_clipped = np.minimum(pos, len(personal.keys) - 1)
+            found = (pos < len(personal.keys)) & (personal.keys[pos_clipped] == user_ids)
+            starts[found] = personal.offsets[pos_clipped[found]]
+            ends[found] = personal.offsets[pos_clipped[found] + 1]
+        lengths = np.where(found, np.minimum(ends - starts, k), min(k, len(default)))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        # Собираем персональные рекомендации и рекомендации по умолчанию в один плоский массив
+        item_ids = np.empty(offsets[-1], dtype=personal.columns["item_id"].dtype)
+        from_personal = np.repeat(found, lengths)
+        item_ids[from_personal] = personal.columns["item_id"][gather_rows(starts[found], lengths[found])]
+        item_ids[~from_personal] = default[gather_rows(np.zeros((~found).sum(), dtype=np.int64), lengths[~found])]
+
+        n_found = int(found.sum())
+        self._stats["request_personal_count"] += n_found
+        self._stats["request_default_count"] += len(user_ids) - n_found
+
+        return offsets, item_ids
+
     def get_default(self, k: int=100):
         """
         Возвращает список рекомендаций по умолчанию
@@ -84,8 +295,7 @@ class Recommendations:
         # (у нас все рекомендации должны быть обязательно загружены, без них сервис не запустится,
         # поэтому KeyError можно не проверять)
         try:
-            recs = self._recs["default"]
-            recs = recs["item_id"].to_list()[:k]
+            recs = self._recs["default"][:k].tolist()
             self._stats["request_default_count"] += 1
         except Exception as e:
             logger.error(f"{e}, no recommendations found")
@@ -93,6 +303,14 @@ class Recommendations:
 
         return recs
 
+    def get_default_response(self, k: int=100, accept=None):
+        """
+        Возвращает готовый ответ с рекомендациями по умолчанию длиной k
+        (без построения списка и сериализации на каждый запрос)
+        """
+        self._stats["request_default_count"] += 1
+        return self._default_response.response(k, accept)
+
     def stats(self):
         logger.info("Stats for recommendations")
         for name, value in self._stats.items():
@@ -100,7 +318,75 @@ class Recommendations:
 
 
 # Создаем объект для работы с рекомендациями
-rec_store = Recommendations()
+rec_store = Recommendations(default_response_k)
+
+# Создаем объект для онлайн-рекомендаций по ALS-модели
+als_store = ALSFoldIn()
+
+# Создаем объект для исключения прослушанных треков из рекомендаций (None - не исключать)
+seen_store = SeenItems(seen_max_users, seen_ttl) if seen_enabled else None
+
+# Создаем кэш онлайн- и смешанных рекомендаций
+response_cache = ResponseCache(cache_maxsize, cache_ttl)
+
+# Метрики загруженных рекомендаций и кэша (вычисляются при запросе /metrics)
+def artifacts_bytes():
+    all_recs = rec_store._recs
+    return {(type,): recs.nbytes for type, recs in all_recs.items() if recs is not None}
+
+metrics.gauge("recommendations_artifacts_bytes", "Size of loaded recommendations", artifacts_bytes, ("type",))
+metrics.REGISTRY.register(metrics.CallbackMetric(
+    "recommendations_responses_total", "Responses by source of offline recommendations",
+    lambda: {(name[len("request_"):-len("_count")],): value for name, value in rec_store._stats.items()},
+    ("source",), type="counter",
+))
+metrics.REGISTRY.register(metrics.CallbackMetric(
+    "response_cache_events_total", "Response cache hits, misses, evictions and expirations",
+    lambda: {(name[len("cache_"):-len("_count")],): value for name, value in response_cache._stats.items()},
+    ("event",), type="counter",
+))
+metrics.gauge(
+    "als_factors_bytes", "Size of loaded ALS item factors",
+    lambda: als_store._model["factors"].nbytes if als_store._model is not None else 0,
+)
+metrics.gauge(
+    "seen_items_bytes", "Size of seen items of users",
+    lambda: seen_store.nbytes if seen_store is not None else 0,
+)
+metrics.gauge("response_cache_entries", "Number of cached responses", lambda: len(response_cache))
+
+# Создаем объекты для перезагрузки рекомендаций без остановки сервиса
+# (после любой перезагрузки, в том числе при изменении файлов, кэш ответов очищается)
+reloaders = [ArtifactsReloader(rec_store, watch_interval, on_swap=response_cache.clear)]
+if online_source == "als":
+    reloaders.append(ArtifactsReloader(als_store, watch_interval, on_swap=response_cache.clear))
+if seen_store is not None:
+    reloaders.append(ArtifactsReloader(seen_store, watch_interval, on_swap=response_cache.clear))
+
+# Создаем общий клиент для обращения к вспомогательным сервисам
+if stores_mode == "embedded":
+    import events_service
+    import features_service
+
+    stores_client = EmbeddedStoresClient(
+        events_service.events_store,
+        features_service.sim_items_store,
+        similar_items_path="similar.parquet",
+        use_mmap=use_mmap_artifacts,
+    )
+    reloaders.append(ArtifactsReloader(features_service.sim_items_store, watch_interval, on_swap=response_cache.clear))
+    # Онлайн-события сразу попадают в прослушанные треки
+    events_service.events_store.seen_items = seen_store
+else:
+    stores_client = HttpStoresClient(
+        events_store_url,
+        features_store_url,
+        timeout=http_timeout,
+        max_connections=http_max_connections,
+        max_concurrency=http_max_concurrency,
+        events_store_shards=events_store_shards,
+        virtual_nodes=events_virtual_nodes,
+    )
 
 
 @asynccontextmanager
@@ -112,22 +398,55 @@ async def lifespan(app: FastAPI):
     rec_store.load(
         "personal",
         "recommendations.parquet",
+        use_mmap=use_mmap_artifacts,
         columns=["user_id", "item_id", "rank"],
     )
     rec_store.load(
         "default",
         'top_popular.parquet', 
+        use_mmap=use_mmap_artifacts,
         columns=["item_id", "rank"],
     )
+    # Загружаем факторы ALS-модели, если онлайн-рекомендации строятся по ней
+    if online_source == "als":
+        als_store.load(als_path, use_mmap=use_mmap_artifacts)
+    # Загружаем прослушанные треки из истории событий
+    if seen_store is not None:
+        seen_store.load(seen_path, use_mmap=use_mmap_artifacts)
+    # Открываем пул соединений с вспомогательными сервисами
+    # (во встроенном режиме - загружаем похожие объекты)
+    await stores_client.start()
+    # Во встроенном режиме lifespan подключенного events_service не выполняется, поэтому
+    # восстановление хранилища событий с диска и заполнение из файла запускаем здесь
+    # (после загрузки прослушанных треков, чтобы в них не попадали уже известные события)
+    if stores_mode == "embedded":
+        await events_service.start_store()
+    # Следим за изменениями файлов с рекомендациями
+    watch_tasks = []
+    if watch_interval > 0:
+        watch_tasks = [asyncio.create_task(reloader.watch()) for reloader in reloaders]
     logger.info("Ready!")
     yield
     # этот код выполнится только один раз при остановке сервиса
+    for task in watch_tasks:
+        task.cancel()
+    if stores_mode == "embedded":
+        await events_service.stop_store()
+    await stores_client.close()
     rec_store.stats()
+    response_cache.stats()
     logger.info("Stopping")
     
 
 # создаём приложение FastAPI
 app = FastAPI(title="recommendations", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware, service="recommendations")
+
+# Во встроенном режиме вспомогательные сервисы доступны по префиксам /events и /features
+# основного сервиса (например, /events/put для добавления онлайн-события)
+if stores_mode == "embedded":
+    app.mount("/events", events_service.app)
+    app.mount("/features", features_service.app)
 
 
 # Обращение к корневому url для проверки работоспособности сервиса
@@ -138,113 +457,311 @@ def read_root():
 
 # Получение персональных рекомендаций пользователя только по его оффлайн-истории
 @app.post("/recommendations_offline")
-async def recommendations_offline(user_id: int, k: int = 100):
+async def recommendations_offline(user_id: int, k: int = 100, accept: str | None = Header(None)):
     """
     Возвращает список оффлайн-рекомендаций длиной k для пользователя user_id
     """
-    recs = rec_store.get(user_id, k)
-    return {"recs": recs}
+    # холодным пользователям без прослушанных треков отдаем готовый ответ с рекомендациями по умолчанию
+    if user_id not in rec_store and (seen_store is None or seen_store.count(user_id) == 0):
+        return rec_store.get_default_response(k, accept)
+
+    recs = rec_store.get(user_id, k, seen_store)
+    return encoded_response("recommendations", {"recs": recs, "version": rec_store.version}, accept)
 
 
 # Получение рекомендаций по умолчанию из числа топ-треков
 @app.post("/recommendations_default")
-async def recommendations_default(k: int = 100):
+async def recommendations_default(k: int = 100, accept: str | None = Header(None)):
     """
     Возвращает список рекомендаций по умолчанию длиной k
     """
-    recs = rec_store.get_default(k)
-    return {"recs": recs}
+    # ответ закодирован заранее при загрузке рекомендаций
+    return rec_store.get_default_response(k, accept)
 
 
-# Функции для получения онлайн-рекомендаций
+# Кол-во пользователей в одной части ответа /recommendations_batch
+BATCH_CHUNK_SIZE = 10_000
 
-# Вспомогательная функция
-def dedup_ids(ids):
+
+def parse_user_ids(data):
     """
-    Дедублицирует список идентификаторов, оставляя только первое вхождение
+    Разбирает идентификаторы пользователей, разделенные пробельными символами, в массив int64
+    (ValueError - если среди них есть не целые числа)
     """
-    seen = set()
-    ids = [id for id in ids if not (id in seen or seen.add(id))]
+    try:
+        return np.array(data.split(), dtype=np.bytes_).astype(np.int64)
+    except (ValueError, OverflowError):
+        raise ValueError("Request body must contain integer user ids, one per line")
 
-    return ids
 
-# Получение онлайн-рекомендаций
-@app.post("/recommendations_online")
-async def recommendations_online(user_id: int, k: int = 50):
-    """
-    Возвращает список онлайн-рекомендаций длиной k для пользователя user_id по его 3-м последним онлайн-событиям
-    """
-    headers = {"Content-type": "application/json", "Accept": "text/plain"}
-
-    # получаем список последних событий пользователя, возьмём три последних
-    params = {"user_id": user_id, "k": 3}
-    resp = requests.post(events_store_url + "/get", headers=headers, params=params)
-    events = resp.json()
-    events = events['events']
-
-    # получаем список айтемов, похожих на последние три, с которыми взаимодействовал пользователь
-    items = []
-    scores = []
-    for item_id in events:
-        # для каждого item_id получаем список похожих в item_similar_items
-        params = {"item_id": item_id, "k": k}
-        resp = requests.post(features_store_url +"/similar_items", headers=headers, params=params)
-        item_similar_items = resp.json()
-        items += item_similar_items["item_id_2"]
-        scores += item_similar_items["score"]
-    
-    # сортируем похожие объекты по scores в убывающем порядке
-    combined = list(zip(items, scores))
-    combined = sorted(combined, key=lambda x: x[1], reverse=True)
-    combined = [item for item, _ in combined]
+async def spool_user_ids(request: Request):
+    """
+    Читает из тела запроса идентификаторы пользователей (по одному на строку) по мере поступления,
+    проверяет их и записывает во временный файл в виде int64 (8 байт на пользователя);
+    в памяти находится только последний полученный фрагмент тела запроса
+    (ValueError - если среди идентификаторов есть не целые числа)
+    """
+    spool = tempfile.TemporaryFile()
+    try:
+        tail = b""
+        async for data in request.stream():
+            data = tail + data
+            cut = data.rfind(b"\n") + 1
+            tail = data[cut:]
+            if cut > 0:
+                spool.write(parse_user_ids(data[:cut]).tobytes())
+        spool.write(parse_user_ids(tail).tobytes())
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+
+    return spool
+
+
+def iter_user_ids(spool, chunk_size: int = BATCH_CHUNK_SIZE):
+    """
+    Возвращает идентификаторы пользователей из временного файла частями по chunk_size
+    и удаляет файл после чтения
+    """
+    with spool:
+        while True:
+            chunk = np.fromfile(spool, dtype=np.int64, count=chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
 
-    # удаляем дубликаты, чтобы не выдавать одинаковые рекомендации
-    recs = dedup_ids(combined)[:k]
 
-    return {"recs": recs}
+def iter_batch_ndjson(chunks, k):
+    """
+    Возвращает рекомендации частями в формате NDJSON: {"user_id": ..., "recs": [...]} на строку
+    """
+    for chunk in chunks:
+        offsets, item_ids = rec_store.get_many(chunk, k)
+        offsets, item_ids = offsets.tolist(), item_ids.tolist()
+        lines = [
+            f'{{"user_id":{user_id},"recs":[{",".join(map(str, item_ids[offsets[i]:offsets[i + 1]]))}]}}\n'
+            for i, user_id in enumerate(chunk.tolist())
+        ]
+        yield "".join(lines).encode()
 
 
-# Получение смешанных offline- и online-рекомендаций,
-# первые помещаем на четные места выходного списка (начиная с нулевой позиции), 
-# вторые - на нечетные
-@app.post("/recommendations")
-async def recommendations(user_id: int, k: int = 100):
+def iter_batch_arrow(chunks, k):
     """
-    Возвращает список рекомендаций длиной k для пользователя user_id
+    Возвращает рекомендации частями в формате Arrow IPC (stream):
+    по одному RecordBatch со столбцами user_id, recs на часть
+    """
+    schema = pa.schema([("user_id", pa.int64()), ("recs", pa.list_(pa.int32()))])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for chunk in chunks:
+            offsets, item_ids = rec_store.get_many(chunk, k)
+            recs = pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), pa.array(item_ids, pa.int32()))
+            writer.write_batch(pa.record_batch([pa.array(chunk), recs], schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+# Получение оффлайн-рекомендаций для многих пользователей одним запросом
+@app.post("/recommendations_batch")
+async def recommendations_batch(request: Request, k: int = 100, format: str = "ndjson"):
+    """
+    Возвращает оффлайн-рекомендации длиной k для пользователей из тела запроса
+    (идентификаторы по одному на строку) в формате NDJSON или Arrow IPC (format=arrow);
+    тело запроса сначала целиком проверяется и сохраняется во временный файл (поэтому на неверный
+    идентификатор в любом месте отвечаем ошибкой 400), затем ответ формируется и отправляется
+    частями по BATCH_CHUNK_SIZE пользователей; память сервиса не зависит от размера запроса
     """
+    try:
+        spool = await spool_user_ids(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    chunks = iter_user_ids(spool, BATCH_CHUNK_SIZE)
 
-    recs_offline = await recommendations_offline(user_id, k)
-    recs_online = await recommendations_online(user_id, k)
+    if format == "arrow":
+        return StreamingResponse(iter_batch_arrow(chunks, k), media_type="application/vnd.apache.arrow.stream")
 
-    recs_offline = recs_offline["recs"]
-    recs_online = recs_online["recs"]
+    return StreamingResponse(iter_batch_ndjson(chunks, k), media_type="application/x-ndjson")
 
-    recs_blended = []
 
-    min_length = min(len(recs_offline), len(recs_online))
-    offline_idx = online_idx = 0
-    
-    # чередуем элементы из списков, пока позволяет минимальная длина
-    for i in range(2 * min_length):
-        if i % 2 == 0:
-            # Оффлайн-рекомендации на четных позициях (начиная с нулевой)
-            recs_blended.append(recs_offline[offline_idx])
-            offline_idx += 1
-        else:
-            # Онлайн-рекомендации на нечетных позициях
-            recs_blended.append(recs_online[online_idx])
-            online_idx += 1
-
-    # добавляем оставшиеся элементы в конец
-    if len(recs_offline) >= len(recs_online):
-        recs_blended.extend(recs_offline[offline_idx:])
+# Перезагрузка файлов с рекомендациями без остановки сервиса
+@app.post("/admin/reload")
+async def reload():
+    """
+    Загружает новые версии файлов с рекомендациями и атомарно подменяет ими текущие;
+    возвращает версии всех перезагруженных хранилищ (version - версия рекомендаций)
+    """
+    versions = {type(reloader.store).__name__: await reloader.reload() for reloader in reloaders}
+    return {"result": "ok", "version": versions[type(rec_store).__name__], "versions": versions}
+
+
+# Функции для получения онлайн-рекомендаций
+
+def artifacts_versions():
+    """
+    Возвращает версии загруженных в процесс данных (оффлайн-рекомендаций, факторов ALS, прослушанных
+    и во встроенном режиме похожих объектов) для ключей кэша ответов
+    """
+    return tuple(reloader.store.version for reloader in reloaders)
+
+
+async def fetch_events(user_id: int):
+    """
+    Возвращает последние онлайн-события пользователя и версию его истории событий
+    """
+    # для i2i берем три последних события, для ALS - als_foldin_events последних
+    n_events = als_foldin_events if online_source == "als" else 3
+    # в режиме http события не проходят через хранилище основного сервиса, поэтому запрашиваем
+    # все хранимые события пользователя и добавляем их в прослушанные (события, вытесненные
+    # из events_service до первого запроса рекомендаций пользователя, в прослушанные не попадают)
+    http_seen = seen_store is not None and stores_mode != "embedded"
+    with stage("recommendations", "events_fetch"):
+        events, events_version = await stores_client.get_events(
+            user_id, max(n_events, max_events_per_user) if http_seen else n_events
+        )
+    if http_seen and len(events) > 0:
+        seen_store.add_many(user_id, events)
+
+    return events[:n_events], events_version
+
+
+def online_candidates(user_id: int, k: int):
+    """
+    Возвращает кол-во запрашиваемых у источника онлайн-рекомендаций с запасом на прослушанные треки
+    (не больше k * seen_candidates_factor и seen_max_candidates, но не меньше k)
+    """
+    if seen_store is None:
+        return k
+
+    return max(k, min(k + seen_store.count(user_id), k * seen_candidates_factor, seen_max_candidates))
+
+
+async def get_online_recs(user_id: int, k: int = 50, events=None, events_version=None):
+    """
+    Возвращает онлайн-рекомендации длиной k для пользователя user_id по его последним онлайн-событиям
+    (если они не переданы, запрашиваются у хранилища событий), версию данных источника
+    и версию истории событий пользователя (None - ответ не кэшируется);
+    при неизменных истории событий и версиях данных рекомендации берутся из кэша без обращения к источнику
+    """
+    if events is None:
+        events, events_version = await fetch_events(user_id)
+    if len(events) == 0:
+        return [], None, events_version
+
+    key = ("online", user_id, k, events_version, *artifacts_versions())
+    cached = response_cache.get(key) if events_version is not None else None
+    if cached is not None:
+        return (*cached, events_version)
+
+    # берем рекомендации с запасом на прослушанные треки, которые будут исключены
+    n = online_candidates(user_id, k)
+    if online_source == "als":
+        # оценка всего каталога не блокирует цикл событий: NumPy отпускает GIL при умножении матриц
+        with stage("recommendations", "als_scoring"):
+            als_recs = await asyncio.to_thread(als_store.get, events, n)
+        recs, version = als_recs["item_id"], als_recs["version"]
+    else:
+        # получаем одним запросом список айтемов, похожих на последние три, с которыми взаимодействовал пользователь;
+        # features_service сам объединяет их, сортирует по убыванию score и удаляет дубликаты
+        with stage("recommendations", "similar_items_fetch"):
+            i2i = await stores_client.get_similar_items(events, n)
+        recs, version = i2i["item_id_2"], i2i.get("version")
+    if seen_store is not None:
+        recs = filter_seen_items(seen_store, user_id, recs, k)
     else:
-        recs_blended.extend(recs_online[online_idx:])
+        recs = recs[:k]
 
-    # удаляем дубликаты
-    recs_blended = dedup_ids(recs_blended)
-    
-    # оставляем только первые k рекомендаций
-    recs_blended = recs_blended[:k]
+    # пустой ответ может означать недоступность источника: его не кэшируем
+    # и не сообщаем версию истории событий, чтобы не закэшировать и смешанную выдачу
+    if len(recs) == 0:
+        return recs, version, None
+    if events_version is not None:
+        response_cache.put(key, (recs, version))
+
+    return recs, version, events_version
+
+
+# Получение онлайн-рекомендаций
+@app.post("/recommendations_online")
+async def recommendations_online(user_id: int, k: int = 50, accept: str | None = Header(None)):
+    """
+    Возвращает список онлайн-рекомендаций длиной k для пользователя user_id по его последним онлайн-событиям
+    """
+    recs, version, _ = await get_online_recs(user_id, k)
+
+    return encoded_response("recommendations", {"recs": recs, "version": version}, accept)
+
+
+# Получение смешанных offline- и online-рекомендаций,
+# при стратегии interleave (по умолчанию) первые помещаем на четные места
+# выходного списка (начиная с нулевой позиции), вторые - на нечетные
+@app.post("/recommendations")
+async def recommendations(user_id: int, k: int = 100, accept: str | None = Header(None)):
+    """
+    Возвращает список рекомендаций длиной k для пользователя user_id
+    """
 
-    return {"recs": recs_blended}
+    # сначала получаем историю событий: по ее версии и версиям данных выдача может найтись в кэше
+    # без обращения к источнику онлайн-рекомендаций и поиска оффлайн-рекомендаций
+    # (если хранилище событий не ответило за отведенное время, отдаем только оффлайн-рекомендации
+    # и такой ответ не кэшируем)
+    started_at = time.perf_counter()
+    degraded = False
+    try:
+        events, events_version = await asyncio.wait_for(fetch_events(user_id), timeout=request_deadline)
+    except asyncio.TimeoutError:
+        degraded, events, events_version = True, [], None
+
+    key = ("blended", user_id, k, events_version, *artifacts_versions())
+    cached = response_cache.get(key) if events_version is not None else None
+    if cached is not None:
+        return encoded_response("recommendations", cached, accept)
+
+    # онлайн-ветку (обращение к features или оценку ALS) запускаем в фоне и даем ей отправить
+    # запрос к источнику, а параллельно с ней получаем оффлайн-рекомендации
+    # (события уже добавлены в прослушанные, поэтому они исключаются и из оффлайн-рекомендаций)
+    online_task = asyncio.create_task(get_online_recs(user_id, k, events, events_version))
+    await asyncio.sleep(0)
+
+    offline_started_at = time.perf_counter()
+    recs_offline = rec_store.get(user_id, k, seen_store)
+    version = rec_store.version
+    # поиск оффлайн-рекомендаций блокирует цикл событий, поэтому его длительность
+    # не учитывается в отведенном онлайн-ветке времени
+    offline_duration = time.perf_counter() - offline_started_at
+
+    try:
+        timeout = max(request_deadline - (time.perf_counter() - started_at - offline_duration), 0)
+        recs_online, _, events_version = await asyncio.wait_for(online_task, timeout=timeout)
+    except asyncio.TimeoutError:
+        degraded, recs_online, events_version = True, [], None
+    if degraded:
+        logger.warning(f"Online recommendations for user_id={user_id} missed the deadline")
+        rec_store._stats["request_degraded_count"] += 1
+
+    # источники, которые попали в выдачу
+    sources = [name for name, recs in (("offline", recs_offline), ("online", recs_online)) if len(recs) > 0]
+
+    # смешиваем списки по заданной стратегии (по умолчанию - чередованием),
+    # удаляем дубликаты и оставляем только первые k рекомендаций
+    # (прослушанные треки уже исключены из обоих списков)
+    with stage("recommendations", "blend"):
+        recs_blended = blend([recs_offline, recs_online], blend_strategy, k=k).tolist()
+
+    # degraded - онлайн-ветка не уложилась в отведенное время
+    response = {"recs": recs_blended, "sources": sources, "version": version, "degraded": degraded}
+    if events_version is not None:
+        response_cache.put(key, response)
+
+    return encoded_response("recommendations", response, accept)
+
+
+# Метрики сервиса
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Возвращает метрики сервиса в текстовом формате Prometheus
+    """
+    return metrics.render()
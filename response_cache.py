@@ -0,0 +1,84 @@
+"""
+Вспомогательный модуль для кэширования ответов основного сервиса рекомендаций в памяти процесса.
+
+Кэш ограничен по количеству записей (при переполнении вытесняются давно не использованные
+записи - LRU) и по времени жизни записей (ttl). Ключ записи включает версию истории событий
+пользователя (см. EventStore.version) и версии загруженных данных, поэтому после нового события
+пользователя или перезагрузки данных старые записи больше не находятся и вытесняются со временем,
+а в выдаче сразу учитываются новые события.
+"""
+
+import time
+import logging
+from collections import OrderedDict
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class ResponseCache:
+    """
+    Класс для кэширования ответов с вытеснением по LRU и по времени жизни записей
+    """
+
+    def __init__(self, maxsize=100_000, ttl=60.0):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # ключ -> (время истечения, значение), от давно использованных к недавно использованным
+        self._entries = OrderedDict()
+        self._stats = {
+            "cache_hit_count": 0,
+            "cache_miss_count": 0,
+            "cache_eviction_count": 0,
+            "cache_expired_count": 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Возвращает значение по ключу или None, если записи нет или она устарела
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["cache_miss_count"] += 1
+            return None
+
+        expires_at, value = entry
+        if self.ttl > 0 and time.monotonic() > expires_at:
+            del self._entries[key]
+            self._stats["cache_expired_count"] += 1
+            self._stats["cache_miss_count"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._stats["cache_hit_count"] += 1
+
+        return value
+
+    def put(self, key, value):
+        """
+        Сохраняет значение по ключу, при переполнении вытесняя давно не использованные записи
+        """
+        if self.maxsize <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._stats["cache_eviction_count"] += 1
+
+    def clear(self):
+        """
+        Удаляет все записи (например, после перезагрузки рекомендаций)
+        """
+        self._entries.clear()
+
+    def stats(self):
+        logger.info("Stats for response cache")
+        for name, value in self._stats.items():
+            logger.info(f"{name:<30} {value} ")
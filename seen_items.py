@@ -0,0 +1,220 @@
+"""
+Вспомогательный модуль для исключения из рекомендаций треков, которые пользователь уже прослушал.
+
+Прослушанные треки хранятся в двух частях:
+- основная - история событий из events.parquet, сконвертированная в индекс CSRIndex
+(build_artifacts.py): для каждого пользователя - отсортированный массив уникальных item_id (int32),
+т.е. 4 байта на трек плюс 16 байт на пользователя (ключ и смещение); директория seen.idx
+отображается в память и перезагружается вместе с остальными рекомендациями;
+- дополнительная - треки из онлайн-событий, которых нет в основной части: словарь
+user_id -> отсортированный массив int32, который пополняется при каждом EventStore.put
+(во встроенном режиме) или по событиям, полученным от events_service (в режиме http).
+Как и в EventStore, дополнительная часть ограничена по кол-ву пользователей (max_users,
+вытесняются пользователи с самыми давними онлайн-событиями) и по времени (ttl, вытесняются
+пользователи без новых событий дольше ttl секунд); треки вытесненных пользователей снова
+исключаются из рекомендаций после пересборки seen.idx.
+
+Проверка принадлежности списка рекомендаций - np.searchsorted по отсортированным массивам
+пользователя, без построения множеств.
+"""
+
+import os
+import time
+import logging
+from collections import OrderedDict
+import numpy as np
+from csr_index import CSRIndex
+from hot_reload import artifacts_stamp, artifacts_version
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _isin_sorted(item_ids, sorted_ids):
+    """
+    Возвращает маску элементов item_ids, которые есть в отсортированном массиве sorted_ids
+    """
+    if len(sorted_ids) == 0:
+        return np.zeros(len(item_ids), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_ids, item_ids), len(sorted_ids) - 1)
+
+    return sorted_ids[pos] == item_ids
+
+
+def unique_sorted(values):
+    """
+    Возвращает отсортированные уникальные значения массива (сортировка и сравнение соседних
+    значений, быстрее np.unique на больших массивах)
+    """
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+
+class SeenItems:
+    """
+    Класс для хранения прослушанных пользователями треков и фильтрации рекомендаций
+    """
+
+    def __init__(self, max_users=0, ttl=0):
+
+        # Ограничения дополнительной части (0 - без ограничений)
+        self.max_users = max_users
+        self.ttl = ttl
+        # Индекс user_id -> отсортированные item_id из истории событий (None - не загружен)
+        self._index = None
+        # Треки из онлайн-событий, которых нет в индексе: user_id -> отсортированный массив int32,
+        # от пользователей с давними событиями к пользователям с недавними, и время последнего события
+        self._delta = OrderedDict()
+        self._updated_at = {}
+        # Путь к директории с индексом (для перезагрузки) и версия загруженных данных
+        self._source = None
+        self.version = None
+
+    @staticmethod
+    def build(user_ids, item_ids):
+        """
+        Строит индекс по парам (user_id, item_id) событий; повторы пар удаляются
+        """
+        keys = unique_sorted(np.asarray(user_ids, dtype=np.int64) << 32 | np.asarray(item_ids, dtype=np.int64))
+        users = keys >> 32
+        # Ключи уже отсортированы, поэтому начала пользователей - места смены user_id
+        starts = np.flatnonzero(np.concatenate([[True], users[1:] != users[:-1]])) if len(keys) else np.empty(0, dtype=np.int64)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+
+        return CSRIndex(users[starts], offsets, {"item_id": (keys & 0xFFFFFFFF).astype(np.int32)})
+
+    @staticmethod
+    def _read(directory, use_mmap=True):
+        """
+        Открывает индекс из директории (или строит пустой, если ее нет)
+        """
+        if not os.path.isdir(directory):
+            logger.info(f"{directory} not found, seen items are tracked from online events only")
+            return SeenItems.build([], [])
+
+        logger.info(f"Loading data, type: seen, from {directory}")
+        return CSRIndex.open(directory, mmap_mode="r" if use_mmap else None)
+
+    def load(self, directory, use_mmap=True):
+        """
+        Загружает индекс прослушанных треков из директории
+        """
+        self._source = (directory, use_mmap)
+        self._index = self._read(directory, use_mmap)
+        self.version = artifacts_version(self.artifacts_stamp())
+        logger.info(f"Loaded")
+
+    def artifacts_stamp(self):
+        """
+        Возвращает отметку директории с индексом (пустую, если директории нет)
+        """
+        return artifacts_stamp([self._source[0]])
+
+    def build_state(self):
+        """
+        Загружает новую версию индекса из той же директории (для перезагрузки)
+        """
+        stamp = self.artifacts_stamp()
+
+        return self._read(*self._source), artifacts_version(stamp)
+
+    def swap(self, state):
+        """
+        Атомарно заменяет текущую версию индекса на новую; из онлайн-событий
+        удаляются треки, которые уже есть в новой версии индекса
+        """
+        index, version = state
+        delta = OrderedDict()
+        for user_id, items in list(self._delta.items()):
+            items = items[~_isin_sorted(items, index.get(user_id, "item_id"))]
+            if len(items):
+                delta[user_id] = items
+        updated_at = {user_id: self._updated_at[user_id] for user_id in delta}
+        self._index, self._delta, self._updated_at, self.version = index, delta, updated_at, version
+
+    def __len__(self):
+        """
+        Кол-во пользователей с прослушанными треками в индексе и в онлайн-событиях
+        """
+        return (len(self._index) if self._index is not None else 0) + len(self._delta)
+
+    @property
+    def nbytes(self):
+        """
+        Размер индекса и массивов онлайн-событий в байтах
+        """
+        index_bytes = self._index.nbytes if self._index is not None else 0
+
+        return index_bytes + sum(items.nbytes for items in self._delta.values())
+
+    def _parts(self, user_id):
+        index = self._index
+        base = index.get(user_id, "item_id") if index is not None else ()
+        return base, self._delta.get(user_id, ())
+
+    def _evict(self, now):
+        """
+        Вытесняет из онлайн-событий пользователей без новых событий дольше ttl
+        и пользователей с самыми давними событиями сверх max_users
+        """
+        delta, updated_at = self._delta, self._updated_at
+        while delta:
+            user_id = next(iter(delta))
+            if not (self.ttl > 0 and now - updated_at[user_id] > self.ttl or 0 < self.max_users < len(delta)):
+                break
+            del delta[user_id], updated_at[user_id]
+
+    def add(self, user_id, item_id):
+        """
+        Добавляет прослушанный трек пользователя
+        """
+        self.add_many(user_id, [item_id])
+
+    def add_many(self, user_id, item_ids):
+        """
+        Добавляет прослушанные треки пользователя (треки, которые уже есть, пропускаются)
+        """
+        item_ids = np.asarray(item_ids, dtype=np.int32)
+        new_ids = item_ids[~self.contains(user_id, item_ids)]
+        delta = self._delta.get(user_id)
+        if len(new_ids):
+            delta = self._delta[user_id] = np.union1d(delta, new_ids) if delta is not None else np.unique(new_ids)
+        if delta is not None:
+            # событие пользователя (даже с уже прослушанным треком) продлевает хранение его треков
+            self._delta.move_to_end(user_id)
+            now = time.monotonic()
+            self._updated_at[user_id] = now
+            self._evict(now)
+
+    def count(self, user_id):
+        """
+        Возвращает кол-во прослушанных пользователем треков
+        """
+        base, delta = self._parts(user_id)
+
+        return len(base) + len(delta)
+
+    def contains(self, user_id, item_ids):
+        """
+        Возвращает маску треков item_ids, которые пользователь уже прослушал
+        """
+        item_ids = np.asarray(item_ids)
+        base, delta = self._parts(user_id)
+        mask = _isin_sorted(item_ids, base)
+        if len(delta):
+            mask |= _isin_sorted(item_ids, delta)
+
+        return mask
+
+    def filter(self, user_id, item_ids):
+        """
+        Исключает из списка item_ids треки, которые пользователь уже прослушал
+        """
+        item_ids = np.asarray(item_ids)
+        if len(item_ids) == 0:
+            return item_ids
+
+        return item_ids[~self.contains(user_id, item_ids)]
@@ -0,0 +1,104 @@
+"""
+Вспомогательный модуль для распределения пользователей между несколькими экземплярами events_service
+(шардами) по консистентному хешированию.
+
+Каждый шард (его url) представлен на кольце хешей virtual_nodes точками, пользователь принадлежит
+шарду первой точки кольца, не меньшей хеша user_id. Виртуальные узлы выравнивают доли шардов:
+отклонение доли пользователей шарда от средней - порядка 1/sqrt(virtual_nodes), т.е. около 10%
+при 100 точках на шард.
+
+Перераспределение при изменении списка шардов:
+- при добавлении шарда к нему переходит примерно 1/(N+1) пользователей, причем только с других шардов
+на новый; остальные пользователи остаются на прежних шардах;
+- при удалении шарда его пользователи распределяются по оставшимся шардам, остальные не перемещаются;
+- история событий перемещенных пользователей остается на прежнем шарде и недоступна, пока не истечет
+по ttl или не будет вытеснена; чтобы не терять ее, после изменения списка шардов отправьте события
+заново через events_loader.py (он распределяет события по новому списку шардов).
+
+Хеши не зависят от процесса и запуска (blake2b для точек шардов и splitmix64 для user_id),
+поэтому основной сервис, events_loader.py и test_service.py направляют пользователя на один и тот же шард.
+"""
+
+import hashlib
+from bisect import bisect_left
+import numpy as np
+
+
+MASK64 = (1 << 64) - 1
+
+
+def hash_user_id(user_id):
+    """
+    Возвращает 64-битный хеш user_id (финализатор splitmix64)
+    """
+    x = (int(user_id) + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+
+    return x ^ (x >> 31)
+
+
+def hash_user_ids(user_ids):
+    """
+    Векторизованный hash_user_id для массива user_id (умножение uint64 - по модулю 2^64)
+    """
+    x = np.asarray(user_ids).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return x ^ (x >> np.uint64(31))
+
+
+def parse_urls(value):
+    """
+    Разбирает список url из config.ini: через запятую, в кавычках или без
+    """
+    return [url.strip().strip('"') for url in value.split(",") if url.strip().strip('"')]
+
+
+class HashRing:
+    """
+    Кольцо консистентного хеширования шардов с виртуальными узлами
+    """
+
+    def __init__(self, nodes, virtual_nodes=100):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+
+        self.nodes = list(nodes)
+        self.virtual_nodes = virtual_nodes
+
+        # Точки кольца (отсортированные хеши) и номер шарда каждой точки
+        points = sorted(
+            (int.from_bytes(hashlib.blake2b(f"{node}#{i}".encode(), digest_size=8).digest(), "little"), n)
+            for n, node in enumerate(self.nodes) for i in range(virtual_nodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [n for _, n in points]
+        self._points_array = np.array(self._points, dtype=np.uint64)
+        self._owners_array = np.array(self._owners, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def index(self, user_id):
+        """
+        Возвращает номер шарда пользователя
+        """
+        pos = bisect_left(self._points, hash_user_id(user_id))
+
+        return self._owners[pos if pos < len(self._points) else 0]
+
+    def node(self, user_id):
+        """
+        Возвращает шард (url) пользователя
+        """
+        return self.nodes[self.index(user_id)]
+
+    def assign(self, user_ids):
+        """
+        Возвращает номера шардов для массива user_id
+        """
+        pos = np.searchsorted(self._points_array, hash_user_ids(user_ids), side="left")
+
+        return self._owners_array[np.where(pos < len(self._points_array), pos, 0)]
@@ -0,0 +1,179 @@
+"""
+Клиенты основного сервиса рекомендаций для обращения к вспомогательным сервисам
+(хранилищу онлайн-событий и хранилищу похожих объектов).
+
+Оба клиента реализуют общий интерфейс StoresClient:
+- HttpStoresClient обращается к events_service и features_service по http, используя один общий
+асинхронный http-клиент с пулом keep-alive соединений, таймаутами на каждый запрос и ограничением
+на количество одновременных запросов (для распределенного развертывания); ответы запрашиваются
+в двоичном формате (см. encoding.py); при нескольких шардах events_service запрос событий
+пользователя отправляется шарду, которому он принадлежит (см. sharding.py);
+- EmbeddedStoresClient напрямую вызывает объекты EventStore и SimilarItems в том же процессе,
+без сериализации и http-запросов (встроенный режим для небольших развертываний).
+"""
+
+import asyncio
+import logging
+import httpx
+import numpy as np
+from encoding import BINARY_MEDIA_TYPE, decode_response
+from sharding import HashRing
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class StoresClient:
+    """
+    Общий интерфейс клиентов для обращения к хранилищам событий и похожих объектов
+    """
+
+    async def start(self):
+        """
+        Подготавливает клиент к работе (вызывается один раз при запуске сервиса)
+        """
+
+    async def close(self):
+        """
+        Освобождает ресурсы клиента (вызывается один раз при остановке сервиса)
+        """
+
+    async def get_events(self, user_id: int, k: int = 10):
+        """
+        Возвращает список последних k онлайн-событий пользователя и версию его истории событий
+        (None, если хранилище недоступно)
+        """
+        raise NotImplementedError
+
+    async def get_similar_items(self, item_ids, k: int = 10, exclude_seed: bool = False):
+        """
+        Возвращает объединенный список объектов, похожих на item_ids
+        """
+        raise NotImplementedError
+
+
+class HttpStoresClient(StoresClient):
+    """
+    Асинхронный клиент для обращения к events_service и features_service по http
+    """
+
+    def __init__(self, events_store_url, features_store_url,
+                 timeout=1.0, max_connections=100, max_concurrency=100,
+                 events_store_shards=None, virtual_nodes=100, transport=None):
+
+        self.events_store_url = events_store_url
+        self.features_store_url = features_store_url
+        # Шарды events_service (один шард - events_store_url)
+        self.events_ring = HashRing(events_store_shards or [events_store_url], virtual_nodes)
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        # Транспорт httpx (None - обычные http-соединения; в тестах - приложения в том же процессе)
+        self.transport = transport
+
+        self._client = None
+        self._semaphore = None
+
+    async def start(self):
+        """
+        Создает общий http-клиент с пулом соединений
+        """
+        self._client = httpx.AsyncClient(
+            headers={"Accept": BINARY_MEDIA_TYPE},
+            timeout=httpx.Timeout(self.timeout),
+            transport=self.transport,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        """
+        Закрывает http-клиент и все открытые соединения
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, url, params, timeout=None):
+        """
+        Отправляет POST-запрос и возвращает ответ в виде словаря
+        (массивы из двоичного ответа - в виде NumPy-массивов)
+        """
+        async with self._semaphore:
+            resp = await self._client.post(url, params=params, timeout=timeout or self.timeout)
+        resp.raise_for_status()
+
+        return decode_response(resp)
+
+    async def get_events(self, user_id: int, k: int = 10):
+        """
+        Возвращает список последних k онлайн-событий пользователя и версию его истории событий
+        """
+        try:
+            events_store_url = self.events_ring.node(user_id)
+            resp = await self._post(events_store_url + "/get", {"user_id": user_id, "k": k})
+            events, version = np.asarray(resp["events"]).tolist(), resp.get("version")
+        except Exception as e:
+            logger.error(f"{e!r}, events store is unavailable")
+            events, version = [], None
+
+        return events, version
+
+    async def get_similar_items(self, item_ids, k: int = 10, exclude_seed: bool = False):
+        """
+        Возвращает объединенный список объектов, похожих на item_ids
+        """
+        try:
+            params = {"item_ids": list(item_ids), "k": k, "exclude_seed": exclude_seed}
+            i2i = await self._post(self.features_store_url + "/similar_items_batch", params)
+        except Exception as e:
+            logger.error(f"{e!r}, features store is unavailable")
+            i2i = {"item_id_2": [], "score": []}
+
+        return i2i
+
+
+class EmbeddedStoresClient(StoresClient):
+    """
+    Клиент, работающий с объектами EventStore и SimilarItems в том же процессе
+    """
+
+    def __init__(self, events_store, sim_items_store, similar_items_path=None, use_mmap=False):
+
+        self.events_store = events_store
+        self.sim_items_store = sim_items_store
+        self.similar_items_path = similar_items_path
+        self.use_mmap = use_mmap
+
+    async def start(self):
+        """
+        Загружает похожие объекты из файла, если он задан
+        """
+        if self.similar_items_path is not None:
+            self.sim_items_store.load(
+                self.similar_items_path,
+                use_mmap=self.use_mmap,
+                columns=["item_id_1", "item_id_2", "score"],
+            )
+
+    async def get_events(self, user_id: int, k: int = 10):
+        """
+        Возвращает список последних k онлайн-событий пользователя и версию его истории событий
+        """
+        try:
+            events = self.events_store.get(user_id, k).tolist()
+            version = self.events_store.version(user_id)
+        except Exception as e:
+            logger.error(f"{e!r}, events store is unavailable")
+            events, version = [], None
+
+        return events, version
+
+    async def get_similar_items(self, item_ids, k: int = 10, exclude_seed: bool = False):
+        """
+        Возвращает объединенный список объектов, похожих на item_ids
+        """
+        return self.sim_items_store.get_batch(item_ids, k, exclude_seed)
@@ -0,0 +1,75 @@
+"""
+Тесты совпадения fold-in в als_foldin.py с вычислением вектора пользователя в implicit
+(AlternatingLeastSquares.recalculate_user) на небольшой обученной модели.
+
+Запуск:
+python -m pytest -q test_als_foldin.py
+"""
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from als_foldin import ALSFoldIn
+
+implicit_als = pytest.importorskip("implicit.cpu.als")
+
+
+N_USERS = 200
+N_ITEMS = 300
+
+
+def fit_model(alpha):
+    """
+    Обучает ALS-модель implicit на случайных взаимодействиях
+    """
+    rng = np.random.default_rng(0)
+    user_items = sp.random(N_USERS, N_ITEMS, density=0.05, format="csr", dtype=np.float32, random_state=rng)
+    user_items.data[:] = 1.0
+    model = implicit_als.AlternatingLeastSquares(factors=16, regularization=0.1, alpha=alpha, iterations=5,
+                                                 random_state=0, num_threads=1)
+    model.fit(user_items, show_progress=False)
+
+    return model
+
+
+@pytest.fixture(params=[1.0, 4.0], ids=["alpha=1", "alpha=4"])
+def models(request, tmp_path):
+    """
+    Обученная модель implicit и загруженные из нее факторы ALSFoldIn (item_id = номер строки * 10)
+    """
+    model = fit_model(request.param)
+    ALSFoldIn.save(str(tmp_path / "als.idx"), np.arange(N_ITEMS) * 10, model.item_factors,
+                   model.regularization, model.alpha)
+    als_store = ALSFoldIn()
+    als_store.load(str(tmp_path / "als.idx"))
+
+    return model, als_store
+
+
+def recalculate_user(model, rows):
+    user_items = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (np.zeros(len(rows)), rows)),
+                               shape=(1, N_ITEMS))
+    return model.recalculate_user(0, user_items)
+
+
+@pytest.mark.parametrize("rows", [[5], [1, 17, 42], list(range(0, 200, 20))])
+def test_fold_in_matches_implicit(models, rows):
+    model, als_store = models
+    expected = recalculate_user(model, rows)
+    actual = als_store.fold_in(np.array(rows))
+
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_get_matches_implicit_scores(models):
+    model, als_store = models
+    rows = np.array([3, 8, 99, 250])
+    scores = model.item_factors @ recalculate_user(model, rows)
+    scores[rows] = -np.inf
+
+    recs = als_store.get(rows * 10, k=20)
+
+    # те же объекты (с точностью до близких оценок на границе top-k) и те же оценки
+    np.testing.assert_allclose(recs["score"], np.sort(scores)[::-1][:20], rtol=1e-4, atol=1e-6)
+    assert not np.isin(recs["item_id"], rows * 10).any()
+    np.testing.assert_allclose(scores[recs["item_id"] // 10], recs["score"], rtol=1e-4, atol=1e-6)
@@ -0,0 +1,122 @@
+"""
+Тесты совпадения функций blending.py с прежними реализациями смешивания на списках Python
+(цикл чередования и dedup_ids из recommendations_service.py, объединение кандидатов из features_service.py)
+на случайных списках разной длины, с повторами и пересечениями.
+
+Запуск:
+python -m pytest -q test_blending.py
+"""
+
+import numpy as np
+import pytest
+from blending import blend, dedup, filter_seen, interleave, merge_by_score, rrf, weighted_fusion
+
+
+# Прежние реализации (для сравнения)
+
+def legacy_dedup(ids):
+    seen = set()
+    return [id for id in ids if not (id in seen or seen.add(id))]
+
+
+def legacy_interleave(recs_offline, recs_online):
+    recs_blended = []
+    min_length = min(len(recs_offline), len(recs_online))
+    offline_idx = online_idx = 0
+    for i in range(2 * min_length):
+        if i % 2 == 0:
+            recs_blended.append(recs_offline[offline_idx])
+            offline_idx += 1
+        else:
+            recs_blended.append(recs_online[online_idx])
+            online_idx += 1
+    if len(recs_offline) >= len(recs_online):
+        recs_blended.extend(recs_offline[offline_idx:])
+    else:
+        recs_blended.extend(recs_online[online_idx:])
+
+    return recs_blended
+
+
+def legacy_filter_seen(ids, seen):
+    seen = set(seen)
+    return [id for id in ids if id not in seen]
+
+
+def legacy_merge_by_score(ids, scores):
+    # сортировка по убыванию score с сохранением исходного порядка при равных score,
+    # затем первое вхождение каждого объекта
+    order = sorted(range(len(ids)), key=lambda i: -scores[i])
+    return legacy_dedup([ids[i] for i in order])
+
+
+def random_lists(rng, k=100):
+    """
+    Возвращает два случайных списка длиной от 0 до 2k из общего небольшого множества
+    объектов (поэтому в них много повторов и пересечений) и случайную длину выдачи
+    """
+    n_items = int(rng.integers(1, 3 * k))
+    recs_offline = rng.integers(0, n_items, int(rng.integers(0, 2 * k))).tolist()
+    recs_online = rng.integers(0, n_items, int(rng.integers(0, 2 * k))).tolist()
+
+    return recs_offline, recs_online, n_items, int(rng.integers(0, 2 * k))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_interleave_and_dedup_match_legacy(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        recs_offline, recs_online, _, k = random_lists(rng)
+        expected = legacy_interleave(recs_offline, recs_online)
+
+        assert interleave([recs_offline, recs_online]).tolist() == expected
+        assert dedup(expected).tolist() == legacy_dedup(expected)
+        assert blend([recs_offline, recs_online], strategy="interleave", k=k).tolist() == legacy_dedup(expected)[:k]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_filter_seen_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        recs_offline, recs_online, n_items, k = random_lists(rng)
+        seen = rng.integers(0, n_items, int(rng.integers(0, 50))).tolist()
+
+        assert filter_seen(recs_offline, seen).tolist() == legacy_filter_seen(recs_offline, seen)
+        expected = legacy_filter_seen(legacy_dedup(legacy_interleave(recs_offline, recs_online)), seen)[:k]
+        assert blend([recs_offline, recs_online], seen=seen, k=k).tolist() == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_merge_by_score_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        n = int(rng.integers(0, 300))
+        ids = rng.integers(0, max(n // 2, 1), n).tolist()
+        # оценки из небольшого набора значений, чтобы проверить порядок при равных score
+        scores = rng.integers(0, 10, n).astype(np.float32).tolist()
+
+        merged_ids, merged_scores = merge_by_score(ids, scores)
+        assert merged_ids.tolist() == legacy_merge_by_score(ids, scores)
+        assert np.all(np.diff(merged_scores) <= 0)
+
+
+def test_empty_lists():
+    assert blend([[], []]).tolist() == []
+    assert blend([[1, 2, 2], []], k=5).tolist() == [1, 2]
+    assert blend([[], [3, 3, 4]], strategy="rrf").tolist() == [3, 4]
+    assert filter_seen([], [1]).tolist() == []
+
+
+@pytest.mark.parametrize("strategy", ["weighted", "rrf"])
+def test_fusion_strategies(strategy):
+    # объект из обоих списков получает наибольшую суммарную оценку и идет первым
+    recs = blend([[1, 3, 2], [4, 3, 5]], strategy=strategy)
+
+    assert recs[0] == 3
+    assert sorted(recs.tolist()) == [1, 2, 3, 4, 5]
+
+
+def test_fusion_weights():
+    # при нулевом весе второго списка порядок совпадает с первым списком
+    assert weighted_fusion([[1, 2, 3], [3, 2, 1]], weights=[1.0, 0.0]).tolist() == [1, 2, 3]
+    assert rrf([[1, 2, 3], [3, 2, 1]], weights=[1.0, 0.0]).tolist() == [1, 2, 3]
@@ -0,0 +1,31 @@
+"""
+Тесты сохранения массивов индексов на диск (csr_index.py).
+
+Запуск:
+python -m pytest -q test_csr_index.py
+"""
+
+import os
+import numpy as np
+from csr_index import save_arrays, load_arrays
+
+
+def test_save_arrays_replaces_directory(tmp_path):
+    directory = str(tmp_path / "recs.idx")
+    save_arrays(directory, {"item_id": np.arange(3)})
+    save_arrays(directory, {"item_id": np.arange(4)})
+
+    assert load_arrays(directory)["item_id"].tolist() == [0, 1, 2, 3]
+    assert os.listdir(tmp_path) == ["recs.idx"]
+
+
+def test_load_arrays_during_swap(tmp_path):
+    directory = str(tmp_path / "recs.idx")
+    save_arrays(directory, {"item_id": np.arange(3)})
+    # состояние между переименованиями в save_arrays (или после прерванной замены)
+    os.rename(directory, directory + ".old")
+    assert load_arrays(directory)["item_id"].tolist() == [0, 1, 2]
+
+    save_arrays(directory, {"item_id": np.arange(4)})
+    assert load_arrays(directory)["item_id"].tolist() == [0, 1, 2, 3]
+    assert os.listdir(tmp_path) == ["recs.idx"]
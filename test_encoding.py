@@ -0,0 +1,126 @@
+"""
+Тесты кодирования ответов сервисов в JSON и в двоичный формат (encoding.py).
+
+Запуск:
+python -m pytest -q test_encoding.py
+"""
+
+import json
+import struct
+import numpy as np
+import pytest
+from fastapi import FastAPI, Header
+from fastapi.testclient import TestClient
+from encoding import (BINARY_MEDIA_TYPE, JSON_MEDIA_TYPE, PrecomputedResponse, decode_response, dumps,
+                      encode_response, pack, unpack)
+
+
+CONTENT = {
+    "recs": [3, 1, 2],
+    "big": [1, 2**40],
+    "scores": np.array([0.5, 0.25], dtype=np.float32),
+    "exact": np.array([0.1, 0.2]),
+    "empty": [],
+    "version": "20240101-000000",
+    "missing": None,
+    "names": ["a", "b"],
+}
+
+
+def test_pack_round_trip():
+    content = unpack(pack(CONTENT))
+
+    assert list(content) == list(CONTENT)
+    assert content["recs"].dtype == np.dtype("<i4") and content["recs"].tolist() == [3, 1, 2]
+    assert content["big"].dtype == np.dtype("<i8") and content["big"].tolist() == [1, 2**40]
+    assert content["scores"].dtype == np.dtype("<f4") and content["scores"].tolist() == [0.5, 0.25]
+    assert content["exact"].dtype == np.dtype("<f8") and content["exact"].tolist() == [0.1, 0.2]
+    assert len(content["empty"]) == 0
+    # остальные значения передаются в JSON
+    assert content["version"] == "20240101-000000" and content["missing"] is None
+    assert content["names"] == ["a", "b"]
+    assert dumps(content) == dumps(CONTENT)
+
+
+def test_pack_header_and_endianness():
+    # массивы с обратным порядком байтов кодируются в little-endian
+    data = pack({"ids": np.array([1, 256], dtype=">i4"), "v": 1})
+
+    assert data[:4] == b"PKA1" and struct.unpack_from("<H", data, 4) == (2,)
+    assert data[6:10] == b"\x03ids" and data[10:13] == b"ai4"
+    assert struct.unpack_from("<I", data, 13) == (2,)
+    assert data[17:25] == struct.pack("<2i", 1, 256)
+    assert data[25:28] == b"\x01vj" and struct.unpack_from("<I", data, 28) == (1,) and data[32:] == b"1"
+    assert unpack(data)["ids"].tolist() == [1, 256]
+
+
+def test_unpack_errors():
+    with pytest.raises(ValueError):
+        unpack(b"JSON" + pack({"a": 1})[4:])
+    with pytest.raises(ValueError):
+        unpack(b"PKA1" + struct.pack("<H", 1) + b"\x01ax")
+
+
+def test_dumps_numpy():
+    content = {"ids": np.arange(3), "n": np.int64(5), "score": np.float32(0.5), "name": "трек"}
+
+    assert json.loads(dumps(content)) == {"ids": [0, 1, 2], "n": 5, "score": 0.5, "name": "трек"}
+    assert "трек".encode() in dumps(content)
+
+
+@pytest.fixture
+def client():
+    """
+    Клиент приложения, которое кодирует ответ по заголовку Accept
+    """
+    app = FastAPI()
+
+    @app.get("/encoded")
+    async def encoded(accept: str | None = Header(None)):
+        return encode_response(CONTENT, accept)
+
+    @app.get("/precomputed")
+    async def precomputed(k: int, accept: str | None = Header(None)):
+        return PrecomputedResponse([5, 4, 3], extra={"version": "v1"}).response(k, accept)
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.mark.parametrize("accept", [None, "application/json", "*/*"])
+def test_accept_json(client, accept):
+    headers = {"Accept": accept} if accept is not None else {}
+    resp = client.get("/encoded", headers=headers)
+
+    assert resp.headers["content-type"] == JSON_MEDIA_TYPE
+    assert resp.content == dumps(CONTENT) and decode_response(resp) == json.loads(dumps(CONTENT))
+
+    resp = client.get("/precomputed", params={"k": 2}, headers=headers)
+    assert resp.headers["content-type"] == JSON_MEDIA_TYPE and resp.json() == {"recs": [5, 4], "version": "v1"}
+
+
+@pytest.mark.parametrize("accept", [BINARY_MEDIA_TYPE, f"{BINARY_MEDIA_TYPE}, application/json"])
+def test_accept_binary(client, accept):
+    resp = client.get("/encoded", headers={"Accept": accept})
+
+    assert resp.headers["content-type"] == BINARY_MEDIA_TYPE
+    assert resp.content == pack(CONTENT) and dumps(decode_response(resp)) == dumps(CONTENT)
+
+    resp = client.get("/precomputed", params={"k": 2}, headers={"Accept": accept})
+    content = decode_response(resp)
+    assert resp.headers["content-type"] == BINARY_MEDIA_TYPE
+    assert content["recs"].tolist() == [5, 4] and content["version"] == "v1"
+
+
+@pytest.mark.parametrize("values", [[7, 3, 12, 100500, 1], np.arange(50, dtype=np.int64), [0.5, 0.25], []])
+@pytest.mark.parametrize("extra", [None, {"version": "v1", "n": 2}])
+def test_precomputed_matches_encoding(values, extra):
+    response = PrecomputedResponse(values, extra=extra, ks=(1, 3))
+
+    for k in (0, 1, 2, 3, len(values), len(values) + 5, -1):
+        content = {"recs": values[:k], **(extra or {})}
+        assert response.body(k) == dumps(content)
+        # тип пустого массива выбирается по всему списку, а не по срезу
+        if len(content["recs"]) > 0:
+            assert response.body(k, binary=True) == pack(content)
+        assert dumps(unpack(response.body(k, binary=True))) == dumps(content)
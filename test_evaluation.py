@@ -0,0 +1,134 @@
+"""
+Тесты совпадения метрик Evaluator (evaluation.py) с расчетом через merge и groupby pandas,
+как в ноутбуке recommendations.ipynb (process_events_recs_for_binary_metrics, compute_cls_metrics,
+novelty и coverage), на случайных событиях и рекомендациях с повторяющимися строками.
+
+Запуск:
+python -m pytest -q test_evaluation.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from evaluation import Evaluator
+
+
+N_USERS = 60
+N_ITEMS = 80
+
+
+# Расчет, как в ноутбуке (для сравнения)
+
+def process_events_recs_for_binary_metrics(events_train, events_test, recs, top_k):
+    events_test = events_test.assign(gt=True)
+    common_users = set(events_test["user_id"]) & set(recs["user_id"])
+    events_for_common_users = events_test[events_test["user_id"].isin(common_users)]
+    recs_for_common_users = recs[recs["user_id"].isin(common_users)].sort_values(["user_id", "score"],
+                                                                                 ascending=[True, False])
+    events_for_common_users = events_for_common_users[events_for_common_users["item_id"].isin(events_train["item_id"].unique())]
+    recs_for_common_users = recs_for_common_users.groupby("user_id").head(top_k)
+
+    events_recs_common = events_for_common_users[["user_id", "item_id", "gt"]].merge(
+        recs_for_common_users[["user_id", "item_id", "score"]], on=["user_id", "item_id"], how="outer")
+    events_recs_common["gt"] = events_recs_common["gt"].fillna(False).astype(bool)
+    events_recs_common["pr"] = ~events_recs_common["score"].isnull()
+    events_recs_common["tp"] = events_recs_common["gt"] & events_recs_common["pr"]
+    events_recs_common["fp"] = ~events_recs_common["gt"] & events_recs_common["pr"]
+    events_recs_common["fn"] = events_recs_common["gt"] & ~events_recs_common["pr"]
+
+    return events_recs_common
+
+
+def compute_cls_metrics(events_recs_for_binary_metric):
+    groupper = events_recs_for_binary_metric.groupby("user_id")
+    precision = groupper["tp"].sum() / (groupper["tp"].sum() + groupper["fp"].sum())
+    recall = groupper["tp"].sum() / (groupper["tp"].sum() + groupper["fn"].sum())
+
+    return precision.fillna(0).mean(), recall.fillna(0).mean()
+
+
+def compute_novelty(events_train, recs, top_k):
+    recs = recs.merge(events_train[["user_id", "item_id"]].assign(played=True), on=["user_id", "item_id"], how="left")
+    recs["played"] = recs["played"].fillna(False).astype("bool")
+    recs = recs.sort_values(by="score", ascending=False, kind="stable")
+    recs["rank"] = recs.groupby("user_id").cumcount() + 1
+
+    return (1 - recs.query("rank <= @top_k").groupby("user_id")["played"].mean()).mean()
+
+
+def compute_ndcg(events_train, events_test, recs, top_k):
+    """
+    NDCG@k с бинарной релевантностью по событиям test с объектами из train (по общим пользователям)
+    """
+    relevant = events_test[events_test["item_id"].isin(events_train["item_id"])].groupby("user_id")["item_id"].agg(set)
+    values = []
+    for user_id, user_recs in recs.groupby("user_id"):
+        if user_id not in set(events_test["user_id"]):
+            continue
+        items = relevant.get(user_id, set())
+        top = user_recs.sort_values("score", ascending=False)["item_id"].tolist()[:top_k]
+        dcg = sum(1 / np.log2(rank + 2) for rank, item_id in enumerate(top) if item_id in items)
+        idcg = sum(1 / np.log2(rank + 2) for rank in range(min(len(items), top_k)))
+        values.append(dcg / idcg if idcg > 0 else 0.0)
+
+    return np.mean(values)
+
+
+def make_data(seed=0):
+    """
+    Возвращает события train, test и рекомендации: события и рекомендации повторяются,
+    часть пользователей и объектов рекомендаций отсутствует в событиях
+    """
+    rng = np.random.default_rng(seed)
+    n = 3000
+    events = pd.DataFrame({
+        "user_id": rng.integers(0, N_USERS, n),
+        "item_id": (rng.zipf(1.3, n) - 1) % N_ITEMS,
+        "is_train": rng.random(n) < 0.8,
+    })
+    # объекты 70..79 встречаются только в test
+    events = events[events["is_train"] | (events["item_id"] < 70) | (rng.random(n) < 0.5)]
+    events = events[~(events["is_train"] & (events["item_id"] >= 70))]
+    events_train, events_test = events[events["is_train"]], events[~events["is_train"]]
+
+    n_recs = 4000
+    recs = pd.DataFrame({
+        # пользователи 60..64 - без событий
+        "user_id": rng.integers(0, N_USERS + 5, n_recs),
+        # объекты 80..84 - вне каталога
+        "item_id": rng.integers(0, N_ITEMS + 5, n_recs),
+        "score": rng.permutation(n_recs) / n_recs,
+    })
+    # повторяющиеся строки рекомендаций (с тем же score)
+    recs = pd.concat([recs, recs.sample(500, random_state=seed)], ignore_index=True)
+
+    return events_train, events_test, recs
+
+
+@pytest.mark.parametrize("k", [1, 5, 20])
+@pytest.mark.parametrize("n_shards", [1, 4])
+def test_matches_pandas(k, n_shards):
+    events_train, events_test, recs = make_data()
+    precision, recall = compute_cls_metrics(process_events_recs_for_binary_metrics(events_train, events_test, recs, k))
+
+    evaluator = Evaluator(events_train, events_test, np.arange(N_ITEMS))
+    metrics = evaluator.evaluate(recs, k, n_shards=n_shards)
+
+    assert metrics["users"] == len(set(events_test["user_id"]) & set(recs["user_id"]))
+    assert np.isclose(metrics["precision"], precision)
+    assert np.isclose(metrics["recall"], recall)
+    assert np.isclose(metrics["novelty"], compute_novelty(events_train, recs, k))
+    assert np.isclose(metrics["ndcg"], compute_ndcg(events_train, events_test, recs, k))
+    assert np.isclose(metrics["coverage"], recs["item_id"].nunique() / N_ITEMS)
+
+
+def test_shards_match():
+    events_train, events_test, recs = make_data(seed=1)
+    evaluator = Evaluator(events_train, events_test, np.arange(N_ITEMS))
+
+    expected = evaluator.evaluate(recs, 5)
+    for n_shards in (2, 3, 7, 100):
+        metrics = evaluator.evaluate(recs, 5, n_shards=n_shards)
+        assert metrics.keys() == expected.keys()
+        assert all(np.isclose(metrics[name], expected[name]) for name in expected)
+    assert evaluator.evaluate(recs, 5, n_shards=3, workers=2) == pytest.approx(expected)
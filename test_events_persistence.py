@@ -0,0 +1,147 @@
+"""
+Тесты сохранения хранилища онлайн-событий на диск (events_persistence.py):
+восстановление из контрольной точки и журнала, переключение CURRENT и копирование снимка частями.
+
+Запуск:
+python -m pytest -q test_events_persistence.py
+"""
+
+import os
+import asyncio
+import numpy as np
+from events_service import EventStore
+from events_persistence import EventStorePersistence, LOG_RECORD
+
+
+def random_events(n_events, n_users=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return zip(rng.integers(0, n_users, n_events).tolist(), rng.integers(0, 1000, n_events).tolist())
+
+
+def put(persistence, user_id, item_id):
+    """
+    Сохраняет событие так же, как /put в events_service
+    """
+    persistence.events_store.put(user_id, item_id)
+    persistence.record(user_id, item_id)
+
+
+def restored(directory, **kwargs):
+    """
+    Возвращает хранилище, восстановленное из директории, как при перезапуске сервиса
+    """
+    store = EventStore(max_events_per_user=3, **kwargs)
+    persistence = EventStorePersistence(store, directory)
+    persistence.restore()
+    persistence._log.close()
+
+    return store
+
+
+def assert_same(store, expected, n_users=30):
+    assert len(store) == len(expected)
+    for user_id in range(n_users):
+        assert store.get(user_id, 3).tolist() == expected.get(user_id, 3).tolist()
+
+
+def test_restore_from_checkpoint_and_log(tmp_path):
+    async def run():
+        persistence = EventStorePersistence(EventStore(max_events_per_user=3, initial_capacity=4), tmp_path)
+        persistence.restore()
+        for user_id, item_id in random_events(300, seed=0):
+            put(persistence, user_id, item_id)
+        await persistence.checkpoint()
+        # события после контрольной точки есть только в журнале
+        for user_id, item_id in random_events(100, n_users=40, seed=1):
+            put(persistence, user_id, item_id)
+        await persistence.flush()
+        persistence._log.close()
+
+        return persistence.events_store
+
+    store = asyncio.run(run())
+
+    assert (tmp_path / "CURRENT").read_text() == "checkpoint.00000001"
+    assert os.path.getsize(tmp_path / "events.00000001.log") == 100 * LOG_RECORD.itemsize
+    assert_same(restored(tmp_path), store, n_users=40)
+
+
+def test_restore_ignores_torn_record(tmp_path):
+    store = EventStore(max_events_per_user=3)
+    records = np.array(list(random_events(50)), dtype=LOG_RECORD)
+    for user_id, item_id in random_events(50):
+        store.put(user_id, item_id)
+    # последняя запись журнала записана не полностью
+    torn = np.array([(7, 1)], dtype=LOG_RECORD).tobytes()[:5]
+    (tmp_path / "events.00000000.log").write_bytes(records.tobytes() + torn)
+
+    assert_same(restored(tmp_path), store)
+
+
+def test_current_switch(tmp_path):
+    async def run():
+        persistence = EventStorePersistence(EventStore(max_events_per_user=3), tmp_path)
+        persistence.restore()
+        for i, (user_id, item_id) in enumerate(random_events(90)):
+            put(persistence, user_id, item_id)
+            if i % 30 == 29:
+                await persistence.checkpoint()
+        await persistence.close()
+
+        return persistence.events_store
+
+    store = asyncio.run(run())
+
+    # остаются только последняя контрольная точка и журнал после нее
+    assert (tmp_path / "CURRENT").read_text() == "checkpoint.00000004"
+    assert sorted(os.listdir(tmp_path)) == ["CURRENT", "checkpoint.00000004", "events.00000004.log"]
+
+    # незавершенная контрольная точка (CURRENT на нее не переключен) не используется
+    os.makedirs(tmp_path / "checkpoint.00000005")
+    (tmp_path / "checkpoint.00000005" / "meta.json").write_text('{"generation": 5, "users": 0}')
+    assert_same(restored(tmp_path), store)
+
+
+def test_snapshot_matches_state_at_start():
+    store = EventStore(max_events_per_user=3, max_users=40, initial_capacity=8)
+    for user_id, item_id in random_events(200):
+        store.put(user_id, item_id)
+    expected = store.to_arrays()
+
+    store.start_snapshot()
+    events = random_events(400, n_users=100, seed=1)
+    # между копированием частей меняются скопированные и нескопированные слоты,
+    # добавляются новые пользователи (с вытеснением и увеличением емкости)
+    while not store.copy_snapshot_part(3):
+        for user_id, item_id in [next(events) for _ in range(20)]:
+            store.put(user_id, item_id)
+    snapshot = store.finish_snapshot()
+
+    for name in ("events", "heads", "counts", "slot_users"):
+        assert np.array_equal(snapshot[name], expected[name]), name
+    assert np.allclose(snapshot["updated_at"], expected["updated_at"])
+    assert store._snapshot is None and not store._snapshot_saved
+
+
+def test_checkpoint_concurrent_with_puts(tmp_path):
+    async def writer(persistence, events):
+        for user_id, item_id in events:
+            put(persistence, user_id, item_id)
+            await asyncio.sleep(0)
+
+    async def run():
+        store = EventStore(max_events_per_user=3, initial_capacity=8)
+        persistence = EventStorePersistence(store, tmp_path, snapshot_chunk_slots=2)
+        persistence.restore()
+        for user_id, item_id in random_events(200, n_users=60):
+            put(persistence, user_id, item_id)
+        # события записываются, пока снимок копируется частями
+        await asyncio.gather(persistence.checkpoint(), writer(persistence, random_events(300, n_users=80, seed=1)))
+        await persistence.flush()
+        persistence._log.close()
+
+        return store
+
+    store = asyncio.run(run())
+
+    assert_same(restored(tmp_path), store, n_users=80)
@@ -0,0 +1,287 @@
+"""
+Тесты хранилища онлайн-событий EventStore, запросов к events_service
+(через TestClient к приложению в том же процессе) и потоковой загрузки событий из parquet-файла.
+
+Запуск:
+python -m pytest -q test_events_service.py
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from fastapi.testclient import TestClient
+import events_service
+from events_service import EventStore
+from events_loader import iter_event_batches, load_events
+from sharding import HashRing
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Управляемое время time.monotonic для проверки вытеснения по ttl
+    """
+    now = [1000.0]
+    monkeypatch.setattr("events_service.time.monotonic", lambda: now[0])
+
+    return now
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+    Клиент events_service с отдельным хранилищем событий
+    """
+    events_store = EventStore(max_events_per_user=3)
+    monkeypatch.setattr(events_service, "events_store", events_store)
+    monkeypatch.setattr(events_service, "events_persistence", None)
+    monkeypatch.setattr(events_service, "warmup_path", "")
+
+    with TestClient(events_service.app) as client:
+        client.events_store = events_store
+        yield client
+
+
+def test_wraparound_order():
+    store = EventStore(max_events_per_user=3, initial_capacity=2)
+    for item_id in range(1, 8):
+        store.put(1, item_id)
+        # последние события от новых к старым, не больше max_events_per_user
+        expected = list(range(item_id, max(item_id - 3, 0), -1))
+        assert store.get(1, 10).tolist() == expected
+        assert store._counts[store._slots[1]] == len(expected)
+
+    assert store.get(1, 2).tolist() == [7, 6]
+    assert store.get(1, 0).tolist() == []
+    assert store.get(2, 3).tolist() == []
+
+
+def test_versions():
+    store = EventStore(max_events_per_user=3)
+    assert store.version(1) == 0
+
+    store.put(1, 10)
+    first = store.version(1)
+    store.put(2, 20)
+    assert store.version(1) == first
+    store.put(1, 10)
+    assert store.version(1) > first
+
+
+def test_grow_keeps_events():
+    store = EventStore(max_events_per_user=2, initial_capacity=1)
+    for user_id in range(10):
+        store.put(user_id, user_id)
+        store.put(user_id, user_id + 100)
+
+    assert len(store) == 10 and len(store._heads) >= 10
+    assert [store.get(user_id, 2).tolist() for user_id in range(10)] == [[u + 100, u] for u in range(10)]
+
+
+def test_max_users_reuses_oldest_slot(clock):
+    store = EventStore(max_events_per_user=3, max_users=3)
+    for user_id in range(3):
+        clock[0] += 1
+        store.put(user_id, user_id)
+    # событие продлевает хранение пользователя 0, поэтому самый давний - пользователь 1
+    clock[0] += 1
+    store.put(0, 10)
+    slot = store._slots[1]
+
+    clock[0] += 1
+    store.put(3, 30)
+
+    assert len(store) == 3 and 1 not in store._slots
+    assert store._slots[3] == slot
+    # в повторно использованном слоте нет событий прежнего пользователя
+    assert store.get(3, 3).tolist() == [30]
+    assert store.get(1, 3).tolist() == [] and store.version(1) == 0
+    assert store.get(0, 3).tolist() == [10, 0]
+
+
+def test_ttl_eviction(clock):
+    store = EventStore(max_events_per_user=3, ttl=10)
+    store.put(1, 10)
+    clock[0] += 5
+    store.put(2, 20)
+
+    # устаревший пользователь не возвращается, даже пока он не вытеснен
+    clock[0] += 6
+    assert store.get(1, 3).tolist() == [] and store.version(1) == 0
+    assert store.get(2, 3).tolist() == [20]
+
+    # вытесняется при появлении нового пользователя, его слот освобождается
+    slot = store._slots[1]
+    store.put(3, 30)
+    assert 1 not in store._slots and 2 in store._slots
+    assert store._slots[3] == slot
+
+
+def test_arrays_round_trip():
+    store = EventStore(max_events_per_user=3, initial_capacity=4)
+    rng = np.random.default_rng(0)
+    for user_id, item_id in zip(rng.integers(0, 20, 200).tolist(), rng.integers(0, 1000, 200).tolist()):
+        store.put(user_id, item_id)
+
+    restored = EventStore(max_events_per_user=3)
+    restored.load_arrays(store.to_arrays())
+
+    assert len(restored) == len(store)
+    for user_id in range(20):
+        assert restored.get(user_id, 3).tolist() == store.get(user_id, 3).tolist()
+        assert restored.version(user_id) > 0
+    # восстановленное хранилище продолжает принимать события
+    restored.put(100, 1)
+    restored.put(0, 2)
+    assert restored.get(100, 3).tolist() == [1]
+    assert restored.get(0, 3).tolist() == [2] + store.get(0, 2).tolist()
+
+    with pytest.raises(ValueError):
+        EventStore(max_events_per_user=5).load_arrays(store.to_arrays())
+
+
+def test_max_events_per_user_must_be_positive():
+    with pytest.raises(ValueError):
+        EventStore(max_events_per_user=0)
+
+
+def test_put_and_get(client):
+    for item_id in (1, 2, 3, 4):
+        assert client.post("/put", params={"user_id": 5, "item_id": item_id}).json() == {"result": "ok"}
+
+    resp = client.post("/get", params={"user_id": 5, "k": 10}).json()
+    assert resp["events"] == [4, 3, 2] and resp["version"] == client.events_store.version(5)
+
+
+@pytest.mark.parametrize("params", [
+    {"user_id": 1, "item_id": 2**31},
+    {"user_id": 1, "item_id": -2**31 - 1},
+    {"user_id": 2**63, "item_id": 1},
+])
+def test_put_out_of_range(client, params):
+    assert client.post("/put", params=params).status_code == 422
+    assert len(client.events_store) == 0
+
+
+def test_put_batch_order_and_cap(client):
+    # события пользователей вперемешку и не по порядку времени
+    batch = {
+        "user_ids": [1, 2, 1, 1, 2, 1, 1],
+        "item_ids": [13, 21, 11, 15, 22, 12, 14],
+        "timestamps": [3, 1, 1, 5, 2, 2, 4],
+    }
+    assert client.post("/put_batch", json=batch).json() == {"result": "ok", "count": 7}
+
+    # хранятся только последние max_events_per_user (3) событий, от новых к старым
+    assert client.post("/get", params={"user_id": 1}).json()["events"] == [15, 14, 13]
+    assert client.post("/get", params={"user_id": 2}).json()["events"] == [22, 21]
+
+    # без timestamps события добавляются в порядке следования, после уже сохраненных
+    client.post("/put_batch", json={"user_ids": [2, 3, 2], "item_ids": [23, 31, 24]})
+    assert client.post("/get", params={"user_id": 2}).json()["events"] == [24, 23, 22]
+    assert client.post("/get", params={"user_id": 3}).json()["events"] == [31]
+
+
+def test_put_batch_matches_put(client):
+    rng = np.random.default_rng(0)
+    user_ids = rng.integers(0, 10, 300)
+    item_ids = rng.integers(0, 1000, 300)
+    expected = EventStore(max_events_per_user=3)
+    for user_id, item_id in zip(user_ids.tolist(), item_ids.tolist()):
+        expected.put(user_id, item_id)
+
+    client.post("/put_batch", json={"user_ids": user_ids.tolist(), "item_ids": item_ids.tolist()})
+
+    for user_id in range(10):
+        assert client.events_store.get(user_id, 3).tolist() == expected.get(user_id, 3).tolist()
+
+
+def test_put_batch_adds_seen_once():
+    class RecordingSeen:
+        def __init__(self):
+            self.items = []
+
+        def add(self, user_id, item_id):
+            self.items.append((user_id, item_id))
+
+        def add_many(self, user_id, item_ids):
+            self.items.extend((user_id, item_id) for item_id in np.asarray(item_ids).tolist())
+
+    store = EventStore(max_events_per_user=3)
+    store.seen_items = RecordingSeen()
+    store.put_batch([1, 2, 1, 1, 1], [10, 20, 11, 12, 13])
+
+    # в прослушанные по одному разу попадают все события, включая не попавшие в хранилище
+    assert sorted(store.seen_items.items) == [(1, 10), (1, 11), (1, 12), (1, 13), (2, 20)]
+    assert store.get(1, 3).tolist() == [13, 12, 11]
+
+    store.put(3, 30)
+    assert store.seen_items.items[-1] == (3, 30)
+
+
+@pytest.mark.parametrize("batch", [
+    {"user_ids": [1, 2], "item_ids": [1]},
+    {"user_ids": [1, 2], "item_ids": [1, 2], "timestamps": [1.0]},
+])
+def test_put_batch_mismatched_lengths(client, batch):
+    assert client.post("/put_batch", json=batch).status_code == 400
+    assert len(client.events_store) == 0
+
+
+def test_put_batch_out_of_range(client):
+    resp = client.post("/put_batch", json={"user_ids": [1, 2], "item_ids": [1, 2**31]})
+
+    assert resp.status_code == 422
+    assert len(client.events_store) == 0
+
+
+def write_events(path, n_events=1000, n_users=50, row_group_size=100, seed=0):
+    """
+    Записывает parquet-файл событий в формате events.parquet из нескольких частей (row groups)
+    и возвращает его в виде датафрейма
+    """
+    rng = np.random.default_rng(seed)
+    events = pd.DataFrame({
+        "user_id": rng.integers(0, n_users, n_events),
+        "item_id": rng.integers(0, 10_000, n_events).astype(np.int32),
+        "started_at": pd.Timestamp("2024-01-01") + pd.to_timedelta(np.arange(n_events), unit="s"),
+    })
+    pq.write_table(pa.Table.from_pandas(events, preserve_index=False), path, row_group_size=row_group_size)
+
+    return events
+
+
+def test_iter_event_batches(tmp_path):
+    events = write_events(tmp_path / "events.parquet")
+    batches = list(iter_event_batches(tmp_path / "events.parquet", batch_size=64))
+
+    # файл читается частями не больше batch_size, вместе части совпадают с файлом
+    assert len(batches) > 1 and all(len(user_ids) <= 64 for user_ids, _, _ in batches)
+    assert np.concatenate([user_ids for user_ids, _, _ in batches]).tolist() == events["user_id"].tolist()
+    assert np.concatenate([item_ids for _, item_ids, _ in batches]).tolist() == events["item_id"].tolist()
+    timestamps = np.concatenate([timestamps for _, _, timestamps in batches])
+    assert np.all(np.diff(timestamps) == 1)
+
+
+def test_load_events_in_chunks(tmp_path):
+    events = write_events(tmp_path / "events.parquet")
+    expected = EventStore(max_events_per_user=3)
+    for user_id, item_id in zip(events["user_id"].tolist(), events["item_id"].tolist()):
+        expected.put(user_id, item_id)
+
+    store = EventStore(max_events_per_user=3)
+    assert load_events(store, tmp_path / "events.parquet", batch_size=64) == len(events)
+    assert len(store) == len(expected)
+    for user_id in range(50):
+        assert store.get(user_id, 3).tolist() == expected.get(user_id, 3).tolist()
+
+    # при загрузке шарда загружаются только события его пользователей
+    ring = HashRing(["http://events0", "http://events1"], virtual_nodes=10)
+    shard_store = EventStore(max_events_per_user=3)
+    load_events(shard_store, tmp_path / "events.parquet", batch_size=64, ring=ring, shard_url="http://events1")
+    assert 0 < len(shard_store) < len(store)
+    for user_id in range(50):
+        owned = ring.node(user_id) == "http://events1"
+        assert shard_store.get(user_id, 3).tolist() == (store.get(user_id, 3).tolist() if owned else [])
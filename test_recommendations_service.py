@@ -0,0 +1,379 @@
+"""
+Тесты основного сервиса рекомендаций на небольших синтетических файлах
+(запросы через TestClient, вспомогательные хранилища - в том же процессе).
+
+Запуск:
+python -m pytest -q test_recommendations_service.py
+"""
+
+import os
+import json
+import time
+import asyncio
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from fastapi.testclient import TestClient
+import recommendations_service as rs
+from recommendations_service import Recommendations
+from events_service import EventStore
+from features_service import SimilarItems
+from store_clients import EmbeddedStoresClient
+from response_cache import ResponseCache
+from seen_items import SeenItems
+from hot_reload import ArtifactsReloader
+
+
+N_USERS = 100
+N_RECS = 5
+N_ITEMS = 1000
+
+
+def write_artifacts(directory):
+    """
+    Записывает файлы с рекомендациями: у пользователей 0..N_USERS-1 есть персональные рекомендации
+    u * N_RECS, ..., u * N_RECS + N_RECS - 1, рекомендации по умолчанию - объекты 900..919
+    """
+    pd.DataFrame({
+        "user_id": np.repeat(np.arange(N_USERS), N_RECS),
+        "item_id": np.arange(N_USERS * N_RECS),
+        "rank": np.tile(np.arange(1, N_RECS + 1), N_USERS),
+    }).to_parquet(directory / "recommendations.parquet")
+    pd.DataFrame({"item_id": np.arange(900, 920), "rank": np.arange(1, 21)}).to_parquet(directory / "top_popular.parquet")
+    pd.DataFrame({
+        "item_id_1": np.arange(N_ITEMS),
+        "item_id_2": (np.arange(N_ITEMS) + 1) % N_ITEMS,
+        "score": np.ones(N_ITEMS, dtype=np.float32),
+    }).to_parquet(directory / "similar.parquet")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """
+    Клиент основного сервиса, загружающего рекомендации из временной директории
+    """
+    write_artifacts(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    events_store = EventStore()
+    seen_store = SeenItems()
+    events_store.seen_items = seen_store
+    rec_store = Recommendations(rs.default_response_k)
+    response_cache = ResponseCache(1000, 60)
+    monkeypatch.setattr(rs, "rec_store", rec_store)
+    monkeypatch.setattr(rs, "seen_store", seen_store)
+    monkeypatch.setattr(rs, "response_cache", response_cache)
+    monkeypatch.setattr(rs, "reloaders", [ArtifactsReloader(rec_store, on_swap=response_cache.clear)])
+    monkeypatch.setattr(rs, "stores_client", EmbeddedStoresClient(
+        events_store, SimilarItems(), similar_items_path="similar.parquet", use_mmap=False,
+    ))
+    monkeypatch.setattr(rs, "watch_interval", 0)
+
+    with TestClient(rs.app) as client:
+        client.events_store = events_store
+        yield client
+
+
+def expected_recs(user_id, k=100):
+    if 0 <= user_id < N_USERS:
+        return list(range(user_id * N_RECS, user_id * N_RECS + min(k, N_RECS)))
+    return list(range(900, 900 + min(k, 20)))
+
+
+@pytest.mark.parametrize("k", [0, 3, 100])
+def test_batch_ndjson(client, k):
+    user_ids = [5, 150, 0, 99, -1, 5]
+    resp = client.post("/recommendations_batch", params={"k": k}, content="\n".join(map(str, user_ids)))
+
+    assert resp.status_code == 200
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [line["user_id"] for line in lines] == user_ids
+    assert [line["recs"] for line in lines] == [expected_recs(user_id, k) for user_id in user_ids]
+
+
+def test_batch_arrow_in_chunks(client, monkeypatch):
+    # тело запроса приходит фрагментами, которые режут строки посередине,
+    # а ответ собирается из нескольких частей
+    monkeypatch.setattr(rs, "BATCH_CHUNK_SIZE", 7)
+    user_ids = list(range(-10, 130))
+    body = ("\n".join(map(str, user_ids)) + "\n").encode()
+    fragments = (body[i:i + 5] for i in range(0, len(body), 5))
+    resp = client.post("/recommendations_batch", params={"k": 4, "format": "arrow"}, content=fragments)
+
+    assert resp.status_code == 200
+    table = pa.ipc.open_stream(resp.content).read_all()
+    assert table.column("user_id").to_pylist() == user_ids
+    assert table.column("recs").to_pylist() == [expected_recs(user_id, 4) for user_id in user_ids]
+
+
+class Body:
+    """
+    Тело запроса, которое приходит заданными фрагментами
+    """
+
+    def __init__(self, *fragments):
+        self.fragments = fragments
+
+    async def stream(self):
+        for fragment in self.fragments:
+            yield fragment
+
+
+def test_spool_user_ids():
+    spool = asyncio.run(rs.spool_user_ids(Body(b"1\n2", b"2\n3\n4", b"\n5\n\n6", b"")))
+    assert [chunk.tolist() for chunk in rs.iter_user_ids(spool, 2)] == [[1, 22], [3, 4], [5, 6]]
+    assert spool.closed
+
+    with pytest.raises(ValueError):
+        asyncio.run(rs.spool_user_ids(Body(b"1\n2\n3\n", b"abc\n", b"4\n")))
+
+
+def test_batch_empty(client):
+    resp = client.post("/recommendations_batch", content=b"")
+
+    assert resp.status_code == 200
+    assert resp.text == ""
+
+
+@pytest.mark.parametrize("body", [b"1\nabc\n3", b"1.5", b"99999999999999999999999"])
+def test_batch_invalid(client, body, monkeypatch):
+    # неверный идентификатор в любой части тела запроса дает ошибку 400, а не обрыв ответа
+    monkeypatch.setattr(rs, "BATCH_CHUNK_SIZE", 1)
+    resp = client.post("/recommendations_batch", content=body)
+
+    assert resp.status_code == 400
+
+
+def test_get_many_empty_index():
+    rec_store = Recommendations()
+    rec_store._recs = {
+        "personal": rs.build_recommendations(
+            "personal", pd.DataFrame({"user_id": np.empty(0, np.int64), "item_id": np.empty(0, np.int64),
+                                      "rank": np.empty(0, np.int64)})),
+        "default": np.array([7, 8, 9]),
+    }
+    offsets, item_ids = rec_store.get_many(np.array([1, 2]), 2)
+
+    assert offsets.tolist() == [0, 2, 4]
+    assert item_ids.tolist() == [7, 8, 7, 8]
+
+
+def count_calls(monkeypatch, obj, *names):
+    """
+    Подменяет асинхронные методы объекта обертками, считающими вызовы
+    """
+    calls = dict.fromkeys(names, 0)
+
+    def counting(name, method):
+        async def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return await method(*args, **kwargs)
+        return wrapper
+
+    for name in names:
+        monkeypatch.setattr(obj, name, counting(name, getattr(obj, name)))
+
+    return calls
+
+
+def test_blended_cache(client, monkeypatch):
+    calls = count_calls(monkeypatch, rs.stores_client, "get_events", "get_similar_items")
+    client.events_store.put(7, 500)
+
+    first = client.post("/recommendations", params={"user_id": 7, "k": 6}).json()
+    assert first["sources"] == ["offline", "online"]
+    assert calls == {"get_events": 1, "get_similar_items": 1}
+
+    # повторный запрос берется из кэша сразу после получения истории событий
+    assert client.post("/recommendations", params={"user_id": 7, "k": 6}).json() == first
+    assert calls == {"get_events": 2, "get_similar_items": 1}
+
+    # новое событие меняет версию истории и выдачу
+    client.events_store.put(7, 600)
+    second = client.post("/recommendations", params={"user_id": 7, "k": 6}).json()
+    assert 601 in second["recs"] and second != first
+    assert calls == {"get_events": 3, "get_similar_items": 2}
+
+
+def test_reload_clears_cache(client, tmp_path):
+    client.events_store.put(7, 500)
+    client.post("/recommendations", params={"user_id": 7})
+    assert len(rs.response_cache) > 0
+
+    # перезагрузка без запроса /admin/reload (так же, как при изменении файлов) тоже очищает кэш
+    write_artifacts(tmp_path)
+    asyncio.run(rs.reloaders[0].reload())
+    assert len(rs.response_cache) == 0
+
+
+def test_admin_reload_versions(client, tmp_path, monkeypatch):
+    seen_store = SeenItems()
+    seen_store.load(str(tmp_path / "seen.idx"))
+    monkeypatch.setattr(rs, "reloaders", rs.reloaders + [ArtifactsReloader(seen_store)])
+
+    # файлы изменены в пределах одной секунды
+    for path in ("recommendations.parquet", "top_popular.parquet"):
+        os.utime(tmp_path / path, ns=(1_700_000_000_000_000_000, 1_700_000_000_000_000_000))
+    first = client.post("/admin/reload").json()
+    os.utime(tmp_path / "recommendations.parquet", ns=(1_700_000_000_000_000_001, 1_700_000_000_000_000_001))
+    second = client.post("/admin/reload").json()
+
+    # возвращаются версии всех хранилищ
+    assert set(second["versions"]) == {"Recommendations", "SeenItems"}
+    assert second["version"] == second["versions"]["Recommendations"] == rs.rec_store.version
+    assert second["version"] != first["version"]
+    assert second["versions"]["SeenItems"] == first["versions"]["SeenItems"]
+
+
+def scrape(client):
+    """
+    Возвращает значения метрик из ответа /metrics: {"имя{метки}": значение}
+    """
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    samples = {}
+    for line in resp.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    return samples
+
+
+def test_metrics(client):
+    before = scrape(client)
+    client.events_store.put(5, 25)
+    for user_id in (5, 6):
+        assert client.post("/recommendations_offline", params={"user_id": user_id, "k": 3}).status_code == 200
+    # холодный пользователь получает готовый ответ с рекомендациями по умолчанию
+    assert client.post("/recommendations_offline", params={"user_id": 1000}).json()["recs"] == expected_recs(1000)
+    assert client.post("/recommendations_default", params={"k": 2}).status_code == 200
+    assert client.post("/recommendations_default", params={"k": "abc"}).status_code == 422
+    after = scrape(client)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    assert delta('http_requests_total{service="recommendations",endpoint="/recommendations_offline",status="200"}') == 3
+    assert delta('http_requests_total{service="recommendations",endpoint="/recommendations_default",status="200"}') == 1
+    assert delta('http_requests_total{service="recommendations",endpoint="/recommendations_default",status="422"}') == 1
+    assert delta('http_request_duration_seconds_count{service="recommendations",endpoint="/recommendations_offline"}') == 3
+    assert delta('http_request_duration_seconds_count{service="recommendations",endpoint="/recommendations_default"}') == 2
+
+    # этапы не вложены друг в друга: поиск по индексу и фильтрация прослушанных считаются отдельно
+    for stage in ("index_lookup", "seen_filter", "serialization"):
+        assert delta(f'stage_duration_seconds_count{{service="recommendations",stage="{stage}"}}') == 2
+    assert client.post("/recommendations_offline", params={"user_id": 5, "k": 3}).json()["recs"] == [26, 27, 28]
+
+    # персональные рекомендации - у пользователей 5 и 6, рекомендации по умолчанию - у холодного пользователя
+    # и в ответе /recommendations_default
+    assert delta('recommendations_responses_total{source="personal"}') == 2
+    assert delta('recommendations_responses_total{source="default"}') == 2
+
+
+def test_http_seen_items(client):
+    # в режиме http события попадают в прослушанные только через ответ events_service
+    client.events_store.seen_items = None
+    for item_id in (10, 11, 12, 13, 14):
+        client.events_store.put(7, item_id)
+
+    client.post("/recommendations_online", params={"user_id": 7})
+    assert rs.seen_store.contains(7, [10, 11, 12, 13, 14]).all()
+
+
+def test_online_candidates_capped(client, monkeypatch):
+    # прослушанных треков намного больше k
+    rs.seen_store.add_many(7, np.arange(10_000, 15_000))
+    client.events_store.put(7, 500)
+    requested = []
+    get_similar_items = rs.stores_client.get_similar_items
+
+    async def wrapper(item_ids, k=10, exclude_seed=False):
+        requested.append(k)
+        return await get_similar_items(item_ids, k, exclude_seed)
+
+    monkeypatch.setattr(rs.stores_client, "get_similar_items", wrapper)
+    resp = client.post("/recommendations_online", params={"user_id": 7, "k": 10}).json()
+
+    assert resp["recs"] == [501]
+    assert requested == [min(10 * rs.seen_candidates_factor, rs.seen_max_candidates)]
+    # запас не меньше k и без прослушанных - ровно k
+    assert rs.online_candidates(7, 5000) == 5000
+    assert rs.online_candidates(8, 10) == 10
+
+
+def test_seen_items_bounded(monkeypatch):
+    seen = SeenItems(max_users=3, ttl=60)
+    seen.load("missing.idx")
+    now = [0.0]
+    monkeypatch.setattr("seen_items.time.monotonic", lambda: now[0])
+
+    for user_id in range(5):
+        seen.add(user_id, user_id)
+    assert list(seen._delta) == [2, 3, 4] and set(seen._updated_at) == {2, 3, 4}
+
+    # событие с уже прослушанным треком тоже продлевает хранение
+    now[0] = 50
+    seen.add(2, 2)
+    now[0] = 100
+    seen.add(5, 5)
+    assert list(seen._delta) == [2, 5]
+    assert seen.count(3) == 0 and seen.count(2) == 1
+
+
+def test_openapi_and_validation(client):
+    paths = client.get("/openapi.json").json()["paths"]
+    for path in ("/recommendations_offline", "/recommendations_default"):
+        assert "post" in paths[path]
+
+    # стандартный ответ FastAPI на неверные параметры
+    detail = client.post("/recommendations_offline", params={"k": 3}).json()["detail"]
+    assert detail[0]["loc"] == ["query", "user_id"] and detail[0]["type"] == "missing"
+    detail = client.post("/recommendations_default", params={"k": "abc"}).json()["detail"]
+    assert detail[0]["loc"] == ["query", "k"] and detail[0]["type"] == "int_parsing"
+
+
+def slow(method, delay):
+    """
+    Асинхронный метод, отвечающий с задержкой delay секунд
+    """
+    async def wrapper(*args, **kwargs):
+        await asyncio.sleep(delay)
+        return await method(*args, **kwargs)
+
+    return wrapper
+
+
+@pytest.mark.parametrize("method", ["get_events", "get_similar_items"])
+def test_blended_deadline(client, monkeypatch, method):
+    monkeypatch.setattr(rs, "request_deadline", 0.1)
+    monkeypatch.setattr(rs.stores_client, method, slow(getattr(rs.stores_client, method), 2.0))
+    client.events_store.put(7, 500)
+
+    start = time.perf_counter()
+    resp = client.post("/recommendations", params={"user_id": 7, "k": 4}).json()
+    elapsed = time.perf_counter() - start
+
+    # онлайн-ветка не уложилась в отведенное время: только оффлайн-рекомендации с отметкой degraded
+    assert resp["degraded"] is True and resp["sources"] == ["offline"]
+    assert resp["recs"] == expected_recs(7, 4)
+    assert elapsed < 1.0
+    # такой ответ не кэшируется
+    assert len(rs.response_cache) == 0
+
+
+def test_blended_deadline_excludes_offline_lookup(client, monkeypatch):
+    monkeypatch.setattr(rs, "request_deadline", 0.1)
+    get = rs.rec_store.get
+
+    def slow_get(*args, **kwargs):
+        time.sleep(0.2)
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(rs.rec_store, "get", slow_get)
+    client.events_store.put(7, 500)
+    resp = client.post("/recommendations", params={"user_id": 7, "k": 4}).json()
+
+    # медленный поиск оффлайн-рекомендаций не переводит ответ в degraded
+    assert resp["degraded"] is False and resp["sources"] == ["offline", "online"]
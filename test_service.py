@@ -19,6 +19,7 @@ import logging
 import sys
 import argparse
 import configparser
+from sharding import HashRing, parse_urls
 
 
 # Настраиваем логирование
@@ -38,12 +39,19 @@ config = configparser.ConfigParser()
 config.read("config.ini")  
 
 # Читаем url-адреса всех сервисов из конфигурационного файла
+# (кавычки вокруг значений, если они есть в config.ini, отбрасываем)
 # Основной сервис для получения оффлайн- и онлайн-рекомендаций
-recommendations_url = config["urls"]["recommendations_url"] # "http://127.0.0.1:8000"
+recommendations_url = config["urls"]["recommendations_url"].strip('"') # "http://127.0.0.1:8000"
 # Вспомогательный сервис для получения рекомендаций по умолчанию на основе топ-треков
-features_store_url = config["urls"]["features_store_url"] # "http://127.0.0.1:8010"
+features_store_url = config["urls"]["features_store_url"].strip('"') # "http://127.0.0.1:8010"
 # Вспомогательный сервис для хранения и получения последних онлайн-событий пользователя
-events_store_url = config["urls"]["events_store_url"] # "http://127.0.0.1:8020"
+events_store_url = config["urls"]["events_store_url"].strip('"') # "http://127.0.0.1:8020"
+# Шарды хранилища онлайн-событий (пусто - один сервис по адресу events_store_url):
+# событие пользователя отправляется шарду, которому он принадлежит
+events_store_ring = HashRing(
+    parse_urls(config.get("urls", "events_store_shards", fallback="")) or [events_store_url],
+    config.getint("events", "virtual_nodes", fallback=100),
+)
 
 
 # Общий заголовок для всех http-запросов
@@ -80,7 +88,7 @@ def offline_recs(user_id: int = 617032, k: int = 10):
 # Добавление одного события в онлайн-историю пользователя
 def add_online(user_id: int, item_id: int):
     params = {"user_id": user_id, "item_id": item_id}
-    resp = requests.post(events_store_url + "/put", headers=headers, params=params)
+    resp = requests.post(events_store_ring.node(user_id) + "/put", headers=headers, params=params)
     if resp.status_code == 200:
         resp = resp.json()
         logger.info(f"Successfully added item_id={item_id} to user_id={user_id} online history")
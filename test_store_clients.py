@@ -0,0 +1,264 @@
+"""
+Тесты одинаковости ответов встроенного и http-клиентов вспомогательных сервисов (см. store_clients.py).
+
+Оба клиента работают с одними и теми же объектами EventStore и SimilarItems: встроенный - напрямую,
+http - через приложения events_service и features_service, запущенные в том же процессе
+(ASGI-транспорт httpx, без сети и без запуска сервисов). Также проверяется, что при нескольких
+шардах events_service события пользователя отправляются на его шард и запрашиваются с него -
+и в том же процессе, и с шардами, запущенными через uvicorn в отдельных процессах.
+
+Запуск:
+python -m pytest -q test_store_clients.py
+"""
+
+import os
+import sys
+import socket
+import asyncio
+import subprocess
+import configparser
+import httpx
+import numpy as np
+import pandas as pd
+import pytest
+import events_service
+import features_service
+from events_service import EventStore
+from features_service import SimilarItems
+from artifacts import build_similar_items
+from store_clients import HttpStoresClient, EmbeddedStoresClient
+from sharding import HashRing
+from load_test import request_url, wait_ready, stop_services
+
+
+EVENTS_URL = "http://events"
+FEATURES_URL = "http://features"
+
+
+class AppsTransport(httpx.AsyncBaseTransport):
+    """
+    Транспорт httpx, передающий запрос ASGI-приложению по адресу сервиса
+    """
+
+    def __init__(self, apps):
+        self.transports = {url: httpx.ASGITransport(app) for url, app in apps.items()}
+
+    async def handle_async_request(self, request):
+        url = f"{request.url.scheme}://{request.url.host}"
+        return await self.transports[url].handle_async_request(request)
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    """
+    Хранилища событий и похожих объектов, общие для обоих клиентов
+    """
+    rng = np.random.default_rng(0)
+    n_items = 50
+    similar = pd.DataFrame({
+        "item_id_1": np.repeat(np.arange(n_items), 5),
+        "item_id_2": rng.integers(0, n_items, 5 * n_items),
+        "score": rng.random(5 * n_items).astype(np.float32),
+    })
+    sim_items_store = SimilarItems()
+    sim_items_store._similar_items = build_similar_items(similar)
+    sim_items_store.version = "test"
+
+    events_store = EventStore(max_events_per_user=5)
+    for user_id, item_id in zip(rng.integers(0, 10, 40).tolist(), rng.integers(0, n_items, 40).tolist()):
+        events_store.put(user_id, item_id)
+
+    # Обработчики сервисов обращаются к хранилищам через глобальные переменные модулей
+    monkeypatch.setattr(events_service, "events_store", events_store)
+    monkeypatch.setattr(features_service, "sim_items_store", sim_items_store)
+
+    return events_store, sim_items_store
+
+
+def make_clients(stores):
+    """
+    Создает встроенный и http-клиенты для одних и тех же хранилищ
+    """
+    events_store, sim_items_store = stores
+    embedded = EmbeddedStoresClient(events_store, sim_items_store)
+    http = HttpStoresClient(
+        EVENTS_URL, FEATURES_URL,
+        transport=AppsTransport({EVENTS_URL: events_service.app, FEATURES_URL: features_service.app}),
+    )
+
+    return embedded, http
+
+
+async def call_both(stores, method, *args):
+    """
+    Вызывает метод method обоих клиентов с одинаковыми аргументами и возвращает ответы
+    """
+    embedded, http = make_clients(stores)
+    await http.start()
+    try:
+        return await getattr(embedded, method)(*args), await getattr(http, method)(*args)
+    finally:
+        await http.close()
+
+
+@pytest.mark.parametrize("user_id, k", [(0, 3), (1, 5), (2, 100), (3, 0), (12345, 3)])
+def test_get_events(stores, user_id, k):
+    (expected, expected_version), (actual, actual_version) = asyncio.run(call_both(stores, "get_events", user_id, k))
+
+    assert actual == expected
+    assert actual_version == expected_version
+    if user_id == 12345:
+        assert actual == [] and actual_version == 0
+
+
+@pytest.mark.parametrize("item_ids, k, exclude_seed", [
+    ([1, 2, 3], 10, False),
+    ([1, 2, 3], 10, True),
+    ([7], 3, False),
+    ([4, 4, 5], 100, False),
+    ([1, 1000, 2000], 10, False),
+    ([1000, 2000], 10, False),
+    ([], 10, False),
+])
+def test_get_similar_items(stores, item_ids, k, exclude_seed):
+    expected, actual = asyncio.run(call_both(stores, "get_similar_items", item_ids, k, exclude_seed))
+
+    assert np.array_equal(np.asarray(actual["item_id_2"]), np.asarray(expected["item_id_2"]))
+    assert np.array_equal(np.asarray(actual["score"], dtype=np.float32), np.asarray(expected["score"], dtype=np.float32))
+    assert actual.get("version") == expected.get("version")
+
+
+def test_online_request(stores):
+    """
+    Полный онлайн-запрос основного сервиса: последние события пользователя и похожие на них объекты
+    """
+    async def online_recs(client, user_id):
+        events, version = await client.get_events(user_id, 3)
+        return events, version, await client.get_similar_items(events, 10)
+
+    embedded, http = make_clients(stores)
+
+    async def run():
+        await http.start()
+        try:
+            return [(await online_recs(embedded, user_id), await online_recs(http, user_id)) for user_id in range(12)]
+        finally:
+            await http.close()
+
+    for (events, version, i2i), (http_events, http_version, http_i2i) in asyncio.run(run()):
+        assert http_events == events and http_version == version
+        assert np.array_equal(np.asarray(http_i2i["item_id_2"]), np.asarray(i2i["item_id_2"]))
+
+
+def shard_app(events_store):
+    """
+    Приложение events_service со своим хранилищем событий (запросы в тесте выполняются по одному,
+    поэтому подмена глобального хранилища не пересекается между шардами)
+    """
+    async def app(scope, receive, send):
+        events_service.events_store = events_store
+        await events_service.app(scope, receive, send)
+
+    return app
+
+
+def test_sharded_events(monkeypatch):
+    monkeypatch.setattr(events_service, "events_store", events_service.events_store)
+    shards = [f"http://events{i}" for i in range(3)]
+    shard_stores = {url: EventStore(max_events_per_user=5) for url in shards}
+    transport = AppsTransport({url: shard_app(store) for url, store in shard_stores.items()})
+    ring = HashRing(shards, virtual_nodes=10)
+    user_ids = list(range(30))
+
+    async def run():
+        # события отправляются так же, как в load_test.py
+        async with httpx.AsyncClient(transport=transport) as client:
+            for user_id in user_ids:
+                for item_id in (user_id, user_id + 100):
+                    url = request_url({}, ring, "put", user_id)
+                    (await client.post(url, params={"user_id": user_id, "item_id": item_id})).raise_for_status()
+
+        http = HttpStoresClient(shards[0], FEATURES_URL, events_store_shards=shards, virtual_nodes=10,
+                                transport=transport)
+        await http.start()
+        try:
+            return [(await http.get_events(user_id, 5))[0] for user_id in user_ids]
+        finally:
+            await http.close()
+
+    events = asyncio.run(run())
+
+    assert events == [[user_id + 100, user_id] for user_id in user_ids]
+    for user_id in user_ids:
+        for url, store in shard_stores.items():
+            assert (len(store.get(user_id, 5)) > 0) == (url == ring.node(user_id))
+    # пользователи распределены между всеми шардами
+    assert all(len(store) > 0 for store in shard_stores.values())
+
+
+def free_port():
+    """
+    Возвращает свободный порт, выбранный ОС
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def shard_processes(tmp_path):
+    """
+    Два шарда events_service, запущенные через uvicorn в отдельных процессах на свободных портах
+    """
+    shards = [f"http://127.0.0.1:{free_port()}" for _ in range(2)]
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "urls": {"events_store_shards": ", ".join(shards)},
+        "events": {"max_events_per_user": "5", "warmup_path": "", "persistence_dir": "", "virtual_nodes": "10"},
+    })
+    with open(tmp_path / "config.ini", "w") as f:
+        config.write(f)
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "events_service:app", "--app-dir", repo_dir,
+                          "--port", url.rsplit(":", 1)[1], "--log-level", "warning"], cwd=tmp_path)
+        for url in shards
+    ]
+    try:
+        for url, process in zip(shards, processes):
+            wait_ready(url, process, timeout=60.0)
+        yield shards
+    finally:
+        stop_services(processes)
+
+
+def test_sharded_events_processes(shard_processes):
+    shards = shard_processes
+    ring = HashRing(shards, virtual_nodes=10)
+    user_ids = list(range(20))
+
+    # события отправляются так же, как в load_test.py
+    with httpx.Client() as client:
+        for user_id in user_ids:
+            for item_id in (user_id, user_id + 100):
+                url = request_url({}, ring, "put", user_id)
+                client.post(url, params={"user_id": user_id, "item_id": item_id}).raise_for_status()
+
+        # события пользователя есть только на его шарде
+        for user_id in user_ids:
+            for url in shards:
+                events = client.post(url + "/get", params={"user_id": user_id, "k": 5}).json()["events"]
+                assert events == ([user_id + 100, user_id] if url == ring.node(user_id) else [])
+        # пользователи распределены между обоими шардами
+        assert len({ring.node(user_id) for user_id in user_ids}) == 2
+
+    async def run():
+        http = HttpStoresClient(shards[0], FEATURES_URL, events_store_shards=shards, virtual_nodes=10)
+        await http.start()
+        try:
+            return [(await http.get_events(user_id, 5))[0] for user_id in user_ids]
+        finally:
+            await http.close()
+
+    assert asyncio.run(run()) == [[user_id + 100, user_id] for user_id in user_ids]